@@ -0,0 +1,142 @@
+import os
+import re
+import csv
+import time
+import hashlib
+import logging
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List
+import Bio.Entrez as Entrez
+
+from phenox.paths import PhenoXPaths
+from phenox.phenox import PhenoX, PhenoXResources
+from phenox.transport import make_transport
+
+SUMMARY_COLUMNS = ('query', 'outprefix', 'status', 'seconds', 'error')
+
+# resources loaded once per batch worker process
+_worker_resources = None
+_worker_config = None
+
+
+def read_queries(query_file: str) -> List:
+    """
+    One disease query per line; blank lines, # comments and repeats are skipped
+    :param query_file:
+    :return:
+    """
+    with open(query_file, 'r') as f:
+        queries = [line.strip() for line in f]
+    return list(dict.fromkeys(q for q in queries if q and not q.startswith('#')))
+
+
+def query_prefix(outprefix: str, query: str) -> str:
+    """
+    Per query output prefix, e.g. phenox_breast-neoplasms-1f0e3dad; the
+    query hash keeps queries apart that only differ in punctuation
+    :param outprefix:
+    :param query:
+    :return:
+    """
+    name = re.sub(r'[^0-9A-Za-z]+', '-', query).strip('-')
+    return '{}_{}-{}'.format(outprefix, name, hashlib.sha256(query.encode('utf-8')).hexdigest()[:8])
+
+
+def _init_worker(config: Dict) -> None:
+    global _worker_resources, _worker_config
+    _worker_config = config
+    _worker_resources = PhenoXResources(
+        config['email'], config['outprefix'], cache_mode=config['cache_mode'],
+        cache_size=config['cache_size'], ner_processes=config['ner_processes'],
+        request_rate=config['request_rate'], transport=make_transport(**config['transport'])
+    )
+    try:
+        _worker_resources.warm(config['phenox_args'].get('cluster_engine', 'pvclust'))
+    except Exception as err:
+        # queries report the failure themselves when they need the resource
+        logging.warning('Could not preload shared resources: {}'.format(err))
+
+
+def _run_query(query: str, options=None) -> Dict:
+    """
+    Run one query on the worker's shared resources, recording any failure
+    :param query:
+    :param options: PhenoX options overriding the batch defaults
+    :return: summary row
+    """
+    outprefix = query_prefix(_worker_config['outprefix'], query)
+    start = time.perf_counter()
+    row = {'query': query, 'outprefix': outprefix, 'status': 'ok', 'error': ''}
+    try:
+        phenox = PhenoX(_worker_config['email'], query, outprefix, resources=_worker_resources,
+                        **dict(_worker_config['phenox_args'], **(options or {})))
+        phenox.subtype()
+    except (Exception, SystemExit) as err:
+        # e.g. NCBIUnavailableError or a MeSH prompt exit, keep the batch going
+        logging.error('Query {} failed:\n{}'.format(query, traceback.format_exc()))
+        row['status'] = 'failed'
+        row['error'] = '{}: {}'.format(type(err).__name__, err)
+    row['seconds'] = round(time.perf_counter() - start, 1)
+    return row
+
+
+def worker_config(email: str, outprefix: str, workers=1, cache_mode='readwrite', cache_size=2048,
+                  ner_processes=1, transport=None, **phenox_args) -> Dict:
+    """
+    Settings each worker process builds its shared resources from
+    :param transport: transport.make_transport settings, e.g. {'replay': archive_file}
+    :return:
+    """
+    return {
+        'email': email, 'outprefix': outprefix, 'cache_mode': cache_mode, 'cache_size': cache_size,
+        'ner_processes': ner_processes, 'phenox_args': phenox_args, 'transport': transport or dict(),
+        'request_rate': (10 if Entrez.api_key else 3) / workers,
+    }
+
+
+def run_batch(email: str, queries: List, outprefix: str, workers=1, cache_mode='readwrite',
+              cache_size=2048, ner_processes=1, transport=None, **phenox_args) -> str:
+    """
+    Subtype many diseases. Each worker process loads the shared resources
+    once and runs queries one after another; NCBI's request rate is split
+    between the workers.
+    :param email:
+    :param queries: disease query terms
+    :param outprefix: prefix of the batch summary, query outputs get
+        <outprefix>_<query>
+    :param workers: worker processes
+    :param cache_mode:
+    :param cache_size:
+    :param ner_processes:
+    :param transport: transport.make_transport settings
+    :param phenox_args: further PhenoX options (mesh_policy, cluster_engine, ...)
+    :return: path of the summary file
+    """
+    workers = max(1, min(workers, len(queries)))
+    config = worker_config(email, outprefix, workers, cache_mode=cache_mode, cache_size=cache_size,
+                           ner_processes=ner_processes, transport=transport, **phenox_args)
+
+    rows = []
+    if workers == 1:
+        _init_worker(config)
+        for query in queries:
+            rows.append(_run_query(query))
+            print('{} {} ({}s)'.format(rows[-1]['status'], query, rows[-1]['seconds']))
+    else:
+        with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(config,)) as executor:
+            for row in executor.map(_run_query, queries):
+                rows.append(row)
+                print('{} {} ({}s)'.format(row['status'], row['query'], row['seconds']))
+
+    paths = PhenoXPaths(outprefix)
+    os.makedirs(paths.output_dir, exist_ok=True)
+    summary_file = os.path.join(paths.output_dir, '{}_batch_summary.txt'.format(outprefix))
+    with open(summary_file, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=SUMMARY_COLUMNS, delimiter='\t')
+        writer.writeheader()
+        writer.writerows(rows)
+
+    n_failed = sum(row['status'] != 'ok' for row in rows)
+    print('{} of {} queries succeeded, summary written to {}'.format(len(rows) - n_failed, len(rows), summary_file))
+    return summary_file
@@ -4,11 +4,39 @@ import pandas as pd
 import scipy.stats as stats
 import itertools
 from typing import List, Dict, Tuple
-from collections import Counter, defaultdict
+from collections import defaultdict
 
 from phenox.paths import PhenoXPaths
 
 
+def fdr_bh(p_values: np.ndarray) -> np.ndarray:
+    """
+    Benjamini-Hochberg adjusted p-values, NaN entries are left out
+    :param p_values:
+    :return: adjusted p-values in input order
+    """
+    p_values = np.asarray(p_values, dtype=np.float64)
+    adjusted = np.full(p_values.shape, np.nan)
+    valid = np.flatnonzero(~np.isnan(p_values))
+    if not len(valid):
+        return adjusted
+    order = valid[np.argsort(p_values[valid])]
+    ranked = p_values[order] * len(order) / np.arange(1, len(order) + 1)
+    adjusted[order] = np.minimum(np.minimum.accumulate(ranked[::-1])[::-1], 1)
+    return adjusted
+
+
+def first_mode(counts: np.ndarray, first_seen: np.ndarray) -> np.ndarray:
+    """
+    Most frequent category per row, ties broken by first appearance
+    :param counts: rows x categories counts
+    :param first_seen: rows x categories position of first appearance
+    :return: category index per row
+    """
+    is_max = counts == counts.max(axis=1, keepdims=True)
+    return np.where(is_max, first_seen, np.inf).argmin(axis=1)
+
+
 class BatchEffect:
     def __init__(self, cluster_dict: Dict, meta_dict: Dict, outprefix: str) -> None:
         """
@@ -22,93 +50,145 @@ class BatchEffect:
         self.num_clusters = len(cluster_dict)
         self.meta_dict = meta_dict
         self.meta_list = ('Sample N', 'Submission Age', 'GPL')
-    
+
+        # cluster index of each entry of the concatenated cluster lists
+        sizes = np.array([len(v) for v in cluster_dict.values()], dtype=np.int64)
+        self.cluster_ids = list(cluster_dict.keys())
+        self.cluster_sizes = sizes
+        self.cluster_of = np.repeat(np.arange(self.num_clusters), sizes)
+        self.gpl_categories = None
+
     def _total_stats(self) -> List:
         """
-        Generate total distributions for each gds metadata value
-        :return total_stats: list of lists (distributions of all gds for each
-            set: n_samples, dates, GPLs)
+        Generate total distributions for each gds metadata value, as typed
+        columns over the concatenated cluster lists
+        :return total_stats: list of arrays (distributions of all gds for each
+            set: n_samples, dates, integer coded GPLs)
         """
         # generate total list of gds for clusters
         gds_in_cluster = list(itertools.chain.from_iterable(self.clusters.values()))
-        # print(gds_in_cluster)
-        
-        # generate total stats dict
-        total_stats = [[] for i in range(3)]
-        [[total_stats[i].append(self.meta_dict[gds][i]) for gds in gds_in_cluster] for i in range(3)]
-        return total_stats
+        metrics = [self.meta_dict[gds] for gds in gds_in_cluster]
 
-    def _generate_ks_test(self, meta_value: int, total_dist: List, clust_stats=None) -> Dict:
+        n_samples = np.array([float(m[0]) for m in metrics], dtype=np.float64)
+        dates = np.array([float(m[1]) for m in metrics], dtype=np.float64)
+        self.gpl_categories, gpl_codes = np.unique(np.array([str(m[2]) for m in metrics]), return_inverse=True)
+        return [n_samples, dates, gpl_codes.astype(np.int64)]
+
+    def _cluster_moments(self, values: np.ndarray) -> Tuple:
+        """
+        Per cluster mean and sample standard deviation
+        :param values: metric over the concatenated cluster lists
+        :return: means, standard deviations (NaN for single member clusters)
+        """
+        n = self.cluster_sizes.astype(np.float64)
+        means = np.bincount(self.cluster_of, weights=values, minlength=self.num_clusters) / n
+        sq_dev = np.bincount(self.cluster_of, weights=(values - means[self.cluster_of]) ** 2,
+                             minlength=self.num_clusters)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            stds = np.where(n > 1, np.sqrt(sq_dev / (n - 1)), np.nan)
+        return means, stds
+
+    def _ks_statistics(self, values: np.ndarray) -> np.ndarray:
+        """
+        Two sample KS statistic of every cluster against the total sample.
+        Cluster ECDFs are cumulative membership counts over the sorted total
+        sample, read at the last position of each run of tied values.
+        :param values: metric over the concatenated cluster lists
+        :return: KS statistic per cluster
+        """
+        n_total = len(values)
+        order = np.argsort(values, kind='stable')
+        sorted_vals = values[order]
+        ends = np.flatnonzero(np.append(sorted_vals[1:] != sorted_vals[:-1], True))
+
+        membership = np.zeros((self.num_clusters, n_total), dtype=np.int32)
+        membership[self.cluster_of[order], np.arange(n_total)] = 1
+        clust_cdf = np.cumsum(membership, axis=1)[:, ends] / self.cluster_sizes[:, None]
+        total_cdf = (ends + 1) / n_total
+        return np.abs(clust_cdf - total_cdf).max(axis=1)
+
+    def _generate_ks_test(self, meta_value: int, total_dist: np.ndarray, clust_stats=None) -> np.ndarray:
         """
         Kolmogrov-Smirnov test for cluster vals and total vals from same dist
         :param meta_value: integer index for gds metric
-        :param total_dist: list distribution of gds metric for ONE gds set
+        :param total_dist: distribution of gds metric for ONE gds set
         :param clust_stats: pass mutable dict for recursive additions
             key=cluster_ids, value=ordered list of stats for all gds metrics
             (KS/chi-stat, p-value, mean/mode, s.d./category_n)
-        :return:
+        :return: per cluster p-values
         """
         # Create if empty
         if clust_stats is None:
             clust_stats = defaultdict(list)
-        
+
         #total output values
-        total_array = np.array(total_dist)
-        clust_stats['Overall'].extend([None, None, np.mean(total_array), np.std(total_array, ddof=1)])    
-        # print(total_dist)
-        
-        #per cluster outputs
-        for cluster_id, cluster_list in self.clusters.items():
-            cluster_dist = [self.meta_dict[gds][meta_value] for gds in cluster_list]
-            # print(cluster_list)
-            clust_array = np.array(cluster_dist)
-            KS_stat, p_val = stats.ks_2samp(clust_array, total_array)
-            clust_stats[cluster_id].extend([KS_stat, p_val, np.mean(clust_array), np.std(clust_array, ddof=1)])
-            if p_val <= 0.01:
-                print('{}\'s {} sample is drawn from a significantly different distribution than the overall sample'.format(cluster_id, self.meta_list[meta_value]))
-        return
-    
+        total_array = np.asarray(total_dist, dtype=np.float64)
+        clust_stats['Overall'].extend([None, None, np.mean(total_array), np.std(total_array, ddof=1)])
+
+        #per cluster outputs, p-values from scipy's exact or asymptotic distributions
+        ks_stats = self._ks_statistics(total_array)
+        clusters = np.split(total_array, np.cumsum(self.cluster_sizes)[:-1])
+        p_vals = np.array([stats.ks_2samp(cluster, total_array).pvalue for cluster in clusters])
+        means, stds = self._cluster_moments(total_array)
+        for i, cluster_id in enumerate(self.cluster_ids):
+            clust_stats[cluster_id].extend([ks_stats[i], p_vals[i], means[i], stds[i]])
+        return p_vals
+
     # For chi-squared test of platform types different from overall
-    def _generate_chisq_test(self, total_dist: List, clust_stats: Dict) -> Dict:
+    def _generate_chisq_test(self, total_dist: np.ndarray, clust_stats: Dict) -> np.ndarray:
         """
-        Chi Squared test for cluster distribution independence from total dist
-        :param total_dist: list distribution of gds metric for total gds set
+        Chi Squared test for cluster distribution independence from total dist,
+        all clusters at once from a cluster x category contingency matrix
+        :param total_dist: integer coded GPLs for total gds set
         :param clust_stats: pass mutable dict for recursive additions
             key=cluster_ids, value=ordered list of stats for all gds metrics
             (KS/chi-stat, p-value, mean/mode, s.d./category_n)
-        :return:
+        :return: per cluster p-values
         """
+        codes = np.asarray(total_dist, dtype=np.int64)
+        n_cat = len(self.gpl_categories)
+        positions = np.arange(len(codes), dtype=np.float64)
+
         # total distribution to counts of categories
-        total_frame = pd.DataFrame.from_dict(Counter(total_dist), orient='index')
-        clust_stats['Overall'].extend([None, None, total_frame[0].idxmax(), len(total_frame.index)]) 
-        
+        total_counts = np.bincount(codes, minlength=n_cat)
+        total_first = np.full(n_cat, np.inf)
+        np.minimum.at(total_first, codes, positions)
+        total_mode = first_mode(total_counts[None, :], total_first[None, :])[0]
+        clust_stats['Overall'].extend([None, None, self.gpl_categories[total_mode], n_cat])
+
         # per cluster counts
-        for cluster_id, cluster_list in self.clusters.items():
-            cluster_dist = [self.meta_dict[gds][2] for gds in cluster_list] # GPL index in meta_list is 2
-            clust_frame = pd.DataFrame.from_dict(Counter(cluster_dist), orient='index')
-            chi_frame = clust_frame.merge(total_frame, how='right', right_index=True, left_index=True).fillna(0)
-            chi_stat, p_val = stats.chisquare(f_obs=chi_frame['0_x'], f_exp=chi_frame['0_y'])
-            clust_stats[cluster_id].extend([chi_stat, p_val, clust_frame[0].idxmax(), len(clust_frame.index)])
-            if p_val <= 0.01:
-                print('{}\'s platform distribution is significantly different from the overall distribution'.format(cluster_id))
-        return
+        counts = np.bincount(self.cluster_of * n_cat + codes,
+                             minlength=self.num_clusters * n_cat).reshape(self.num_clusters, n_cat)
+        first_seen = np.full((self.num_clusters, n_cat), np.inf)
+        np.minimum.at(first_seen, (self.cluster_of, codes), positions)
+
+        chi_stats = (((counts - total_counts) ** 2) / total_counts).sum(axis=1)
+        p_vals = stats.chi2.sf(chi_stats, n_cat - 1) if n_cat > 1 else np.full(self.num_clusters, np.nan)
+        modes = self.gpl_categories[first_mode(counts, first_seen)]
+        category_n = (counts > 0).sum(axis=1)
+        for i, cluster_id in enumerate(self.cluster_ids):
+            clust_stats[cluster_id].extend([chi_stats[i], p_vals[i], modes[i], category_n[i]])
+        return p_vals
 
-    def _stat_outfile(self, clust_stats: Dict) -> None:
+    def _stat_outfile(self, clust_stats: Dict, adjusted: Dict=None) -> None:
         """
         Generate output tab separated text file
         :param clust_stats: pass mutable dict for recursive additions
             key=cluster_ids, value=ordered list of stats for all gds metrics
             (KS/chi-stat, p-value, mean/mode, s.d./category_n)
-        :param outprefix: 
+        :param adjusted: key=gds metric, value=per cluster BH adjusted p-values,
+            appended as extra columns
         :return:
         """
         # define order for column labels
         stat_list = ('KS-stat', 'P-value', 'Mean', 'Std Dev', 'Chi-stat', 'P-value', 'Mode', 'Category N')
         columns = [' '.join([i, j]) for i in (self.meta_list[0], self.meta_list[1]) for j in stat_list[:4]]
         columns.extend([' '.join([self.meta_list[2], j]) for j in stat_list[4:]])
-        
+
         # transfer dict to dataframe
         out_tbl = pd.DataFrame.from_dict(clust_stats, orient='index', columns=columns)
+        for metric, p_adj in (adjusted or dict()).items():
+            out_tbl['{} Adj P-value'.format(metric)] = pd.Series(p_adj, index=self.cluster_ids)
         outfile = os.path.join(self.paths.output_dir, '{}_cluster_stats.txt'.format(self.paths.outprefix))
         print('Writing batch statistics to {}'.format(outfile))
         out_tbl.to_csv(outfile, sep='\t', na_rep='.', index_label='Cluster ID')
@@ -121,12 +201,21 @@ class BatchEffect:
         """
         total_stats = self._total_stats()
         clust_stats = defaultdict(list)
-        
+
         # For n_samples and date, populate clust_stats recursively
-        [self._generate_ks_test(i, total_stats[i], clust_stats) for i in range(2)]
-        
+        p_vals = [self._generate_ks_test(i, total_stats[i], clust_stats) for i in range(2)]
+
         # For GPL, chi squared stats in clust_stats
-        self._generate_chisq_test(total_stats[2], clust_stats)
-        
+        p_vals.append(self._generate_chisq_test(total_stats[2], clust_stats))
+
+        # Benjamini-Hochberg correction across clusters for each metric
+        adjusted = {metric: fdr_bh(p) for metric, p in zip(self.meta_list, p_vals)}
+        for metric, p_adj in adjusted.items():
+            for cluster_id in np.array(self.cluster_ids, dtype=object)[p_adj <= 0.01]:
+                if metric == 'GPL':
+                    print('{}\'s platform distribution is significantly different from the overall distribution'.format(cluster_id))
+                else:
+                    print('{}\'s {} sample is drawn from a significantly different distribution than the overall sample'.format(cluster_id, metric))
+
         #generate outfile
-        self._stat_outfile(clust_stats)
+        self._stat_outfile(clust_stats, adjusted)
@@ -0,0 +1,340 @@
+import io
+import os
+import sys
+import json
+import time
+import platform
+import tempfile
+import tracemalloc
+import contextlib
+from collections import Counter
+from typing import Callable, Dict, List, Tuple
+
+import numpy as np
+
+from phenox.geo_data import GEOQuery, as_csr, docsum_gene_counts, merge_gds_dict
+from phenox.batcheffect import BatchEffect
+from phenox.bootstrap_cluster import MultiscaleBootstrap
+from phenox.keyword_matcher import KeywordMatcher
+from phenox.metrics import cpu_time
+from phenox.pubmed import Pubmed
+from phenox.wordcloud import WordcloudPlotter
+
+
+# benchmarked stages, in pipeline order
+BENCH_STAGES = ('gdsdict', 'docsum_stream', 'dataframe', 'cluster', 'batch', 'ner', 'wordcloud')
+
+# the bootstrap forms a dense GDS x GDS matrix per replicate, so the cluster
+# stage runs on at most this many datasets
+CLUSTER_MAX_DATASETS = 5000
+
+# synthetic data sizes; production queries range from about 100 to 20k
+# GEO datasets and 1k to 1M abstracts
+SCALES = {
+    'small': dict(datasets=100, genes_per_dataset=50, genes=5000, abstracts=1000, keywords=2000,
+                  clusters=6, nboot=100),
+    'medium': dict(datasets=2000, genes_per_dataset=100, genes=15000, abstracts=50000, keywords=20000,
+                   clusters=12, nboot=200),
+    'large': dict(datasets=20000, genes_per_dataset=200, genes=25000, abstracts=1000000, keywords=50000,
+                  clusters=24, nboot=500),
+}
+
+# words abstracts are padded with besides keyword mentions
+FILLER_WORDS = ('the', 'patients', 'expression', 'was', 'increased', 'in', 'cells', 'with', 'of',
+                'significantly', 'cohort', 'study', 'and', 'samples', 'associated', 'levels')
+
+
+def synthetic_docsums(datasets: int, genes_per_dataset: int, genes: int, batch_size=500, seed=0) -> List:
+    """
+    GEO profile docsum batches shaped like the parsed esummary results that
+    gdsdict_from_profile reads, one profile per (dataset, gene) with gene
+    popularity following a power law as in real GEO profiles
+    :param datasets: number of GDS
+    :param genes_per_dataset: mean differential genes per GDS
+    :param genes: gene vocabulary size
+    :param batch_size: docsums per batch
+    :param seed:
+    :return:
+    """
+    rng = np.random.default_rng(seed)
+    popularity = 1. / np.arange(1, genes + 1) ** .8
+    popularity /= popularity.sum()
+    docsums = []
+    for gds_id in range(1, datasets + 1):
+        n_genes = max(1, min(genes, rng.poisson(genes_per_dataset)))
+        for gene in rng.choice(genes, n_genes, replace=False, p=popularity):
+            docsums.append({'GDS': str(gds_id), 'geneName': 'GENE{}'.format(gene)})
+    return [{'DocumentSummarySet': {'DocumentSummary': docsums[i:i + batch_size]}}
+            for i in range(0, len(docsums), batch_size)]
+
+
+def docsum_xml(batch: Dict) -> bytes:
+    """
+    Raw efetch docsum response of a synthetic docsum batch, as streamed by
+    docsum_gene_counts
+    :param batch: one batch from synthetic_docsums
+    :return:
+    """
+    records = ''.join('<DocumentSummary uid="{0}"><GDS>{1}</GDS><geneName>{2}</geneName></DocumentSummary>'
+                      .format(i, docsum['GDS'], docsum['geneName'])
+                      for i, docsum in enumerate(batch['DocumentSummarySet']['DocumentSummary']))
+    return ('<?xml version="1.0" encoding="UTF-8" ?>\n<eSummaryResult><DocumentSummarySet status="OK">'
+            '{}</DocumentSummarySet></eSummaryResult>'.format(records)).encode('utf-8')
+
+
+def synthetic_meta(gds_ids: List, seed=0) -> Dict:
+    """
+    Batch effect metadata as returned by meta_from_gds
+    :param gds_ids:
+    :param seed:
+    :return: key=gds_ids, value=[n_samples, submission timestamp, GPL]
+    """
+    rng = np.random.default_rng(seed)
+    n_samples = rng.integers(4, 200, len(gds_ids))
+    dates = rng.uniform(1.0e9, 1.5e9, len(gds_ids))
+    platforms = rng.choice(['570', '96', '6244', '6947', '10558', '6883'], len(gds_ids))
+    return {gds: [str(n), float(d), str(p)] for gds, n, d, p in zip(gds_ids, n_samples, dates, platforms)}
+
+
+def synthetic_clusters(gds_ids: List, clusters: int, seed=0) -> Dict:
+    """
+    Random partition of GDS ids into clusters
+    :param gds_ids:
+    :param clusters:
+    :param seed:
+    :return: key=cluster_ids, value=list of GDS ids
+    """
+    rng = np.random.default_rng(seed)
+    labels = rng.integers(0, clusters, len(gds_ids))
+    return {'cluster{}'.format(i): [gds for gds, label in zip(gds_ids, labels) if label == i]
+            for i in range(clusters)}
+
+
+def synthetic_keywords(keywords: int, seed=0) -> Dict:
+    """
+    DO/HPO-like keyword table of one to three word phrases
+    :param keywords:
+    :param seed:
+    :return: k=keyword, v=main term
+    """
+    rng = np.random.default_rng(seed)
+    lengths = rng.integers(1, 4, keywords)
+    return {' '.join('term{}w{}'.format(i, j) for j in range(n)): 'disease {}'.format(i // 3)
+            for i, n in enumerate(lengths)}
+
+
+def synthetic_abstracts(abstracts: int, keywords: List, words=200, mentions=8, seed=0):
+    """
+    Stream of (pmid, abstract text) pairs mixing filler words and keyword mentions
+    :param abstracts:
+    :param keywords:
+    :param words: filler words per abstract
+    :param mentions: keyword mentions per abstract
+    :param seed:
+    :return: generator
+    """
+    rng = np.random.default_rng(seed)
+    for pmid in range(abstracts):
+        text = list(rng.choice(FILLER_WORDS, words))
+        for pos, kw in zip(rng.integers(0, words, mentions), rng.choice(keywords, mentions)):
+            text[pos] = kw
+        yield str(pmid), ' '.join(text) + '.'
+
+
+def synthetic_term_clusters(clusters: int, terms=400, seed=0) -> Dict:
+    """
+    Per cluster term frequencies as fed to the wordcloud plotter
+    :param clusters:
+    :param terms: distinct terms per cluster
+    :param seed:
+    :return: key=cluster_ids, value=Counter of terms
+    """
+    rng = np.random.default_rng(seed)
+    return {'cluster{}'.format(i): Counter({'disease {}'.format(t): int(c) for t, c in
+                                            enumerate(rng.zipf(1.5, terms))})
+            for i in range(clusters)}
+
+
+def measure(fn: Callable, repeat=1, memory=True) -> Dict:
+    """
+    Time a function, best of repeat runs, then record its peak Python heap
+    in a separate traced run since tracing slows pure Python code down
+    :param fn: called without arguments, returns the number of items processed
+    :param repeat:
+    :param memory: record peak memory
+    :return: seconds, cpu_seconds (including child processes), items,
+        throughput (items/s) and peak_mb
+    """
+    best = None
+    for _ in range(repeat):
+        cpu_start = cpu_time()
+        start = time.perf_counter()
+        items = fn()
+        seconds = time.perf_counter() - start
+        cpu_seconds = cpu_time() - cpu_start
+        if best is None or seconds < best['seconds']:
+            best = {'seconds': seconds, 'cpu_seconds': cpu_seconds, 'items': items}
+    best['throughput'] = best['items'] / best['seconds'] if best['seconds'] > 0 else None
+
+    best['peak_mb'] = None
+    if memory:
+        tracemalloc.start()
+        try:
+            fn()
+            best['peak_mb'] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        finally:
+            tracemalloc.stop()
+    return best
+
+
+@contextlib.contextmanager
+def _quiet():
+    # stage progress bars and messages would swamp the results table
+    with open(os.devnull, 'w') as devnull, \
+            contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(devnull):
+        yield
+
+
+# class for timing PhenoX stages on synthetic data
+class StageBenchmark:
+    def __init__(self, datasets=100, genes_per_dataset=50, genes=5000, abstracts=1000, keywords=2000,
+                 clusters=6, nboot=100, jobs=None, seed=0, outprefix='benchmark'):
+        """
+        Synthetic inputs are generated once and shared by the stages
+        :param datasets: number of GDS
+        :param genes_per_dataset: mean differential genes per GDS
+        :param genes: gene vocabulary size
+        :param abstracts: abstracts annotated by the NER stage
+        :param keywords: size of the NER keyword table
+        :param clusters: clusters for batch effect statistics and wordclouds
+        :param nboot: bootstrap replicates per scale for clustering
+        :param jobs: worker processes for clustering, NER and wordclouds
+        :param seed:
+        :param outprefix: prefix of the batch effect statistics file, written
+            to a temporary directory removed by close()
+        """
+        self.scale = dict(datasets=datasets, genes_per_dataset=genes_per_dataset, genes=genes,
+                          abstracts=abstracts, keywords=keywords, clusters=clusters, nboot=nboot,
+                          jobs=jobs, seed=seed)
+        self.outprefix = outprefix
+        self.geo = GEOQuery(outprefix, 'benchmark', 'benchmark@example.com')
+        self.docsums = synthetic_docsums(datasets, genes_per_dataset, genes, seed=seed)
+        self.docsum_responses = [docsum_xml(batch) for batch in self.docsums]
+        with _quiet():
+            self.gds_dict = self.geo.gdsdict_from_profile(self.docsums)
+            self.gds_py = self.geo.gds_to_pd_dataframe(self.gds_dict)
+        gds_ids = list(self.gds_dict)
+        self.meta_dict = synthetic_meta(gds_ids, seed=seed)
+        self.clusters = synthetic_clusters(gds_ids, clusters, seed=seed)
+        self.keywords = synthetic_keywords(keywords, seed=seed)
+        self.term_clusters = synthetic_term_clusters(clusters, seed=seed)
+        self.output_dir = tempfile.TemporaryDirectory()
+        # annotation only needs the matcher, not the DO/HPO lexicon
+        self.pubmed = Pubmed('benchmark@example.com', outprefix, ner_processes=jobs or 1,
+                             lexicon=(dict(), dict()), matcher=KeywordMatcher(self.keywords))
+
+    def gdsdict(self) -> int:
+        self.geo.gdsdict_from_profile(self.docsums)
+        return sum(len(batch['DocumentSummarySet']['DocumentSummary']) for batch in self.docsums)
+
+    def docsum_stream(self) -> int:
+        gds_dict = dict()
+        n_docsums = 0
+        for response in self.docsum_responses:
+            counts, n = docsum_gene_counts(io.BytesIO(response))
+            merge_gds_dict(gds_dict, counts)
+            n_docsums += n
+        return n_docsums
+
+    def dataframe(self) -> int:
+        self.geo.gds_to_pd_dataframe(self.gds_dict)
+        return len(self.gds_dict)
+
+    def cluster(self) -> int:
+        # the first CLUSTER_MAX_DATASETS datasets at larger scales
+        gds_py = self.gds_py.iloc[:CLUSTER_MAX_DATASETS]
+        fit = MultiscaleBootstrap(nboot=self.scale['nboot'], n_jobs=self.scale['jobs'], seed=self.scale['seed'])
+        fit.fit(as_csr(gds_py), gds_py.index).pick(alpha=.95)
+        return len(gds_py)
+
+    def batch(self) -> int:
+        effect = BatchEffect(self.clusters, self.meta_dict, self.outprefix)
+        effect.paths.output_dir = self.output_dir.name
+        effect.cluster_stats()
+        return len(self.meta_dict)
+
+    def ner(self) -> int:
+        self.pubmed.reset()
+        pmid_texts = synthetic_abstracts(self.scale['abstracts'], list(self.keywords), seed=self.scale['seed'])
+        return len(self.pubmed.find_DNER_batch(pmid_texts))
+
+    def wordcloud(self) -> int:
+        plotter = WordcloudPlotter(self.outprefix, processes=self.scale['jobs'], cache_mode='off')
+        return len(plotter._render_all(self.term_clusters))
+
+    def close(self) -> None:
+        self.geo.close()
+        self.output_dir.cleanup()
+
+    def run(self, stages=BENCH_STAGES, repeat=1, memory=True) -> Dict:
+        """
+        Benchmark stages, quietly
+        :param stages: names from BENCH_STAGES
+        :param repeat: timed runs per stage, the fastest is kept
+        :param memory: also record peak memory
+        :return: machine readable results
+        """
+        results = dict()
+        for stage in stages:
+            if stage not in BENCH_STAGES:
+                raise ValueError('Unknown stage {}, expected one of {}'.format(stage, ', '.join(BENCH_STAGES)))
+            with _quiet():
+                results[stage] = measure(getattr(self, stage), repeat=repeat, memory=memory)
+        return {
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'machine': {'python': platform.python_version(), 'platform': platform.platform(),
+                        'cpus': os.cpu_count()},
+            'scale': self.scale,
+            'stages': results,
+        }
+
+
+def compare(results: Dict, baseline: Dict, tolerance=0.2) -> List[Tuple]:
+    """
+    Compare benchmark results to a baseline
+    :param results:
+    :param baseline:
+    :param tolerance: allowed relative increase of time and peak memory
+    :return: (stage, metric, baseline, current, ratio, regressed) for each
+        metric measured in both
+    """
+    rows = []
+    for stage, current in results['stages'].items():
+        before = baseline['stages'].get(stage)
+        if before is None:
+            continue
+        for metric in ('seconds', 'cpu_seconds', 'peak_mb'):
+            if not current.get(metric) or not before.get(metric):
+                continue
+            ratio = current[metric] / before[metric]
+            rows.append((stage, metric, before[metric], current[metric], ratio, ratio > 1 + tolerance))
+    return rows
+
+
+def save_results(results: Dict, outfile: str) -> None:
+    with open(outfile, 'w') as f:
+        json.dump(results, f, indent=2)
+
+
+def load_results(infile: str) -> Dict:
+    with open(infile, 'r') as f:
+        return json.load(f)
+
+
+def print_results(results: Dict, file=sys.stdout) -> None:
+    print('{:<10} {:>10} {:>10} {:>12} {:>14} {:>10}'.format(
+        'stage', 'seconds', 'cpu s', 'items', 'items/s', 'peak MB'), file=file)
+    for stage, r in results['stages'].items():
+        print('{:<10} {:>10.3f} {:>10.3f} {:>12} {:>14.1f} {:>10}'.format(
+            stage, r['seconds'], r['cpu_seconds'], r['items'], r['throughput'] or 0,
+            '-' if r['peak_mb'] is None else '{:.1f}'.format(r['peak_mb'])), file=file)
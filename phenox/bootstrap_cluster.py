@@ -0,0 +1,279 @@
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from typing import List
+from scipy import sparse
+from scipy.stats import norm
+from scipy.spatial.distance import squareform
+from scipy.cluster.hierarchy import linkage, dendrogram
+
+import matplotlib.pyplot as plt
+plt.switch_backend('agg')
+
+
+# relative sample sizes used by pvclust by default
+DEFAULT_SCALES = np.round(np.arange(0.5, 1.45, 0.1), 1)
+
+# data shared with bootstrap worker processes
+_worker_data = None
+
+
+def _init_worker(mat: sparse.csr_matrix, leaf_keys: np.ndarray, edge_keys: np.ndarray) -> None:
+    global _worker_data
+    _worker_data = (mat, leaf_keys, edge_keys)
+
+
+def weighted_distances(mat: sparse.csr_matrix, weights: np.ndarray) -> np.ndarray:
+    """
+    Euclidean distances between rows of a binary matrix whose columns are
+    repeated weights[k] times, as in a bootstrap resample of the columns
+    :param mat: binary GDS x gene matrix
+    :param weights: column multiplicities
+    :return: condensed distance vector
+    """
+    weighted = mat.multiply(weights.reshape(1, -1)).tocsr()
+    gram = np.asarray((weighted @ mat.T).todense(), dtype=np.float64)
+    sq_norms = np.diag(gram).copy()
+    sq_dist = sq_norms[:, None] + sq_norms[None, :] - 2 * gram
+    np.maximum(sq_dist, 0, out=sq_dist)
+    np.fill_diagonal(sq_dist, 0)
+    return squareform(np.sqrt(sq_dist), checks=False)
+
+
+def cluster_keys(Z: np.ndarray, leaf_keys: np.ndarray) -> np.ndarray:
+    """
+    Order independent key of each merged cluster: the wrapping sum of
+    random 64-bit keys of its leaves
+    :param Z: scipy linkage matrix
+    :param leaf_keys: one random uint64 per leaf
+    :return: key per linkage row
+    """
+    n = len(leaf_keys)
+    keys = np.empty(2 * n - 1, dtype=np.uint64)
+    keys[:n] = leaf_keys
+    merge = Z[:, :2].astype(np.int64)
+    with np.errstate(over='ignore'):
+        for i in range(n - 1):
+            keys[n + i] = keys[merge[i, 0]] + keys[merge[i, 1]]
+    return keys[n:]
+
+
+def _bootstrap_chunk(args) -> np.ndarray:
+    """
+    Count how often each original cluster reappears in bootstrap replicates
+    :param args: (sample size, number of replicates, seed sequence)
+    :return: count per original edge
+    """
+    sample_size, n_reps, seed = args
+    mat, leaf_keys, edge_keys = _worker_data
+    rng = np.random.default_rng(seed)
+    n_genes = mat.shape[1]
+    counts = np.zeros(len(edge_keys), dtype=np.int64)
+    for _ in range(n_reps):
+        weights = np.bincount(rng.integers(0, n_genes, sample_size), minlength=n_genes)
+        Z = linkage(weighted_distances(mat, weights), method='ward')
+        counts += np.isin(edge_keys, cluster_keys(Z, leaf_keys))
+    return counts
+
+
+def msfit(bp: np.ndarray, scales: np.ndarray, nboot: int) -> tuple:
+    """
+    Multiscale bootstrap curve fit per edge, z(r) = v sqrt(r) + c / sqrt(r)
+    by weighted least squares as in pvclust
+    :param bp: bootstrap probabilities, edges x scales
+    :param scales: relative sample sizes
+    :param nboot: replicates per scale
+    :return: au, bp at scale 1
+    """
+    n_edges = bp.shape[0]
+    au = np.empty(n_edges)
+    bp1 = np.empty(n_edges)
+    design = np.stack([np.sqrt(scales), 1 / np.sqrt(scales)], axis=1)
+    for e in range(n_edges):
+        use = (bp[e] > 0) & (bp[e] < 1)
+        if use.sum() < 2:
+            # degenerate curve, every scale (nearly) always or never recovers the edge
+            au[e] = bp1[e] = float(bp[e].mean() >= 0.5)
+            continue
+        z = -norm.ppf(bp[e, use])
+        var = bp[e, use] * (1 - bp[e, use]) / (nboot * norm.pdf(z) ** 2)
+        w = 1 / var
+        X = design[use]
+        v, c = np.linalg.solve(X.T @ (X * w[:, None]), X.T @ (w * z))
+        au[e] = norm.cdf(-(v - c))
+        bp1[e] = norm.cdf(-(v + c))
+    return au, bp1
+
+
+# class for pvclust-style hierarchical clustering with AU p-values
+class MultiscaleBootstrap:
+    def __init__(self, nboot=1000, scales=DEFAULT_SCALES, n_jobs=None, seed=None, chunk_size=50):
+        """
+        Ward (ward.D2) clustering of rows on euclidean distance, with
+        approximately unbiased p-values from multiscale bootstrap
+        resampling of columns
+        :param nboot: replicates per scale
+        :param scales: relative bootstrap sample sizes
+        :param n_jobs: worker processes, defaults to cpu count
+        :param seed:
+        :param chunk_size: replicates per worker task
+        """
+        self.nboot = nboot
+        self.scales = np.asarray(scales, dtype=np.float64)
+        self.n_jobs = n_jobs or os.cpu_count()
+        self.seed = seed
+        self.chunk_size = chunk_size
+
+    def fit(self, mat: sparse.csr_matrix, labels: List):
+        """
+        Cluster rows of the matrix and bootstrap every merge
+        :param mat: binary GDS x gene matrix
+        :param labels: row labels (GDS ids)
+        :return: self, with linkage Z and per edge au/bp arrays
+        """
+        mat = sparse.csr_matrix(mat, dtype=np.float64)
+        self.labels = list(labels)
+        n_genes = mat.shape[1]
+
+        self.Z = linkage(weighted_distances(mat, np.ones(n_genes)), method='ward')
+        seeds = np.random.SeedSequence(self.seed)
+        leaf_keys = np.random.default_rng(seeds.spawn(1)[0]).integers(
+            0, np.iinfo(np.uint64).max, len(self.labels), dtype=np.uint64, endpoint=True
+        )
+        edge_keys = cluster_keys(self.Z, leaf_keys)
+
+        tasks = []
+        for j, r in enumerate(self.scales):
+            sample_size = int(round(r * n_genes))
+            for start in range(0, self.nboot, self.chunk_size):
+                tasks.append((j, (sample_size, min(self.chunk_size, self.nboot - start), seeds.spawn(1)[0])))
+
+        counts = np.zeros((len(edge_keys), len(self.scales)), dtype=np.int64)
+        with ProcessPoolExecutor(self.n_jobs, initializer=_init_worker,
+                                 initargs=(mat, leaf_keys, edge_keys)) as executor:
+            for (j, _), chunk_counts in zip(tasks, executor.map(_bootstrap_chunk, [t for _, t in tasks])):
+                counts[:, j] += chunk_counts
+
+        self.bp_scales = counts / self.nboot
+        self.au, self.bp = msfit(self.bp_scales, self.scales, self.nboot)
+        return self
+
+    def members(self, edge: int) -> List:
+        """
+        Leaf labels under a linkage row, in dendrogram order
+        :param edge:
+        :return:
+        """
+        n = len(self.labels)
+        stack = [n + edge]
+        leaves = []
+        while stack:
+            node = stack.pop()
+            if node < n:
+                leaves.append(self.labels[node])
+            else:
+                stack.extend([int(self.Z[node - n, 1]), int(self.Z[node - n, 0])])
+        return leaves
+
+    def picked_edges(self, alpha=0.95) -> List:
+        """
+        Largest clusters with au >= alpha, skipping the root (as pvpick)
+        :param alpha:
+        :return: linkage rows of picked clusters
+        """
+        picked = []
+        picked_sets = []
+        for edge in range(len(self.Z) - 2, -1, -1):
+            if self.au[edge] >= alpha:
+                m = set(self.members(edge))
+                if not any(m <= p for p in picked_sets):
+                    picked.append(edge)
+                    picked_sets.append(m)
+        return picked
+
+    def pick(self, alpha=0.95) -> List:
+        """
+        Members of the picked clusters
+        :param alpha:
+        :return: list of member lists
+        """
+        return [self.members(edge) for edge in self.picked_edges(alpha)]
+
+    def newick(self) -> str:
+        """
+        Newick tree with ape::as.phylo branch lengths (half merge heights)
+        :return:
+        """
+        n = len(self.labels)
+        heights = np.concatenate([np.zeros(n), self.Z[:, 2]])
+
+        def _node(i, parent_height):
+            length = (parent_height - heights[i]) / 2
+            if i < n:
+                return '{}:{:g}'.format(self.labels[i], length)
+            a, b = int(self.Z[i - n, 0]), int(self.Z[i - n, 1])
+            return '({},{}):{:g}'.format(_node(a, heights[i]), _node(b, heights[i]), length)
+
+        root = 2 * n - 2
+        a, b = int(self.Z[-1, 0]), int(self.Z[-1, 1])
+        return '({},{});'.format(_node(a, heights[root]), _node(b, heights[root]))
+
+    def plot(self, hcluster_file: str, alpha=0.95) -> None:
+        """
+        Dendrogram with AU (red) and BP (green) percentages and boxes
+        around picked clusters, as pvclust plot and pvrect
+        :param hcluster_file:
+        :param alpha:
+        :return:
+        """
+        n = len(self.labels)
+        fig, ax = plt.subplots(figsize=(8.27, 5.85))
+        dn = dendrogram(self.Z, labels=self.labels, ax=ax, color_threshold=0,
+                        above_threshold_color='black', leaf_font_size=6)
+
+        # scipy places leaves at 5, 15, 25, ... and merges at child midpoints
+        xpos = np.zeros(2 * n - 1)
+        xpos[dn['leaves']] = 5 + 10 * np.arange(n)
+        for i, (a, b) in enumerate(self.Z[:, :2].astype(int)):
+            xpos[n + i] = 0.5 * (xpos[a] + xpos[b])
+
+        for edge in range(n - 1):
+            x, y = xpos[n + edge], self.Z[edge, 2]
+            ax.annotate('{:d}'.format(int(round(100 * self.au[edge]))), (x, y),
+                        color='red', fontsize=5, ha='right', va='bottom')
+            ax.annotate('{:d}'.format(int(round(100 * self.bp[edge]))), (x, y),
+                        color='green', fontsize=5, ha='left', va='bottom')
+
+        leaf_x = dict(zip(dn['ivl'], 5 + 10 * np.arange(n)))
+        for edge in self.picked_edges(alpha):
+            xs = [leaf_x[m] for m in self.members(edge)]
+            ax.add_patch(plt.Rectangle((min(xs) - 4, 0), max(xs) - min(xs) + 8, self.Z[edge, 2] * 1.02,
+                                       fill=False, edgecolor='red'))
+
+        ax.set_title('Cluster dendrogram with AU/BP values (%)')
+        ax.set_ylabel('Height')
+        fig.savefig(hcluster_file, bbox_inches='tight')
+        plt.close(fig)
+
+    def plot_heatmap(self, mat: sparse.csr_matrix, heatmap_file: str) -> None:
+        """
+        Gene x GDS heatmap with GDS ordered as in the dendrogram
+        :param mat: binary GDS x gene matrix
+        :param heatmap_file:
+        :return:
+        """
+        n = len(self.labels)
+        fig, (ax_tree, ax_map) = plt.subplots(2, 1, figsize=(8.27, 11.69),
+                                              gridspec_kw={'height_ratios': [1, 4]})
+        dn = dendrogram(self.Z, ax=ax_tree, no_labels=True, color_threshold=0,
+                        above_threshold_color='black')
+        ax_tree.axis('off')
+
+        ordered = sparse.csr_matrix(mat)[dn['leaves']].T.toarray()
+        ax_map.imshow(ordered, aspect='auto', interpolation='nearest', cmap=plt.cm.bwr,
+                      extent=(0, 10 * n, ordered.shape[0], 0))
+        ax_map.set_xticks(5 + 10 * np.arange(n))
+        ax_map.set_xticklabels([self.labels[i] for i in dn['leaves']], rotation=90, fontsize=5)
+        ax_map.set_yticks([])
+        fig.savefig(heatmap_file, bbox_inches='tight')
+        plt.close(fig)
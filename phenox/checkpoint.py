@@ -0,0 +1,110 @@
+import os
+import json
+import time
+import pickle
+import contextlib
+import hashlib
+import logging
+from typing import Callable, Dict
+
+
+# pipeline stages of PhenoX.subtype, in run order
+STAGES = ('mesh', 'geo', 'cluster', 'batch', 'pubmed', 'ner', 'visualize')
+
+
+def params_key(*parts) -> str:
+    """
+    Stable hash of json-serializable inputs and parameters
+    :param parts:
+    :return:
+    """
+    payload = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+# class for persisting pipeline stage outputs in a run directory
+class RunCheckpoints:
+    def __init__(self, run_dir: str, resume=False, from_stage=None, metrics=None):
+        """
+        Stage outputs are pickled to <run_dir>/<stage>.pkl and listed in
+        manifest.json with their stage key. A stage key chains the stage's
+        parameters onto the key of the stage before it, so changing a
+        parameter invalidates that stage and everything downstream.
+        :param run_dir:
+        :param resume: reuse valid checkpoints instead of recomputing
+        :param from_stage: recompute this stage and all later ones, reusing
+            valid checkpoints before it (implies resume)
+        :param metrics: metrics.RunMetrics timing each stage, or None
+        """
+        if from_stage is not None and from_stage not in STAGES:
+            raise ValueError('Unknown stage {}, expected one of {}'.format(from_stage, ', '.join(STAGES)))
+        self.run_dir = run_dir
+        self.resume = resume or from_stage is not None
+        self.from_stage = from_stage
+        self.metrics = metrics
+        self.manifest_file = os.path.join(run_dir, 'manifest.json')
+        self._prev_key = ''
+
+        os.makedirs(run_dir, exist_ok=True)
+        self.manifest = dict()
+        if os.path.exists(self.manifest_file):
+            with open(self.manifest_file, 'r') as f:
+                self.manifest = json.load(f)
+
+    def _reusable(self, stage: str) -> bool:
+        if not self.resume:
+            return False
+        if self.from_stage is None:
+            return True
+        return STAGES.index(stage) < STAGES.index(self.from_stage)
+
+    def _checkpoint_file(self, stage: str) -> str:
+        return os.path.join(self.run_dir, '{}.pkl'.format(stage))
+
+    def is_valid(self, stage: str, key: str) -> bool:
+        entry = self.manifest.get(stage)
+        return entry is not None and entry['key'] == key and os.path.exists(self._checkpoint_file(stage))
+
+    def load(self, stage: str):
+        with open(self._checkpoint_file(stage), 'rb') as f:
+            return pickle.load(f)
+
+    def save(self, stage: str, key: str, value) -> None:
+        """
+        Write checkpoint atomically, then record it in the manifest
+        :param stage:
+        :param key:
+        :param value:
+        :return:
+        """
+        outfile = self._checkpoint_file(stage)
+        with open(outfile + '.tmp', 'wb') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(outfile + '.tmp', outfile)
+
+        self.manifest[stage] = {'key': key, 'saved': time.time()}
+        with open(self.manifest_file + '.tmp', 'w') as f:
+            json.dump(self.manifest, f, indent=2)
+        os.replace(self.manifest_file + '.tmp', self.manifest_file)
+
+    def run(self, stage: str, params: Dict, compute: Callable):
+        """
+        Load a stage output from its checkpoint, or compute and checkpoint it
+        :param stage: one of STAGES
+        :param params: parameters the stage output depends on
+        :param compute: function producing the stage output
+        :return: stage output
+        """
+        key = params_key(self._prev_key, stage, params)
+        self._prev_key = key
+        timer = self.metrics.stage(stage) if self.metrics is not None else contextlib.nullcontext(dict())
+        with timer as info:
+            if self._reusable(stage) and self.is_valid(stage, key):
+                logging.info('Stage {}: reusing checkpoint in {}'.format(stage, self.run_dir))
+                print('Skipping stage {}, checkpoint is valid'.format(stage))
+                info['checkpoint'] = 'reused'
+                return self.load(stage)
+            info['checkpoint'] = 'computed'
+            value = compute()
+            self.save(stage, key, value)
+            return value
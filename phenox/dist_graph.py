@@ -0,0 +1,126 @@
+import numpy as np
+from scipy import sparse
+from scipy.sparse.linalg import eigsh
+from sklearn.neighbors import NearestNeighbors
+
+
+def squared_distances(mat: sparse.csr_matrix, rows=None) -> np.ndarray:
+    """
+    Squared euclidean distances from selected rows to all rows
+    :param mat: GDS x gene matrix
+    :param rows: row indices, defaults to all rows
+    :return: len(rows) x n matrix
+    """
+    mat = sparse.csr_matrix(mat, dtype=np.float64)
+    sub = mat if rows is None else mat[rows]
+    sq_norms = np.asarray(mat.multiply(mat).sum(axis=1)).ravel()
+    sub_norms = sq_norms if rows is None else sq_norms[rows]
+    gram = np.asarray((sub @ mat.T).todense())
+    return np.maximum(sub_norms[:, None] + sq_norms[None, :] - 2 * gram, 0)
+
+
+def _top_eigen(B: np.ndarray, k: int):
+    """
+    Largest k eigenpairs of a symmetric matrix, truncated solver for large B
+    """
+    if B.shape[0] > 10 * k + 2:
+        vals, vecs = eigsh(B, k=k, which='LA')
+    else:
+        vals, vecs = np.linalg.eigh(B)
+    order = np.argsort(vals)[::-1][:k]
+    return np.maximum(vals[order], 0), vecs[:, order]
+
+
+def classical_mds(sq_dist: np.ndarray, k=2) -> tuple:
+    """
+    Torgerson classical MDS from squared distances
+    :param sq_dist: n x n squared distances
+    :param k: output dimensions
+    :return: n x k coordinates, eigenvalues, eigenvectors
+    """
+    n = sq_dist.shape[0]
+    row_mean = sq_dist.mean(axis=1)
+    B = -0.5 * (sq_dist - row_mean[:, None] - row_mean[None, :] + row_mean.mean())
+    vals, vecs = _top_eigen(B, min(k, n - 1) if n > 1 else 1)
+    return vecs * np.sqrt(vals), vals, vecs
+
+
+def landmark_mds(mat: sparse.csr_matrix, n_landmarks=500, k=2, seed=0) -> np.ndarray:
+    """
+    Landmark MDS: classical MDS on random landmarks, other points placed
+    by distance-based triangulation against them
+    :param mat: GDS x gene matrix
+    :param n_landmarks:
+    :param k: output dimensions
+    :param seed:
+    :return: n x k coordinates
+    """
+    n = mat.shape[0]
+    landmarks = np.sort(np.random.default_rng(seed).choice(n, min(n_landmarks, n), replace=False))
+    sq_to_landmarks = squared_distances(mat, landmarks)
+    _, vals, vecs = classical_mds(sq_to_landmarks[:, landmarks], k)
+
+    keep = vals > 1e-12
+    pinv = vecs[:, keep] / np.sqrt(vals[keep])
+    mean_sq = sq_to_landmarks[:, landmarks].mean(axis=1)
+    coords = np.zeros((n, k))
+    coords[:, :keep.sum()] = -0.5 * (sq_to_landmarks - mean_sq[:, None]).T @ pinv
+    return coords
+
+
+def embed(mat: sparse.csr_matrix, landmark_threshold=2000, n_landmarks=500) -> np.ndarray:
+    """
+    2D embedding of GDS, exact classical MDS up to landmark_threshold points
+    :param mat:
+    :param landmark_threshold:
+    :param n_landmarks:
+    :return: n x 2 coordinates
+    """
+    n = mat.shape[0]
+    if n < 3:
+        return np.column_stack([np.arange(n, dtype=np.float64), np.zeros(n)])
+    if n <= landmark_threshold:
+        coords = classical_mds(squared_distances(mat))[0]
+    else:
+        coords = landmark_mds(mat, n_landmarks)
+    if coords.shape[1] < 2:
+        coords = np.column_stack([coords, np.zeros(n)])
+    return coords
+
+
+def knn_edges(mat: sparse.csr_matrix, n_neighbors=5) -> tuple:
+    """
+    Undirected k-nearest-neighbour edges in the original gene space
+    :param mat:
+    :param n_neighbors:
+    :return: (m, 2) node pairs, edge distances
+    """
+    n = mat.shape[0]
+    k = min(n_neighbors + 1, n)
+    dist, ind = NearestNeighbors(n_neighbors=k).fit(mat).kneighbors(mat)
+    src = np.repeat(np.arange(n), k)
+    pairs = np.stack([src, ind.ravel()], axis=1)
+    dist = dist.ravel()
+    not_self = pairs[:, 0] != pairs[:, 1]
+    pairs = np.sort(pairs[not_self], axis=1)
+    pairs, first = np.unique(pairs, axis=0, return_index=True)
+    return pairs, dist[not_self][first]
+
+
+def spread_labels(coords: np.ndarray, max_labels=40) -> np.ndarray:
+    """
+    Farthest point sample of points to label, so labels spread over the plot
+    :param coords:
+    :param max_labels:
+    :return: indices of points to label
+    """
+    n = coords.shape[0]
+    if n <= max_labels:
+        return np.arange(n)
+    chosen = [int(np.argmax(np.linalg.norm(coords - coords.mean(axis=0), axis=1)))]
+    min_dist = np.linalg.norm(coords - coords[chosen[0]], axis=1)
+    for _ in range(max_labels - 1):
+        nxt = int(np.argmax(min_dist))
+        chosen.append(nxt)
+        np.minimum(min_dist, np.linalg.norm(coords - coords[nxt], axis=1), out=min_dist)
+    return np.array(chosen)
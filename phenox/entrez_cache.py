@@ -0,0 +1,220 @@
+import io
+import json
+import time
+import zlib
+import sqlite3
+import hashlib
+import logging
+import threading
+import xml.parsers.expat
+from typing import Dict
+import Bio.Entrez as Entrez
+
+
+# parameters that identify the caller, not the request
+IGNORED_PARAMS = ('email', 'tool', 'api_key')
+
+# seconds before a cached response is considered stale; history server
+# results (esearch/epost with usehistory) expire on the NCBI side as well
+DEFAULT_TTLS = {
+    'esearch': 60 * 60,
+    'epost': 60 * 60,
+    'efetch': 30 * 24 * 60 * 60,
+    'esummary': 7 * 24 * 60 * 60,
+    'elink': 7 * 24 * 60 * 60,
+    'einfo': 24 * 60 * 60,
+}
+
+CACHE_MODES = ('readwrite', 'readonly', 'offline')
+
+
+class CacheMissError(LookupError):
+    """
+    Raised in offline mode when a request is not in the cache
+    """
+    pass
+
+
+def request_key(query_type: str, params: Dict) -> str:
+    """
+    Content address of an Entrez request from its normalized parameters
+    :param query_type: Entrez function name, e.g. efetch
+    :param params: keyword arguments passed to the Entrez function
+    :return:
+    """
+    normalized = {k: v for k, v in params.items() if k not in IGNORED_PARAMS and v is not None}
+    blob = json.dumps([query_type, normalized], sort_keys=True, default=str)
+    return hashlib.sha256(blob.encode('utf-8')).hexdigest()
+
+
+def cacheable(params: Dict, data: bytes) -> bool:
+    """
+    Whether a response may be cached: not empty, without an NCBI <ERROR>
+    element and well-formed XML or JSON unless text was requested
+    :param params: keyword arguments passed to the Entrez function
+    :param data: response body
+    :return:
+    """
+    if not data.strip() or b'<ERROR>' in data:
+        return False
+    retmode = params.get('retmode')
+    try:
+        if retmode == 'json':
+            json.loads(data)
+        elif retmode != 'text':
+            xml.parsers.expat.ParserCreate().Parse(data, True)
+    except (ValueError, xml.parsers.expat.ExpatError):
+        return False
+    return True
+
+
+# class for caching raw Entrez responses on disk
+class EntrezCache:
+    def __init__(self, cache_file: str, max_bytes=2 * 1024 ** 3, ttls=None, mode='readwrite'):
+        """
+        SQLite-backed cache of compressed Entrez responses
+        :param cache_file: path to sqlite database
+        :param max_bytes: compressed size bound, least recently used entries are evicted
+        :param ttls: dict of per endpoint time to live in seconds, overrides DEFAULT_TTLS
+        :param mode: readwrite, readonly (never store) or offline (never hit the network)
+        """
+        assert mode in CACHE_MODES
+        self.cache_file = cache_file
+        self.max_bytes = max_bytes
+        self.ttls = dict(DEFAULT_TTLS, **(ttls or {}))
+        self.mode = mode
+        self._lock = threading.Lock()
+
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS responses ('
+                'key TEXT PRIMARY KEY, endpoint TEXT, created REAL, '
+                'accessed REAL, size INTEGER, payload BLOB)'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)')
+
+    def _connect(self):
+        return sqlite3.connect(self.cache_file, timeout=30)
+
+    def get(self, query_type: str, params: Dict):
+        """
+        Return cached response bytes, or None if missing or expired
+        :param query_type:
+        :param params:
+        :return:
+        """
+        key = request_key(query_type, params)
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            row = conn.execute(
+                'SELECT created, payload FROM responses WHERE key = ?', (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            created, payload = row
+            ttl = self.ttls.get(query_type)
+            if ttl is not None and now - created > ttl and self.mode != 'offline':
+                return None
+            if self.mode != 'readonly':
+                conn.execute('UPDATE responses SET accessed = ? WHERE key = ?', (now, key))
+        return zlib.decompress(payload)
+
+    def put(self, query_type: str, params: Dict, data: bytes) -> None:
+        """
+        Store response bytes and evict least recently used entries over
+        max_bytes; error responses and truncated bodies are not stored
+        :param query_type:
+        :param params:
+        :param data:
+        :return:
+        """
+        if self.mode != 'readwrite':
+            return
+        if not cacheable(params, data):
+            logging.debug('Not caching invalid {} response for {}'.format(query_type, params))
+            return
+        key = request_key(query_type, params)
+        payload = zlib.compress(data)
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)',
+                (key, query_type, now, now, len(payload), sqlite3.Binary(payload))
+            )
+            self._evict(conn)
+
+    def discard(self, query_type: str, params: Dict) -> None:
+        """
+        Drop a cached response, e.g. one that turned out to be corrupt
+        :param query_type:
+        :param params:
+        :return:
+        """
+        if self.mode != 'readwrite':
+            return
+        with self._lock, self._connect() as conn:
+            conn.execute('DELETE FROM responses WHERE key = ?', (request_key(query_type, params),))
+
+    def _evict(self, conn) -> None:
+        """
+        Drop least recently used entries until the cache fits in max_bytes
+        :param conn:
+        :return:
+        """
+        total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        excess = total - self.max_bytes
+        freed = 0
+        stale = []
+        for key, size in conn.execute('SELECT key, size FROM responses ORDER BY accessed'):
+            stale.append((key,))
+            freed += size
+            if freed >= excess:
+                break
+        conn.executemany('DELETE FROM responses WHERE key = ?', stale)
+        logging.debug('Evicted {} cached responses ({} bytes)'.format(len(stale), freed))
+
+    def request(self, query_type: str, fetch, **kwargs):
+        """
+        Serve an Entrez request from cache, or call fetch and store the response
+        :param query_type:
+        :param fetch: callable returning a response handle
+        :param kwargs:
+        :return: binary handle with the response body
+        """
+        data = self.get(query_type, kwargs)
+        if data is not None:
+            logging.debug('Cache hit for {} {}'.format(query_type, kwargs))
+            return io.BytesIO(data)
+        if self.mode == 'offline':
+            raise CacheMissError('{} request not cached: {}'.format(query_type, kwargs))
+
+        handle = fetch(**kwargs)
+        data = handle.read()
+        handle.close()
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self.put(query_type, kwargs, data)
+        return io.BytesIO(data)
+
+
+def entrez_request(cache, query_type: str, transport=None, **kwargs):
+    """
+    Issue an Entrez E-utilities call, served from cache when one is given
+    :param cache: EntrezCache or None
+    :param query_type: Entrez function name, e.g. efetch
+    :param transport: phenox.transport.Transport sending uncached requests,
+        None for Bio.Entrez
+    :param kwargs:
+    :return:
+    """
+    if transport is None:
+        fetch = getattr(Entrez, query_type)
+    else:
+        def fetch(**params):
+            return io.BytesIO(transport.fetch(query_type, params))
+    if cache is None:
+        return fetch(**kwargs)
+    return cache.request(query_type, fetch, **kwargs)
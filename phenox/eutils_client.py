@@ -0,0 +1,245 @@
+import io
+import time
+import asyncio
+import logging
+import threading
+import http.client
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+from urllib.error import HTTPError
+from urllib.parse import urlencode, urlsplit
+import Bio.Entrez as Entrez
+
+from phenox.entrez_cache import CacheMissError
+
+
+EUTILS_URL = 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/'
+
+
+def _check_no_running_loop(coros: List) -> None:
+    """
+    Fail clearly, rather than inside asyncio.run, when synchronous helpers
+    are called from a running event loop
+    :param coros: coroutines to close unstarted on failure
+    :return:
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return
+    for coro in coros:
+        coro.close()
+    raise RuntimeError('PhenoX retrieval methods block and cannot be called from a running event loop '
+                       '(e.g. Jupyter or async code); call them from a worker thread, '
+                       'e.g. await loop.run_in_executor(None, geo.retrieve_geo_data, term)')
+
+
+def run_sync(coro):
+    """
+    Run a coroutine to completion from synchronous code
+    :param coro:
+    :return:
+    :raises RuntimeError: called from a running event loop
+    """
+    _check_no_running_loop([coro])
+    return asyncio.run(coro)
+
+
+def run_all(coros) -> List:
+    """
+    Run coroutines concurrently from synchronous code
+    :param coros:
+    :return: results in input order
+    :raises RuntimeError: called from a running event loop
+    """
+    coros = list(coros)
+    _check_no_running_loop(coros)
+
+    async def _all():
+        return await asyncio.gather(*coros)
+    return asyncio.run(_all())
+
+
+# class for NCBI request rate limiting shared by concurrent requests
+class TokenBucket:
+    def __init__(self, rate: float, capacity=1):
+        """
+        Token bucket allowing rate requests per second with bursts of capacity.
+        Tokens are reserved up front, so no lock is needed within one event loop
+        and waiting requests are released in arrival order.
+        :param rate: tokens per second
+        :param capacity: bucket size
+        """
+        self.rate = float(rate)
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def reserve(self) -> float:
+        """
+        Take one token, going into debt if none are left
+        :return: seconds to wait before the token may be used
+        """
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return max(0., -self.tokens / self.rate)
+
+    async def acquire(self) -> None:
+        delay = self.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+# class for concurrent NCBI E-utilities requests
+class AsyncEntrez:
+    def __init__(self, cache=None, rate=None, max_connections=6, base_url=None, timeout=120, transport=None):
+        """
+        asyncio E-utilities client returning the same binary response handles
+        as Bio.Entrez, so responses parse with Entrez.read. HTTP runs on a
+        shared pool of keep-alive connections, one worker thread per
+        connection, under a token bucket at NCBI's request rate.
+        :param cache: EntrezCache or None, checked before any request is sent
+        :param rate: requests per second, defaults to 10 with an API key else 3
+        :param max_connections: size of the connection pool
+        :param base_url: E-utilities endpoint, e.g. a local mirror or test server,
+            defaults to the transport's base_url or NCBI
+        :param timeout: socket timeout in seconds
+        :param transport: phenox.transport.Transport wrapping each uncached
+            request, e.g. to record or replay it
+        """
+        self.cache = cache
+        self.transport = transport
+        base_url = base_url or getattr(transport, 'base_url', None) or EUTILS_URL
+        self.rate = rate or (10 if Entrez.api_key else 3)
+        self.limiter = TokenBucket(self.rate)
+        self.max_connections = max_connections
+        self.base_url = base_url.rstrip('/') + '/'
+        self.timeout = timeout
+
+        url = urlsplit(self.base_url)
+        self._scheme = url.scheme
+        self._host = url.netloc
+        self._path = url.path
+        self._idle = deque()
+        self._pool_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_connections, thread_name_prefix='eutils')
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=True)
+        while self._idle:
+            self._idle.pop().close()
+
+    def _connection(self):
+        with self._pool_lock:
+            if self._idle:
+                return self._idle.pop()
+        if self._scheme == 'https':
+            return http.client.HTTPSConnection(self._host, timeout=self.timeout)
+        return http.client.HTTPConnection(self._host, timeout=self.timeout)
+
+    def _release(self, conn) -> None:
+        with self._pool_lock:
+            self._idle.append(conn)
+
+    @staticmethod
+    def encode_params(query_type: str, params: Dict) -> str:
+        """
+        URL encode request parameters as Bio.Entrez does, including the
+        caller identification; elink keeps one id parameter per id so that
+        each id gets its own link set
+        :param query_type:
+        :param params:
+        :return:
+        """
+        params = dict(params)
+        params.setdefault('tool', Entrez.tool)
+        params.setdefault('email', Entrez.email)
+        params.setdefault('api_key', Entrez.api_key)
+        params = {k: v for k, v in params.items() if v is not None}
+        ids = params.get('id')
+        if ids is not None and not isinstance(ids, str):
+            ids = [str(i) for i in ids]
+            params['id'] = ids if query_type == 'elink' else ','.join(ids)
+        return urlencode(params, doseq=True)
+
+    def _post(self, query_type: str, body: str) -> bytes:
+        """
+        Blocking POST on a pooled connection, run in a worker thread
+        :param query_type:
+        :param body: url encoded parameters
+        :return: response body
+        """
+        path = '{}{}.fcgi'.format(self._path, query_type)
+        headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+        conn = self._connection()
+        try:
+            conn.request('POST', path, body=body.encode('utf-8'), headers=headers)
+            response = conn.getresponse()
+            data = response.read()
+        except Exception:
+            conn.close()
+            raise
+        if response.will_close:
+            conn.close()
+        else:
+            self._release(conn)
+        if response.status >= 400:
+            raise HTTPError(self.base_url + query_type + '.fcgi', response.status, response.reason,
+                            response.headers, io.BytesIO(data))
+        return data
+
+    def _send(self, query_type: str, params: Dict) -> bytes:
+        return self._post(query_type, self.encode_params(query_type, params))
+
+    async def request(self, query_type: str, **kwargs) -> io.BytesIO:
+        """
+        E-utilities call, e.g. await client.request('efetch', db='gds', id=ids)
+        :param query_type: Entrez function name
+        :param kwargs: E-utilities parameters
+        :return: binary handle with the response body
+        """
+        if self.cache is not None:
+            data = self.cache.get(query_type, kwargs)
+            if data is not None:
+                logging.debug('Cache hit for {} {}'.format(query_type, kwargs))
+                return io.BytesIO(data)
+            if self.cache.mode == 'offline':
+                raise CacheMissError('{} request not cached: {}'.format(query_type, kwargs))
+
+        await self.limiter.acquire()
+        loop = asyncio.get_running_loop()
+        if self.transport is None:
+            data = await loop.run_in_executor(self._executor, self._send, query_type, kwargs)
+        else:
+            data = await loop.run_in_executor(self._executor, self.transport.fetch, query_type, kwargs, self._send)
+        if self.cache is not None:
+            self.cache.put(query_type, kwargs, data)
+        return io.BytesIO(data)
+
+    async def read(self, query_type: str, **kwargs):
+        """
+        E-utilities call parsed with Entrez.read; a response that fails to
+        parse is dropped from the cache so a retry fetches it again
+        :param query_type:
+        :param kwargs:
+        :return:
+        """
+        handle = await self.request(query_type, **kwargs)
+        try:
+            return Entrez.read(handle)
+        except ValueError:
+            if self.cache is not None:
+                self.cache.discard(query_type, kwargs)
+            raise
+
+    async def gather(self, query_type: str, param_list: List) -> List:
+        """
+        Submit many calls of one endpoint at once
+        :param query_type:
+        :param param_list: list of parameter dicts
+        :return: parsed responses in input order
+        """
+        return await asyncio.gather(*[self.read(query_type, **params) for params in param_list])
@@ -1,15 +1,16 @@
 import os
-import sys
+import asyncio
 import logging
 import time
 import tqdm
+import xml.etree.ElementTree as ET
 from typing import List, Dict, Tuple
 from collections import defaultdict
 import Bio.Entrez as Entrez
-from urllib.error import HTTPError
 
 import numpy as np
 import pandas as pd
+from scipy import sparse
 import pydendroheatmap as pdh
 from datetime import datetime
 
@@ -17,25 +18,122 @@ import matplotlib
 import matplotlib.pyplot as plt
 from matplotlib.collections import LineCollection
 
-from sklearn import manifold
-from sklearn.metrics import euclidean_distances
-from sklearn.decomposition import PCA
-
-from rpy2.robjects import pandas2ri, default_converter
-from rpy2.robjects.conversion import Converter, localconverter
-from rpy2.robjects.packages import importr
-from rpy2 import rinterface
-
 from phenox.paths import PhenoXPaths
+from phenox import dist_graph
+from phenox.entrez_cache import entrez_request
+from phenox.eutils_client import AsyncEntrez, run_all, run_sync
+from phenox.bootstrap_cluster import MultiscaleBootstrap
+from phenox.retry import NCBIErrorResponse, RetryPolicy
+
+
+def as_csr(gds_py) -> sparse.csr_matrix:
+    """
+    CSR matrix of a GDS x gene dataframe, sparse-backed or dense
+    :param gds_py:
+    :return:
+    """
+    try:
+        return gds_py.sparse.to_coo().tocsr()
+    except AttributeError:
+        return sparse.csr_matrix(gds_py.values)
+
+
+def docsum_gene_counts(handle) -> Tuple[Dict, int]:
+    """
+    Parse one GEO profile docsum response incrementally, keeping only the
+    GDS and geneName of each DocumentSummary and dropping records as soon
+    as they are counted
+    :param handle: binary file object of an efetch rettype=docsum response
+    :return: ({k=gds_id, v={k=geneName, v=gene freq}}, number of docsums)
+    :raises ET.ParseError: truncated or corrupt response
+    :raises NCBIErrorResponse: the response reports an error instead of docsums
+    """
+    counts = dict()
+    n_docsums = 0
+    gdsid = gnames = None
+    docsum_set = None
+    for event, elem in ET.iterparse(handle, events=('start', 'end')):
+        if event == 'start':
+            if elem.tag == 'DocumentSummarySet':
+                docsum_set = elem
+            continue
+        if elem.tag == 'GDS':
+            gdsid = elem.text or ''
+        elif elem.tag == 'geneName':
+            gnames = elem.text or ''
+        elif elem.tag == 'DocumentSummary':
+            n_docsums += 1
+            for gname in (gnames or '').split("<:>"):
+                if len(gname) > 0:
+                    if gdsid not in counts:
+                        counts[gdsid] = defaultdict(int)
+                    counts[gdsid][gname.upper()] += 1
+            gdsid = gnames = None
+            elem.clear()
+            if docsum_set is not None:
+                docsum_set.clear()
+        elif elem.tag == 'ERROR':
+            raise NCBIErrorResponse('E-utilities error in docsum response: {}'.format(elem.text))
+    return counts, n_docsums
+
+
+def merge_gds_dict(gds_dict: Dict, counts: Dict) -> Dict:
+    """
+    Add the gene counts of one docsum batch to gds_dict
+    :param gds_dict: k=gds_id, v={k=geneName, v=gene freq}, updated in place
+    :param counts: same layout, from docsum_gene_counts
+    :return: gds_dict
+    """
+    for gdsid, genes in counts.items():
+        if gdsid not in gds_dict:
+            gds_dict[gdsid] = defaultdict(int)
+        target = gds_dict[gdsid]
+        for gname, freq in genes.items():
+            target[gname] += freq
+    return gds_dict
+
+
+def as_dense(gds_py) -> pd.DataFrame:
+    """
+    Dense copy of a GDS x gene dataframe, e.g. for conversion to R
+    :param gds_py:
+    :return:
+    """
+    try:
+        return gds_py.sparse.to_dense()
+    except AttributeError:
+        return gds_py
 
 
 # class for querying GEO databases
 class GEOQuery:
-    def __init__(self, outprefix, term, email, tool="phenotypeXpression", efetch_batch=5000, elink_batch=100):
+    def __init__(self, outprefix, term, email, tool="phenotypeXpression", efetch_batch=5000, elink_batch=100,
+                 esearch_batch=10000, esummary_batch=500, cache=None, cluster_engine='pvclust', nboot=5000, cluster_jobs=None,
+                 nboot_tol=None, nboot_start=500, eutils=None, transport=None, metrics=None, retry=None):
         Entrez.email = email
         Entrez.tool = tool
+        self.cache = cache
+        # record/replay or stand-in server transport, see phenox.transport
+        self.transport = transport
+        # metrics.RunMetrics of the run, or None
+        self.metrics = metrics
+        # retry policy and circuit breaker, shared with other queries when passed in
+        self.retry = retry or RetryPolicy()
+        # concurrent E-utilities client, shared with other queries when passed in
+        # and closed by close() only when created here
+        self._owns_eutils = eutils is None
+        self.eutils = eutils or AsyncEntrez(cache=cache, transport=transport)
+        self.cluster_engine = cluster_engine
+        self.nboot = nboot
+        self.cluster_jobs = cluster_jobs
+        # adaptive replicate count for pvclust: start at nboot_start and double
+        # up to nboot until candidate cluster AU values move less than nboot_tol
+        self.nboot_tol = nboot_tol
+        self.nboot_start = nboot_start
         self.efetch_batch = efetch_batch
         self.elink_batch = elink_batch
+        self.esearch_batch = esearch_batch
+        self.esummary_batch = esummary_batch
         self.db = 'geoprofiles'
 
         self.paths = PhenoXPaths(outprefix)
@@ -53,46 +151,39 @@ class GEOQuery:
             self.paths.output_dir, "{}_{}_dist_graph.pdf".format(self.paths.outprefix, term_name)
         )
 
+    def close(self) -> None:
+        """
+        Shut down the E-utilities client if this query created it
+        :return:
+        """
+        if self._owns_eutils:
+            self.eutils.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
     @staticmethod
     def timing_tool():
         return time.perf_counter()
 
-    @staticmethod
-    def http_attempts(query_type, **kwargs):
+    def _on_retry(self):
+        return self.metrics.retry if self.metrics is not None else None
+
+    def http_attempts(self, query_type, **kwargs):
         """
-        HTTP attempts
+        Entrez request under the shared retry policy
         :param query_type:
         :param kwargs:
-        :return:
+        :return: response handle
+        :raises NCBIUnavailableError: retries exhausted or NCBI circuit open
         """
-        fetch_handle = None
-
-        for attempt in range(4):  # HTTPError and retry three times
-            try:
-                fetch_handle = getattr(Entrez, query_type)(**kwargs)
-            except ValueError as oops:
-                logging.warning('Empty set: Likely total number = batch size')
-                break
-            except HTTPError as err:
-                if 500 <= err.code <= 599:
-                    logging.info("Attempt {} of 4".format(attempt + 1))
-                    logging.warning(err)
-                    time.sleep(15)
-                elif err.code == 400:
-                    logging.info("Attempt {} of 4".format(attempt + 1))
-                    logging.warning(err)
-                    sys.tracebacklimit = None
-                    time.sleep(15)
-                else:
-                    raise
-            except KeyboardInterrupt:
-                raise KeyboardInterrupt()
-            else:
-                break
-        else:
-            logging.critical('Failed to connect to NCBI 4 times exiting...')
-            sys.exit()
-        return fetch_handle
+        return self.retry.call(
+            lambda: entrez_request(self.cache, query_type, transport=self.transport, **kwargs),
+            query_type, on_retry=self._on_retry()
+        )
 
     def post_ncbi(self, query_type, **kwargs):
         """
@@ -114,26 +205,77 @@ class GEOQuery:
                       .format(webenv, query_key))
         return webenv, query_key, count
 
+    async def http_attempts_async(self, query_type, **kwargs):
+        """
+        HTTP attempts on the concurrent client, parsed with Entrez.read
+        :param query_type:
+        :param kwargs:
+        :return: parsed response
+        :raises NCBIUnavailableError: retries exhausted, including responses
+            that still fail to parse, or NCBI circuit open
+        """
+        return await self.retry.call_async(
+            lambda: self.eutils.read(query_type, **kwargs), query_type, on_retry=self._on_retry()
+        )
+
+    async def _batch_ncbi_async(self, query_type, count, **kwargs) -> List:
+        """
+        Download all retstart windows of a history list concurrently
+        :param query_type:
+        :param count: number in history list
+        :param kwargs:
+        :return: parsed batches in window order
+        """
+        windows = range(0, count, self.efetch_batch)
+        logging.info("Going to download {} records in {} batches".format(count, len(windows)))
+        return list(await asyncio.gather(*[
+            self.http_attempts_async(query_type, **dict(retstart=start, **kwargs)) for start in windows
+        ]))
+
     # Utilized for batch efetch/esummary from ncbi using history server.
     def batch_ncbi(self, query_type, query_results, count1, **kwargs):
-        # number in history list
-        count = count1
-
-        # sliding window of history list in batch size
-        for start in range(0, count, self.efetch_batch):
-            end = min(count, start + self.efetch_batch)
-            logging.info("Going to download record {} to {}"
-                         .format(start + 1, end))
-
-            logging.debug('{} run with {}'
-                          .format(query_type, dict(retstart=start, **kwargs)))
-            fetch_handle = self.http_attempts(
-                query_type, **dict(retstart=start, **kwargs)
-            )
-            query_results.append(Entrez.read(fetch_handle))
-            fetch_handle.close()
+        query_results.extend(run_sync(self._batch_ncbi_async(query_type, count1, **kwargs)))
         return
 
+    async def _docsum_async(self, mesh_term, database, query_term) -> List:
+        """
+        esearch onto the history server, then efetch all docsum windows
+        :param mesh_term:
+        :param database:
+        :param query_term:
+        :return:
+        """
+        query = await self.http_attempts_async(
+            'esearch', db=database, usehistory='y', term='{} AND {}'.format(mesh_term, query_term)
+        )
+        logging.debug('returned webenv: {} and query key: {}'.format(query['WebEnv'], query['QueryKey']))
+        return await self._batch_ncbi_async(
+            'efetch', int(query['Count']), db=database, rettype='docsum', retmax=self.efetch_batch,
+            webenv=query['WebEnv'], query_key=query['QueryKey']
+        )
+
+    def get_ncbi_docsums(self, mesh_term, database, query_terms: List) -> List:
+        """
+        Get document summaries for several queries, all submitted at once
+        :param mesh_term:
+        :param database:
+        :param query_terms:
+        :return: list of query results, one per query term
+        """
+        start = self.timing_tool()
+        results = run_all([self._docsum_async(mesh_term, database, q) for q in query_terms])
+
+        # stop timing and log
+        stop = self.timing_tool()
+        logging.info('Download time: {} min, Batches run -> {}'
+                     .format(((stop - start) / 60), sum(len(r) for r in results)))
+        if self.metrics is not None:
+            self.metrics.record('geo_docsums', database=database, queries=len(query_terms),
+                                batches=sum(len(r) for r in results), seconds=round(stop - start, 4),
+                                docsums=sum(len(b['DocumentSummarySet']['DocumentSummary'])
+                                            for r in results for b in r))
+        return results
+
     def get_ncbi_docsum(self, mesh_term, database, query_term='"up down genes"[filter]') -> List:
         """
         Get document summaries from NCBI database
@@ -142,56 +284,177 @@ class GEOQuery:
         :param query_term:
         :return:
         """
-        start = self.timing_tool()
-        staging_list = []
-        query_results = []
+        return self.get_ncbi_docsums(mesh_term, database, [query_term])[0]
 
-        # First, esearch using mesh_term, and keep results on ePost history server
-        webenv1, query_key1, count1 = self.post_ncbi(
-            'esearch', db=database, usehistory='y',
-            term='{} AND {}'.format(mesh_term, query_term)
-        )
+    async def _docsum_counts_async(self, database, **kwargs) -> Tuple[Dict, int]:
+        """
+        Download one retstart window of docsums and reduce it to gene counts;
+        an unparseable or error response is dropped from the cache and
+        retried under the policy
+        :param database:
+        :param kwargs: efetch history and window parameters
+        :return: gene counts and number of docsums
+        :raises NCBIUnavailableError: retries exhausted or NCBI circuit open
+        """
+        params = dict(db=database, rettype='docsum', **kwargs)
 
-        # Then, efetch in batches of efetch_batch
-        self.batch_ncbi('efetch', staging_list, count1, db=database,
-                        rettype='docsum', retmax=self.efetch_batch, webenv=webenv1,
-                        query_key=query_key1)
+        async def fetch():
+            handle = await self.eutils.request('efetch', **params)
+            try:
+                return docsum_gene_counts(handle)
+            except (ET.ParseError, NCBIErrorResponse) as err:
+                if self.eutils.cache is not None:
+                    self.eutils.cache.discard('efetch', params)
+                if isinstance(err, NCBIErrorResponse):
+                    raise
+                raise ValueError('Unparseable docsum batch: {}'.format(err))
 
-        # append to passed list
-        [query_results.append(batch) for batch in staging_list]
+        return await self.retry.call_async(fetch, 'efetch', on_retry=self._on_retry())
+
+    async def _stream_docsums_async(self, mesh_term, database, query_term) -> Tuple[Dict, int, int]:
+        """
+        Search, then fold the docsum windows into one gds_dict while they
+        download, in window order so dataset and gene order match
+        gdsdict_from_profile
+        :param mesh_term:
+        :param database:
+        :param query_term:
+        :return: gds_dict, number of docsums and of batches
+        """
+        query = await self.http_attempts_async(
+            'esearch', db=database, usehistory='y', term='{} AND {}'.format(mesh_term, query_term)
+        )
+        windows = range(0, int(query['Count']), self.efetch_batch)
+        logging.info("Going to stream {} records in {} batches".format(query['Count'], len(windows)))
+        tasks = [asyncio.ensure_future(self._docsum_counts_async(
+            database, retstart=start, retmax=self.efetch_batch,
+            webenv=query['WebEnv'], query_key=query['QueryKey'])) for start in windows]
+
+        gds_dict = dict()
+        n_docsums = 0
+        try:
+            for task in tqdm.tqdm(tasks, desc="GEO Datasets"):
+                counts, n = await task
+                merge_gds_dict(gds_dict, counts)
+                n_docsums += n
+        finally:
+            for task in tasks:
+                task.cancel()
+        return gds_dict, n_docsums, len(windows)
+
+    def stream_gds_dict(self, mesh_term, database, query_term='"up down genes"[filter]') -> Dict:
+        """
+        GDS data dict straight from the docsum responses, without keeping
+        parsed docsum batches; same result as get_ncbi_docsum followed by
+        gdsdict_from_profile
+        :param mesh_term:
+        :param database:
+        :param query_term:
+        :return gds_dict: k=gds_id, v={k=geneName, v=gene freq}
+        """
+        start = self.timing_tool()
+        gds_dict, n_docsums, n_batches = run_sync(self._stream_docsums_async(mesh_term, database, query_term))
 
-        # stop timing and log
         stop = self.timing_tool()
-        logging.info('Download time: {} min, Batches run -> {}'
-                     .format(((stop - start) / 60), len(query_results)))
+        logging.info('Download time: {} min, Batches run -> {}'.format(((stop - start) / 60), n_batches))
+        if self.metrics is not None:
+            self.metrics.record('geo_docsums', database=database, queries=1, batches=n_batches,
+                                seconds=round(stop - start, 4), docsums=n_docsums, streamed=True)
+        return gds_dict
 
-        return query_results
+    async def _uilist_async(self, database, **kwargs) -> List:
+        """
+        One window of ids from the history server, as a text efetch uilist
+        :param database:
+        :param kwargs: efetch history and window parameters
+        :return: list of ids
+        :raises NCBIUnavailableError: retries exhausted or NCBI circuit open
+        """
+        params = dict(db=database, rettype='uilist', retmode='text', **kwargs)
+
+        async def fetch():
+            data = (await self.eutils.request('efetch', **params)).read()
+            ids = data.decode('utf-8', 'replace').split()
+            if b'<ERROR>' in data or not all(i.isdigit() for i in ids):
+                if self.eutils.cache is not None:
+                    self.eutils.cache.discard('efetch', params)
+                if b'<ERROR>' in data:
+                    raise NCBIErrorResponse('E-utilities error in uilist response: {}'.format(data[:200]))
+                raise ValueError('Unparseable uilist batch')
+            return ids
+
+        return await self.retry.call_async(fetch, 'efetch', on_retry=self._on_retry())
+
+    async def _search_ids_async(self, mesh_term, database, query_term) -> List:
+        """
+        ID only esearch onto the history server; ids past the first page are
+        fetched as uilist windows, since PubMed esearch does not page beyond
+        10,000 records
+        :param mesh_term:
+        :param database:
+        :param query_term:
+        :return: list of ids
+        """
+        term = '{} AND {}'.format(mesh_term, query_term)
+        first = await self.http_attempts_async('esearch', db=database, term=term, usehistory='y',
+                                               retmax=self.esearch_batch)
+        pages = await asyncio.gather(*[
+            self._uilist_async(database, webenv=first['WebEnv'], query_key=first['QueryKey'],
+                               retstart=start, retmax=self.esearch_batch)
+            for start in range(len(first['IdList']), int(first['Count']), self.esearch_batch)
+        ])
+        return list(first['IdList']) + [i for page in pages for i in page]
+
+    def search_ids(self, mesh_term, database, query_terms: List) -> List:
+        """
+        IDs matching each of several queries, all submitted at once
+        :param mesh_term:
+        :param database:
+        :param query_terms:
+        :return: list of id lists, one per query term
+        """
+        return run_all([self._search_ids_async(mesh_term, database, q) for q in query_terms])
 
-    def batch_local(self, query_type, id_list, **kwargs) -> Dict:
+    async def _batch_local_async(self, query_type, id_list, fold, **kwargs) -> None:
         """
-        Batch local for elink,einfo queries w/ no retstart parameter
+        Submit all id batches at once and fold each parsed batch into the
+        caller's results as soon as it arrives
         :param query_type:
         :param id_list:
+        :param fold: callable taking one parsed batch
         :param kwargs:
         :return:
         """
         count = len(id_list)
+        logging.info("Looking up {} ids in {} batches".format(count, -(-count // self.elink_batch)))
+        batches = [
+            self.http_attempts_async(query_type, **dict(id=id_list[start:start + self.elink_batch], **kwargs))
+            for start in range(0, count, self.elink_batch)
+        ]
+        for batch in asyncio.as_completed(batches):
+            fold(await batch)
+
+    def batch_local(self, query_type, id_list, **kwargs) -> Dict:
+        """
+        Batch local for elink,einfo queries w/ no retstart parameter.
+        Ids are passed as a list, so elink returns one link set per id.
+        :param query_type:
+        :param id_list:
+        :param kwargs:
+        :return: k=id, v=first linked id or None
+        """
         result_dict = dict()
 
-        for start in range(0, count, self.elink_batch):
-            end = min(count, start + self.elink_batch)
-            logging.info("Looking up PMIDs for GDSs {} to {}"
-                         .format(start + 1, end))
-
-            # elink each batch
-            fetch_handle = self.http_attempts(
-                query_type, **dict(id=','.join(id_list[start:end]), **kwargs)
-            )
-            record = Entrez.read(fetch_handle)
-            fetch_handle.close()
+        def fold(record):
             # for each Link'Id', dig down through dict add to list
             for el in record:
-                result_dict[el['IdList'][0]] = el['LinkSetDb'][0]['Link'][0]['Id']
+                try:
+                    result_dict[el['IdList'][0]] = el['LinkSetDb'][0]['Link'][0]['Id']
+                except IndexError:
+                    # entries with missing info
+                    result_dict[el['IdList'][0]] = None
+
+        run_sync(self._batch_local_async(query_type, list(id_list), fold, **kwargs))
         return result_dict
 
     def gdsdict_from_profile(self, query_results) -> Dict:
@@ -214,95 +477,110 @@ class GEOQuery:
                         gds_dict[gdsid][gname.upper()] += 1
         return gds_dict
 
+    async def _meta_async(self, gds_list: List, meta_dict: Dict) -> None:
+        """
+        epost the GDS list once, then esummary windows from the history server
+        :param gds_list:
+        :param meta_dict: filled in place as batches arrive
+        :return:
+        """
+        if not gds_list:
+            return
+        post = await self.http_attempts_async('epost', db='gds', id=gds_list)
+        batches = [
+            self.http_attempts_async('esummary', db='gds', webenv=post['WebEnv'], query_key=post['QueryKey'],
+                                     retstart=start, retmax=self.esummary_batch)
+            for start in range(0, len(gds_list), self.esummary_batch)
+        ]
+        for batch in asyncio.as_completed(batches):
+            for sm in await batch:
+                meta_dict[sm['Id']] = [sm['n_samples'],
+                                       datetime.strptime(sm['PDAT'], '%Y/%m/%d').timestamp(),
+                                       sm['GPL']]
+
     def meta_from_gds(self, gds_dict: Dict) -> Dict:
         """
         Get meta information, such as gds submission time, n_samples, platform from gds.
         :param gds_dict: k=gds_id, v={k=geneName, v=gene freq}
         :return: meta_dict: key=gds_ids, value=list of gds metrics (n_samples, dates, GPLs)
         """
+        meta_dict = dict()
         gds_list = list(gds_dict.keys())
-        qout = Entrez.read(Entrez.esummary(db="gds", id=",".join(gds_list)))
-        meta_dict = {sm['Id']:[sm['n_samples'],
-                               datetime.strptime(sm['PDAT'],'%Y/%m/%d').timestamp(),
-                               sm['GPL']]
-                     for sm in qout}
+        if gds_list:
+            run_sync(self._meta_async(gds_list, meta_dict))
         return meta_dict
 
     def get_pubmed_ids(self, data_dict) -> Dict:
         """
         Fetch PubMed terms from GDS data
         :param gds_dict: k=gds_id, v={k=geneName, v=gene freq}
-        :return pids:
+        :return pids: k=gds_id, v=first linked pubmed id or None
         """
-        gds_list = list(data_dict.keys())
-    
-        # elink gds to pid
-        pid_list = Entrez.read(
-            Entrez.elink(
-                id=gds_list, db='pubmed', dbfrom='gds', linkname='gds_pubmed'
-            )
-        )
-
-        # extract Pubmed IDs
-        pids = dict()
-
-        for entry in pid_list:
-            try:
-                pids[entry['IdList'][0]] = entry['LinkSetDb'][0]['Link'][0]['Id']
-            except IndexError:
-                # skip entries with missing info
-                pids[entry['IdList'][0]] = None
-                continue
-    
-        return pids
+        # elink gds to pid in batches, one link set per GDS
+        return self.batch_local('elink', list(data_dict.keys()), db='pubmed', dbfrom='gds', linkname='gds_pubmed')
     
     def gds_to_pd_dataframe(self, gds_dict: Dict):
         """
-        Convert GDS to pandas dataframe
+        Convert GDS to binary GDS x gene matrix, keeping genes found in
+        more than one GDS and GDS with more than one such gene
         :param gds_dict: k=gds_id, v={k=geneName, v=gene freq}
-        :return pdd:
-        """
-        pdd = pd.DataFrame(list(gds_dict.values()))
-        pdd.index = gds_dict.keys()
-        pdd = pdd.fillna(0)
-        pdd[pdd > 1] = 1
-        col_select = pdd.columns[pdd.sum() > 1]
-        pdd = pdd.loc[:, col_select]
-        pdd = pdd[pdd.sum(axis=1) > 1]
+        :return pdd: sparse-backed dataframe, index=gds ids, columns=gene names
+        """
+        gds_ids = list(gds_dict.keys())
+        gene_index = dict()
+        indptr = [0]
+        indices = []
+        for gds_id in gds_ids:
+            indices.extend(gene_index.setdefault(gname, len(gene_index)) for gname in gds_dict[gds_id])
+            indptr.append(len(indices))
+
+        mat = sparse.csr_matrix(
+            (np.ones(len(indices), dtype=np.int8), np.array(indices, dtype=np.int32), np.array(indptr)),
+            shape=(len(gds_ids), len(gene_index))
+        )
+        gene_names = np.array(list(gene_index.keys()), dtype=object)
+
+        col_select = mat.getnnz(axis=0) > 1
+        mat = mat[:, col_select]
+        row_select = mat.getnnz(axis=1) > 1
+        mat = mat[row_select]
+
+        pdd = pd.DataFrame.sparse.from_spmatrix(
+            mat, index=np.array(gds_ids, dtype=object)[row_select], columns=gene_names[col_select]
+        )
         return pdd
 
-    def _generate_dist_graph(self, gds_py):
+    def _generate_dist_graph(self, gds_py, n_neighbors=5, max_labels=40, landmark_threshold=2000):
         """
-        Generate a distance plot from GDS matrix
+        Generate a distance plot from GDS matrix: classical MDS layout
+        (landmark MDS above landmark_threshold datasets) with edges to each
+        dataset's nearest neighbours, coloured by euclidean distance
         :param gds_py:
+        :param n_neighbors: edges drawn per dataset
+        :param max_labels: cap on annotated datasets
+        :param landmark_threshold:
         :return:
         """
-        exp_list = list(gds_py.index)
-        gds_array = np.array(gds_py)
-        gds_array -= gds_array.mean()
+        exp_list = np.array(gds_py.index, dtype=object)
+        gds_array = as_csr(gds_py).astype(np.float64)
 
-        similarities = euclidean_distances(gds_array)
-        mds = manifold.MDS(n_components=2, max_iter=100, eps=1e-9,
-                           dissimilarity="precomputed", n_jobs=1)
-        pos = mds.fit(similarities).embedding_
-
-        clf = PCA(n_components=2)
-        pos = clf.fit_transform(pos)
+        pos = dist_graph.embed(gds_array, landmark_threshold=landmark_threshold)
+        pairs, distances = dist_graph.knn_edges(gds_array, n_neighbors)
 
         fig = plt.figure(1)
         ax = plt.axes([0., 0., 1., 1.])
 
-        plt.scatter(pos[:, 0], pos[:, 1], color='navy', s=100, lw=0, label='MDS')
-        for i, txt in enumerate(exp_list):
-            ax.annotate(txt, (pos[i, 0] + 0.1, pos[i, 1] + 0.1), color='black')
+        size = 100 if len(pos) <= 200 else max(4, 100 * 200 / len(pos))
+        plt.scatter(pos[:, 0], pos[:, 1], color='navy', s=size, lw=0, label='MDS')
+        for i in dist_graph.spread_labels(pos, max_labels):
+            ax.annotate(exp_list[i], (pos[i, 0] + 0.1, pos[i, 1] + 0.1), color='black')
 
-        segments = [[pos[i, :], pos[j, :]] for i in range(len(pos)) for j in range(len(pos))]
-        values = np.abs(similarities)
+        segments = np.stack([pos[pairs[:, 0]], pos[pairs[:, 1]]], axis=1)
         lc = LineCollection(segments,
                             zorder=0, cmap=plt.cm.Blues,
-                            norm=plt.Normalize(0, values.max()))
-        lc.set_array(similarities.flatten())
-        lc.set_linewidths(0.5 * np.ones(len(segments)))
+                            norm=plt.Normalize(0, distances.max() if len(distances) else 1))
+        lc.set_array(distances)
+        lc.set_linewidths(0.5)
         ax.add_collection(lc)
 
         xmin, xmax = plt.xlim()
@@ -313,15 +591,74 @@ class GEOQuery:
 
         fig.suptitle("Distances")
         fig.savefig(self.dist_graph_file, bbox_inches='tight')
+        plt.close(fig)
         print("Distance graph written to {}".format(self.dist_graph_file))
         return
 
+    def _run_pvclust(self, pvclust, mat_trans, nboot):
+        """
+        Run pvclust on a parallel worker cluster
+        :param pvclust: imported pvclust R package
+        :param mat_trans: gene x GDS R matrix
+        :param nboot:
+        :return: pvclust fit
+        """
+        # an integer sets the number of R worker processes, TRUE uses all but one core
+        parallel = self.cluster_jobs if self.cluster_jobs else True
+        return pvclust.pvclust(mat_trans, nboot=nboot, method_hclust="ward.D2", method_dist="euclidean",
+                               parallel=parallel, quiet=True)
+
+    def _adaptive_pvclust(self, pvclust, mat_trans, alpha=.95):
+        """
+        Run pvclust in rounds of doubling nboot until the AU p-values of
+        candidate clusters (AU within 0.1 of alpha or above) change by less
+        than nboot_tol between rounds, or nboot is reached
+        :param pvclust: imported pvclust R package
+        :param mat_trans: gene x GDS R matrix
+        :param alpha:
+        :return: pvclust fit of the last round
+        """
+        nboot = min(self.nboot_start, self.nboot)
+        fit = self._run_pvclust(pvclust, mat_trans, nboot)
+        au = np.array(fit.rx2('edges').rx2('au'))
+        trace = []
+
+        while nboot < self.nboot:
+            nboot = min(2 * nboot, self.nboot)
+            next_fit = self._run_pvclust(pvclust, mat_trans, nboot)
+            next_au = np.array(next_fit.rx2('edges').rx2('au'))
+
+            candidates = (au >= alpha - .1) | (next_au >= alpha - .1)
+            delta = float(np.abs(next_au - au)[candidates].max()) if candidates.any() else 0.
+            trace.append((nboot, delta))
+            logging.info('pvclust nboot={}: max AU change {:.4f} over {} candidate clusters'
+                         .format(nboot, delta, int(candidates.sum())))
+
+            fit, au = next_fit, next_au
+            if delta < self.nboot_tol:
+                break
+
+        logging.info('pvclust converged at nboot={} (tolerance {}), trace: {}'
+                     .format(nboot, self.nboot_tol, trace))
+        return fit
+
+    def _record_bootstrap(self, engine: str, nboot: int, start: float) -> None:
+        if self.metrics is not None:
+            self.metrics.record('bootstrap', engine=engine, nboot=nboot,
+                                seconds=round(self.timing_tool() - start, 4))
+
     def call_r_clustering(self, gds_py):
         """
         Call R script
         :param gds: dataframe with GDS data
         :return:
         """
+        # R is only needed for the pvclust engine
+        from rpy2.robjects import pandas2ri, default_converter
+        from rpy2.robjects.conversion import localconverter
+        from rpy2.robjects.packages import importr
+        from rpy2 import rinterface
+
         # load all R libraries
         base = importr("base")
         pvclust = importr("pvclust")
@@ -332,14 +669,20 @@ class GEOQuery:
 
         # convert pandas df to R df
         with localconverter(default_converter + pandas2ri.converter) as cv:
-            gds = pandas2ri.py2ri(gds_py)
+            gds = pandas2ri.py2ri(as_dense(gds_py))
 
         matrix = base.as_matrix(gds)
         mat_trans = matrix.transpose()
 
         # cluster over studies
         print("Clustering on Studies...")
-        fit = pvclust.pvclust(mat_trans, nboot=5000, method_hclust="ward.D2", method_dist="euclidean")
+        start = self.timing_tool()
+        if self.nboot_tol:
+            fit = self._adaptive_pvclust(pvclust, mat_trans)
+        else:
+            fit = self._run_pvclust(pvclust, mat_trans, self.nboot)
+            logging.info('pvclust nboot={}'.format(self.nboot))
+        self._record_bootstrap('pvclust', int(fit.rx2('nboot')[0]), start)
 
         # write clustering output to pdf
         grdevices.pdf(self.hcluster_file, paper="a4")
@@ -380,32 +723,95 @@ class GEOQuery:
         self._generate_dist_graph(gds_py)
         return cluster_members
 
-    def get_all_geo_data(self, mesh_term: str) -> Tuple:
+    def call_py_clustering(self, gds_py):
         """
-        Link all functions together to retrieve GEO data
-        :param mesh_term:
+        Cluster GDS with the native multiscale bootstrap engine, writing
+        the same outputs as the pvclust path
+        :param gds_py: dataframe with GDS data
         :return:
         """
-        # query GEO using MeSH term and retrieve datasets
-        query_results = self.get_ncbi_docsum(mesh_term, self.db)
+        print("Clustering on Studies...")
+        mat = as_csr(gds_py)
+        start = self.timing_tool()
+        fit = MultiscaleBootstrap(nboot=self.nboot, n_jobs=self.cluster_jobs).fit(mat, gds_py.index)
+        self._record_bootstrap('python', self.nboot, start)
 
-        # Map GEO datasets to genes names and count gene frequency
-        gds_dict = self.gdsdict_from_profile(query_results)
+        fit.plot(self.hcluster_file, alpha=.95)
+        print("Clustering diagram written to {}".format(self.hcluster_file))
+
+        fit.plot_heatmap(mat, self.heatmap_file)
+        print("Heatmap written to {}".format(self.heatmap_file))
+
+        with open(self.tree_file, 'w') as f:
+            f.write(fit.newick() + '\n')
+        print("Cluster tree written to {}".format(self.tree_file))
+
+        # extract cluster membership
+        clusters = fit.pick(alpha=.95)
+
+        cluster_members = defaultdict(list)
+
+        if not clusters:
+            print("WARNING: Only one cluster!")
+            cluster_members['cluster0'] = list(gds_py.index)
+        else:
+            for i, clust in enumerate(clusters):
+                cluster_members["cluster{}".format(i)].extend(clust)
+
+        # generate distance graph
+        self._generate_dist_graph(gds_py)
+        return cluster_members
+
+    def cluster_gds(self, gds_py):
+        """
+        Cluster GDS with the configured engine (pvclust or python)
+        :param gds_py: dataframe with GDS data
+        :return:
+        """
+        if self.cluster_engine == 'python':
+            return self.call_py_clustering(gds_py)
+        return self.call_r_clustering(gds_py)
+
+    def retrieve_geo_data(self, mesh_term: str) -> Tuple:
+        """
+        Retrieve GEO datasets, their genes, PubMed links and metadata
+        :param mesh_term:
+        :return:
+        """
+        # query GEO using MeSH term, mapping datasets to gene names and
+        # counting gene frequency as the docsums arrive
+        gds_dict = self.stream_gds_dict(mesh_term, self.db)
 
         # Map GEO datasets to Pubmed IDs
         geo_to_pid_dict = self.get_pubmed_ids(gds_dict)
 
-        # Retrieve gene names from GEO gene profiles
-        # gid_to_gname_dict = self.genedict_from_profile(query_results)
+        # Batch effect data
+        meta_dict = self.meta_from_gds(gds_dict)
+
+        return geo_to_pid_dict, gds_dict, meta_dict
 
+    def cluster_geo_data(self, gds_dict: Dict) -> Dict:
+        """
+        Cluster GEO datasets on their gene sets
+        :param gds_dict: k=gds_id, v={k=geneName, v=gene freq}
+        :return: key=cluster_ids, value=list of GDS ids
+        """
         # Export GDS
         gds = self.gds_to_pd_dataframe(gds_dict)
+        if self.metrics is not None:
+            nnz = as_csr(gds).nnz
+            self.metrics.record('gds_matrix', datasets=len(gds_dict), rows=gds.shape[0], columns=gds.shape[1],
+                                nnz=nnz, density=round(nnz / max(1, gds.shape[0] * gds.shape[1]), 6))
 
         # Run clustering algorithm
-        clusters = self.call_r_clustering(gds)
-        
-        # Batch effect data
-        meta_dict = self.meta_from_gds(gds_dict)
+        return self.cluster_gds(gds)
 
+    def get_all_geo_data(self, mesh_term: str) -> Tuple:
+        """
+        Link all functions together to retrieve GEO data
+        :param mesh_term:
+        :return:
+        """
+        geo_to_pid_dict, gds_dict, meta_dict = self.retrieve_geo_data(mesh_term)
+        clusters = self.cluster_geo_data(gds_dict)
         return geo_to_pid_dict, gds_dict, clusters, meta_dict
-
@@ -0,0 +1,166 @@
+import re
+import pickle
+from array import array
+from collections import deque
+from typing import Dict, List, Tuple
+
+
+# words and single punctuation marks; whitespace only separates tokens
+TOKEN_RE = re.compile(r'\w+|[^\w\s]')
+
+
+def tokenize(text: str) -> List:
+    """
+    Split text into (start, end, lowercased token) triples
+    :param text:
+    :return:
+    """
+    return [(m.start(), m.end(), m.group().lower()) for m in TOKEN_RE.finditer(text)]
+
+
+# class for matching a large keyword list against free text
+class KeywordMatcher:
+    def __init__(self, keywords: Dict, stop_words=()):
+        """
+        Build an Aho-Corasick automaton over keyword token sequences.
+        Matching is case-insensitive and only starts and ends on token
+        boundaries; overlapping hits resolve to the leftmost longest keyword.
+        :param keywords: k=keyword, v=value reported for matches of the keyword
+        :param stop_words: matches starting with one of these tokens are dropped
+        """
+        self.stop_words = frozenset(w.lower() for w in stop_words)
+        self.keywords = []
+        self.values = []
+        self.vocab = dict()
+
+        # goto transitions keyed by node * n_vocab + token id
+        goto = dict()
+        term = array('i', [-1])
+        depth = array('i', [0])
+
+        sequences = []
+        for kw, value in keywords.items():
+            tokens = [t for _, _, t in tokenize(kw)]
+            if tokens:
+                sequences.append((tokens, kw, value))
+        for tokens, _, _ in sequences:
+            for t in tokens:
+                self.vocab.setdefault(t, len(self.vocab))
+        self.n_vocab = max(len(self.vocab), 1)
+
+        for tokens, kw, value in sequences:
+            node = 0
+            for t in tokens:
+                key = node * self.n_vocab + self.vocab[t]
+                if key not in goto:
+                    goto[key] = len(term)
+                    term.append(-1)
+                    depth.append(depth[node] + 1)
+                node = goto[key]
+            if term[node] < 0:
+                term[node] = len(self.keywords)
+                self.keywords.append(kw.lower())
+                self.values.append(value)
+
+        self.goto = goto
+        self.term = term
+        self.depth = depth
+        self._build_links()
+
+    def _build_links(self) -> None:
+        """
+        Breadth-first computation of failure and output links
+        :return:
+        """
+        n_nodes = len(self.term)
+        children = [[] for _ in range(n_nodes)]
+        for key, child in self.goto.items():
+            children[key // self.n_vocab].append((key % self.n_vocab, child))
+
+        fail = array('i', [0] * n_nodes)
+        out = array('i', [0] * n_nodes)
+        queue = deque(child for _, child in children[0])
+        while queue:
+            node = queue.popleft()
+            for tok, child in children[node]:
+                state = fail[node]
+                while state and state * self.n_vocab + tok not in self.goto:
+                    state = fail[state]
+                target = self.goto.get(state * self.n_vocab + tok, 0)
+                fail[child] = target if target != child else 0
+                out[child] = fail[child] if self.term[fail[child]] >= 0 else out[fail[child]]
+                queue.append(child)
+
+        self.fail = fail
+        self.out = out
+
+    def find(self, text: str) -> List[Tuple]:
+        """
+        Scan text once and return non-overlapping keyword matches
+        :param text:
+        :return: list of (matched text, keyword, value)
+        """
+        tokens = tokenize(text)
+        hits = []
+        node = 0
+        n_vocab = self.n_vocab
+        for i, (_, _, tok) in enumerate(tokens):
+            tok_id = self.vocab.get(tok)
+            if tok_id is None:
+                node = 0
+                continue
+            while node and node * n_vocab + tok_id not in self.goto:
+                node = self.fail[node]
+            node = self.goto.get(node * n_vocab + tok_id, 0)
+            hit = node if self.term[node] >= 0 else self.out[node]
+            while hit:
+                hits.append((i - self.depth[hit] + 1, i, self.term[hit]))
+                hit = self.out[hit]
+
+        # leftmost longest, non-overlapping
+        hits.sort(key=lambda h: (h[0], h[0] - h[1]))
+        matches = []
+        next_free = 0
+        for start, end, kw_ind in hits:
+            if start < next_free:
+                continue
+            next_free = end + 1
+            if tokens[start][2] in self.stop_words:
+                continue
+            span = text[tokens[start][0]:tokens[end][1]]
+            matches.append((span, self.keywords[kw_ind], self.values[kw_ind]))
+        return matches
+
+    def save(self, matcher_file: str) -> None:
+        """
+        Serialize automaton to file
+        :param matcher_file:
+        :return:
+        """
+        with open(matcher_file, 'wb') as f:
+            pickle.dump(self.__dict__, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, matcher_file: str):
+        """
+        Load a prebuilt automaton from file
+        :param matcher_file:
+        :return:
+        """
+        matcher = cls.__new__(cls)
+        with open(matcher_file, 'rb') as f:
+            matcher.__dict__.update(pickle.load(f))
+        return matcher
+
+
+def ontology_matcher(kw2id: Dict, id2kw: Dict) -> KeywordMatcher:
+    """
+    Build the DO/HPO matcher, reporting each keyword as the main term
+    (first item) of its DO/HPO entry and skipping matches on English stop words
+    :param kw2id: k=lowercased keyword, v=ontology id
+    :param id2kw: k=ontology id, v=list of keywords, main term first
+    :return:
+    """
+    # spaCy's stop word list is only needed to build the automaton
+    from spacy.lang.en.stop_words import STOP_WORDS
+    return KeywordMatcher({kw: id2kw[i][0] for kw, i in kw2id.items()}, stop_words=STOP_WORDS)
@@ -0,0 +1,210 @@
+import os
+import json
+import mmap
+import pickle
+import struct
+import numpy as np
+from collections.abc import Mapping
+from typing import Dict, List, Tuple
+
+
+MAGIC = b'PXLEX001'
+# magic, n_terms, n_synonyms, n_keywords, blob size
+HEADER = struct.Struct('<8sQQQQ')
+
+# ontology label files merged into the pickled DO/HPO keyword dicts
+ONTOLOGY_FILES = ('doid.json', 'hp.json')
+
+
+def utf8_offsets(strings: List) -> np.ndarray:
+    """
+    Cumulative byte offsets of utf-8 encoded strings, with a leading zero
+    :param strings:
+    :return:
+    """
+    lengths = [len(s) for s in strings]
+    return np.concatenate([[0], np.cumsum(lengths, dtype=np.uint64)]).astype(np.uint64)
+
+
+def merge_ontologies(id2kw: Dict, kw2id: Dict, ontologies: List) -> Tuple[Dict, Dict]:
+    """
+    DO/HPO terms and keywords: the pickled dicts plus ontology labels of
+    terms missing from them. Keywords of unknown terms are dropped.
+    :param id2kw: k=ontology id, v=list of keywords, main term first
+    :param kw2id: k=lowercased keyword, v=ontology id
+    :param ontologies: additional dicts of k=ontology id, v=list of labels
+    :return: merged id2kw, kw2id
+    """
+    terms = {k: list(v) for k, v in id2kw.items()}
+    keywords = dict(kw2id)
+    for ontology in ontologies:
+        for term_id, labels in ontology.items():
+            if term_id not in terms and labels:
+                terms[term_id] = list(labels)
+            for label in labels:
+                keywords.setdefault(label.lower(), term_id)
+    return terms, {k: v for k, v in keywords.items() if v in terms}
+
+
+def load_ontology_keywords(data_dir: str) -> Tuple[Dict, Dict]:
+    """
+    DO/HPO terms and keywords from the pickles and ontology files in data_dir,
+    the same ones the lexicon file and keyword matcher are built from
+    :param data_dir:
+    :return: id2kw, kw2id
+    """
+    with open(os.path.join(data_dir, 'id2kw_dict.pkl'), 'rb') as f:
+        id2kw = pickle.load(f)
+    with open(os.path.join(data_dir, 'kw2id_dict.pkl'), 'rb') as f:
+        kw2id = pickle.load(f)
+    ontologies = []
+    for ontology_file in ONTOLOGY_FILES:
+        with open(os.path.join(data_dir, ontology_file), 'r') as f:
+            ontologies.append(json.load(f))
+    return merge_ontologies(id2kw, kw2id, ontologies)
+
+
+def build_lexicon(id2kw: Dict, kw2id: Dict, ontologies: List, lexicon_file: str) -> None:
+    """
+    Write the DO/HPO lexicon as one read-only string table file.
+    Terms are sorted by ontology id and keywords by their utf-8 bytes so that
+    both can be binary searched in place.
+    :param id2kw: k=ontology id, v=list of keywords, main term first
+    :param kw2id: k=lowercased keyword, v=ontology id
+    :param ontologies: additional dicts of k=ontology id, v=list of labels
+        (doid.json, hp.json) for terms missing from id2kw
+    :param lexicon_file:
+    :return:
+    """
+    terms, keywords = merge_ontologies(id2kw, kw2id, ontologies)
+
+    term_ids = sorted(terms)
+    term_index = {t: i for i, t in enumerate(term_ids)}
+    synonyms = [s.encode('utf-8') for t in term_ids for s in terms[t]]
+    syn_start = np.concatenate([[0], np.cumsum([len(terms[t]) for t in term_ids])]).astype(np.uint32)
+
+    kw_items = sorted((k.encode('utf-8'), term_index[v]) for k, v in keywords.items())
+    kw_bytes = [k for k, _ in kw_items]
+    kw_term = np.array([t for _, t in kw_items], dtype=np.uint32)
+
+    id_bytes = [t.encode('utf-8') for t in term_ids]
+    blob = b''.join(id_bytes + synonyms + kw_bytes)
+    id_off = utf8_offsets(id_bytes)
+    syn_off = utf8_offsets(synonyms) + id_off[-1]
+    kw_off = utf8_offsets(kw_bytes) + syn_off[-1]
+
+    with open(lexicon_file, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(term_ids), len(synonyms), len(kw_bytes), len(blob)))
+        for arr in (id_off, syn_off, kw_off, syn_start, kw_term):
+            f.write(arr.tobytes())
+        f.write(blob)
+
+
+# class for DO/HPO keyword and term lookups served from a memory-mapped file
+class OntologyLexicon:
+    def __init__(self, lexicon_file: str):
+        """
+        Map lexicon file built by build_lexicon
+        :param lexicon_file:
+        """
+        self.lexicon_file = lexicon_file
+        with open(lexicon_file, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, n_terms, n_syn, n_kw, blob_size = HEADER.unpack_from(self._mm, 0)
+        assert magic == MAGIC, 'Not a PhenoX lexicon file: {}'.format(lexicon_file)
+        self.n_terms = n_terms
+        self.n_keywords = n_kw
+
+        # typed views straight onto the mapped pages, nothing is copied
+        view = memoryview(self._mm)
+        pos = HEADER.size
+        arrays = []
+        for fmt, count in (('Q', n_terms + 1), ('Q', n_syn + 1), ('Q', n_kw + 1),
+                           ('I', n_terms + 1), ('I', n_kw)):
+            size = struct.calcsize(fmt) * count
+            arrays.append(view[pos:pos + size].cast(fmt))
+            pos += size
+        self._id_off, self._syn_off, self._kw_off, self._syn_start, self._kw_term = arrays
+        self._blob_start = pos
+
+        self.kw2id = _KeywordView(self)
+        self.id2kw = _TermView(self)
+
+    def __reduce__(self):
+        # worker processes reopen the mapping instead of copying it
+        return self.__class__, (self.lexicon_file,)
+
+    def _string(self, offsets: memoryview, i: int) -> bytes:
+        return self._mm[self._blob_start + offsets[i]:self._blob_start + offsets[i + 1]]
+
+    def _search(self, offsets: memoryview, n: int, key: bytes) -> int:
+        """
+        Binary search a sorted string table, return index or -1
+        """
+        lo, hi = 0, n
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._string(offsets, mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < n and self._string(offsets, lo) == key:
+            return lo
+        return -1
+
+    def term_index(self, term_id: str) -> int:
+        return self._search(self._id_off, self.n_terms, term_id.encode('utf-8'))
+
+    def keyword_index(self, keyword: str) -> int:
+        return self._search(self._kw_off, self.n_keywords, keyword.encode('utf-8'))
+
+    def term_id(self, term_ind: int) -> str:
+        return self._string(self._id_off, term_ind).decode('utf-8')
+
+    def synonyms(self, term_ind: int) -> List:
+        return [self._string(self._syn_off, i).decode('utf-8')
+                for i in range(self._syn_start[term_ind], self._syn_start[term_ind + 1])]
+
+    def keyword(self, kw_ind: int) -> str:
+        return self._string(self._kw_off, kw_ind).decode('utf-8')
+
+
+class _KeywordView(Mapping):
+    """
+    Read-only kw2id dict: k=lowercased keyword, v=ontology id
+    """
+    def __init__(self, lexicon: OntologyLexicon):
+        self._lex = lexicon
+
+    def __getitem__(self, keyword):
+        ind = self._lex.keyword_index(keyword) if isinstance(keyword, str) else -1
+        if ind < 0:
+            raise KeyError(keyword)
+        return self._lex.term_id(self._lex._kw_term[ind])
+
+    def __iter__(self):
+        return (self._lex.keyword(i) for i in range(self._lex.n_keywords))
+
+    def __len__(self):
+        return self._lex.n_keywords
+
+
+class _TermView(Mapping):
+    """
+    Read-only id2kw dict: k=ontology id, v=list of keywords, main term first
+    """
+    def __init__(self, lexicon: OntologyLexicon):
+        self._lex = lexicon
+
+    def __getitem__(self, term_id):
+        ind = self._lex.term_index(term_id) if isinstance(term_id, str) else -1
+        if ind < 0:
+            raise KeyError(term_id)
+        return self._lex.synonyms(ind)
+
+    def __iter__(self):
+        return (self._lex.term_id(i) for i in range(self._lex.n_terms))
+
+    def __len__(self):
+        return self._lex.n_terms
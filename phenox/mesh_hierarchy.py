@@ -0,0 +1,185 @@
+import numpy as np
+from typing import List, Tuple
+
+
+def iter_mesh_bin(bin_file: str, tree_prefix='C'):
+    """
+    Stream MeSH descriptor records from an ASCII MeSH bin file
+    :param bin_file:
+    :param tree_prefix: only keep tree numbers in this branch (C = diseases)
+    :return: generator of (name, tree numbers, aliases)
+    """
+    name = None
+    ids = []
+    aliases = []
+    with open(bin_file, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('*NEWRECORD'):
+                if ids:
+                    yield name, ids, aliases
+                name = None
+                ids = []
+                aliases = []
+            # parse mesh id
+            elif line.startswith('MN = '):
+                tree_number = line.split('=')[1].strip()
+                if tree_number.startswith(tree_prefix):
+                    ids.append(tree_number)
+            # parse main heading
+            elif line.startswith('MH = '):
+                name = line.split('=')[1].strip()
+            # parse aliases
+            elif line.startswith('ENTRY = '):
+                aliases.append(line.split('=')[1].strip().split('|')[0].lower())
+    if ids:
+        yield name, ids, aliases
+
+
+# arrays persisted by MeshHierarchy.save
+ARRAYS = ('names', 'tree_numbers', 'tree_node', 'node_tree_ptr', 'node_trees',
+          'child_indptr', 'child_indices', 'parent_indptr', 'parent_indices')
+
+
+def _csr(edges: np.ndarray, n_nodes: int) -> Tuple:
+    """
+    CSR adjacency from an (n, 2) array of (source, target) node pairs
+    :param edges:
+    :param n_nodes:
+    :return: indptr, indices
+    """
+    edges = np.unique(edges, axis=0) if len(edges) else edges.reshape(0, 2)
+    indptr = np.zeros(n_nodes + 1, dtype=np.int32)
+    np.cumsum(np.bincount(edges[:, 0], minlength=n_nodes), out=indptr[1:])
+    return indptr, edges[:, 1].astype(np.int32)
+
+
+# class for MeSH descriptor hierarchy queries over tree numbers
+class MeshHierarchy:
+    def __init__(self, names: np.ndarray, tree_numbers: np.ndarray, tree_node: np.ndarray):
+        """
+        Index descriptors by integer node id
+        :param names: node id -> descriptor name
+        :param tree_numbers: sorted tree numbers
+        :param tree_node: tree number index -> node id
+        """
+        self.names = names
+        self.tree_numbers = tree_numbers
+        self.tree_node = tree_node
+
+        # node id -> indices into tree_numbers
+        self.node_tree_ptr = np.zeros(len(names) + 1, dtype=np.int32)
+        np.cumsum(np.bincount(tree_node, minlength=len(names)), out=self.node_tree_ptr[1:])
+        self.node_trees = np.argsort(tree_node, kind='stable').astype(np.int32)
+
+        # parent tree number of each tree number, '' at branch roots
+        parent_tn = np.array([t.rsplit('.', 1)[0] if '.' in t else '' for t in tree_numbers.tolist()])
+        pos = np.minimum(np.searchsorted(tree_numbers, parent_tn), len(tree_numbers) - 1)
+        has_parent = (parent_tn != '') & (tree_numbers[pos] == parent_tn)
+        edges = np.stack([tree_node[pos[has_parent]], tree_node[has_parent]], axis=1)
+
+        self.child_indptr, self.child_indices = _csr(edges, len(names))
+        self.parent_indptr, self.parent_indices = _csr(edges[:, ::-1], len(names))
+        self._name_to_node = None
+        # stamp of the file the index was built from, see MeshHierarchy.save
+        self.source = ''
+
+    @classmethod
+    def from_records(cls, records):
+        """
+        Build from (name, tree numbers, ...) records, e.g. iter_mesh_bin
+        :param records:
+        :return:
+        """
+        names = []
+        tree_numbers = []
+        tree_node = []
+        for record in records:
+            name, ids = record[0], record[1]
+            if not name:
+                continue
+            for tree_number in ids:
+                tree_numbers.append(tree_number)
+                tree_node.append(len(names))
+            names.append(name)
+
+        tree_numbers = np.array(tree_numbers)
+        order = np.argsort(tree_numbers, kind='stable')
+        return cls(np.array(names), tree_numbers[order], np.array(tree_node, dtype=np.int32)[order])
+
+    def save(self, index_file: str, source='') -> None:
+        """
+        Write index arrays as uncompressed npz
+        :param index_file:
+        :param source: stamp of the file the index was built from, kept so
+            a stale index can be told apart
+        :return:
+        """
+        self.source = source
+        np.savez(index_file, source=np.array(source), **{a: getattr(self, a) for a in ARRAYS})
+
+    @classmethod
+    def load(cls, index_file: str):
+        """
+        Load index written by save, without recomputing adjacency
+        :param index_file:
+        :return:
+        """
+        hierarchy = cls.__new__(cls)
+        with np.load(index_file, allow_pickle=False) as data:
+            for a in ARRAYS:
+                setattr(hierarchy, a, data[a])
+            hierarchy.source = str(data['source']) if 'source' in data.files else ''
+        hierarchy._name_to_node = None
+        return hierarchy
+
+    def node(self, name: str) -> int:
+        if self._name_to_node is None:
+            self._name_to_node = {n.lower(): i for i, n in enumerate(self.names.tolist())}
+        return self._name_to_node[name.lower()]
+
+    def node_tree_numbers(self, node: int) -> List:
+        return self.tree_numbers[self.node_trees[self.node_tree_ptr[node]:self.node_tree_ptr[node + 1]]].tolist()
+
+    def children(self, node: int) -> np.ndarray:
+        return self.child_indices[self.child_indptr[node]:self.child_indptr[node + 1]]
+
+    def parents(self, node: int) -> np.ndarray:
+        return self.parent_indices[self.parent_indptr[node]:self.parent_indptr[node + 1]]
+
+    def subtree(self, node: int) -> np.ndarray:
+        """
+        Node and all its descendants, found as tree number prefix ranges
+        :param node:
+        :return: sorted node ids
+        """
+        members = [np.array([node], dtype=np.int32)]
+        for tree_number in self.node_tree_numbers(node):
+            lo = np.searchsorted(self.tree_numbers, tree_number + '.')
+            hi = np.searchsorted(self.tree_numbers, tree_number + '/')
+            members.append(self.tree_node[lo:hi])
+        return np.unique(np.concatenate(members))
+
+    def descendants(self, node: int) -> np.ndarray:
+        subtree = self.subtree(node)
+        return subtree[subtree != node]
+
+    def ancestors(self, node: int) -> np.ndarray:
+        """
+        All nodes on the paths from the branch roots to this node
+        :param node:
+        :return: sorted node ids
+        """
+        prefixes = set()
+        for tree_number in self.node_tree_numbers(node):
+            parts = tree_number.split('.')
+            prefixes.update('.'.join(parts[:i]) for i in range(1, len(parts)))
+        if not prefixes:
+            return np.array([], dtype=np.int32)
+        prefixes = np.array(sorted(prefixes))
+        pos = np.minimum(np.searchsorted(self.tree_numbers, prefixes), len(self.tree_numbers) - 1)
+        found = self.tree_numbers[pos] == prefixes
+        return np.unique(self.tree_node[pos[found]])
+
+    def names_of(self, nodes) -> List:
+        return self.names[nodes].tolist()
@@ -1,27 +1,340 @@
 import os
 import sys
 import json
+import re
 import glob
-import difflib
+from collections import defaultdict
+from collections.abc import Mapping
+from typing import Dict, List, Tuple
+
+import numpy as np
 
 from phenox.paths import PhenoXPaths
+from phenox.lexicon import utf8_offsets
+from phenox.mesh_hierarchy import MeshHierarchy, iter_mesh_bin
+
+
+LOOKUP_POLICIES = ('interactive', 'best', 'fail', 'candidates')
+
+# layout of mesh_records.npz and mesh_trigrams.npz; older files are rebuilt
+NPZ_FORMAT = 2
+
+# string tables and arrays persisted by TrigramIndex.save
+TRIGRAM_TABLES = ('names', 'keys', 'grams')
+TRIGRAM_ARRAYS = ('rows', 'sizes', 'posting_ptr', 'posting_rows')
+
+# list fields of a MeSH record and their offset arrays in MeshRecords
+RECORD_LISTS = (('ids', 'id_ptr'), ('aliases', 'alias_ptr'), ('parents', 'parent_ptr'), ('children', 'child_ptr'))
+
+
+class MeshLookupError(LookupError):
+    """
+    Raised when a query does not resolve to a MeSH term
+    """
+    def __init__(self, query_text: str, candidates: List):
+        self.query_text = query_text
+        self.candidates = candidates
+        super().__init__('No exact MeSH match for "{}"; closest: {}'.format(
+            query_text, ', '.join(c['name'] for c in candidates) or 'none'
+        ))
+
+
+def normalize(text: str) -> str:
+    """
+    Lowercase, drop punctuation and sort words so that inverted
+    names like "cancer, breast" compare equal to "breast cancer"
+    :param text:
+    :return:
+    """
+    return ' '.join(sorted(re.findall(r'\w+', text.lower())))
+
+
+def trigrams(text: str) -> set:
+    """
+    Character trigrams of a padded, normalized string
+    :param text:
+    :return:
+    """
+    padded = '  {} '.format(normalize(text))
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def source_stamp(source_file: str) -> str:
+    """
+    Size and modification time of the file an index was built from, stored
+    with the index so a regenerated source is noticed
+    :param source_file:
+    :return:
+    """
+    stat = os.stat(source_file)
+    return '{}:{}'.format(stat.st_size, stat.st_mtime_ns)
+
+
+def _flatten(lists: List) -> Tuple:
+    """
+    Offsets and concatenated items of a list of lists
+    :param lists:
+    :return: indptr, items
+    """
+    indptr = np.zeros(len(lists) + 1, dtype=np.int32)
+    np.cumsum([len(items) for items in lists], out=indptr[1:])
+    return indptr, [item for items in lists for item in items]
+
+
+def _is_current(data) -> bool:
+    return 'format' in data.files and int(data['format']) == NPZ_FORMAT
+
+
+# class for a list of strings kept as one utf-8 blob with byte offsets
+class StringTable:
+    def __init__(self, offsets: np.ndarray, blob: bytes):
+        """
+        :param offsets: n + 1 byte offsets into blob, with a leading zero
+        :param blob: concatenated utf-8 strings
+        """
+        self.offsets = offsets
+        self.blob = blob
+        self._bounds = offsets.tolist()
+
+    @classmethod
+    def from_strings(cls, strings: List):
+        encoded = [s.encode('utf-8') for s in strings]
+        return cls(utf8_offsets(encoded), b''.join(encoded))
+
+    def arrays(self, name: str) -> Dict:
+        """
+        npz arrays of the table, the blob as name and the offsets as name_off
+        :param name:
+        :return:
+        """
+        return {name: np.frombuffer(self.blob, dtype=np.uint8), name + '_off': self.offsets}
+
+    @classmethod
+    def from_arrays(cls, data, name: str):
+        return cls(data[name + '_off'], data[name].tobytes())
+
+    def slice(self, start: int, stop: int) -> List:
+        bounds = self._bounds
+        return [self.blob[bounds[i]:bounds[i + 1]].decode('utf-8') for i in range(start, stop)]
+
+    def tolist(self) -> List:
+        return self.slice(0, len(self))
+
+    def __getitem__(self, i: int) -> str:
+        return self.blob[self._bounds[i]:self._bounds[i + 1]].decode('utf-8')
+
+    def __len__(self) -> int:
+        return len(self._bounds) - 1
+
+
+# class for MeSH records kept as string tables, read without parsing mesh.json
+class MeshRecords(Mapping):
+    def __init__(self, tables: Dict, ptrs: Dict, source=''):
+        """
+        Records by lowercased name, each built on access as the mesh.json
+        dict {ids, name, aliases, parents, children}
+        :param tables: StringTables of keys, names and the items of each list field
+        :param ptrs: per record offsets into the item table of each list field
+        :param source: source_stamp of the mesh.json the tables came from
+        """
+        self.tables = tables
+        self.ptrs = {ptr: indptr.tolist() for ptr, indptr in ptrs.items()}
+        self.source = source
+        self._row = {key: i for i, key in enumerate(tables['keys'].tolist())}
+
+    @classmethod
+    def from_dict(cls, mesh: Dict, source=''):
+        """
+        :param mesh: parsed mesh.json
+        :param source:
+        :return:
+        """
+        records = list(mesh.values())
+        tables = {'keys': StringTable.from_strings(list(mesh)),
+                  'names': StringTable.from_strings([r['name'] for r in records])}
+        ptrs = dict()
+        for field, ptr in RECORD_LISTS:
+            ptrs[ptr], items = _flatten([r[field] for r in records])
+            tables[field] = StringTable.from_strings(items)
+        return cls(tables, ptrs, source)
+
+    def save(self, records_file: str) -> None:
+        arrays = {ptr: np.array(indptr, dtype=np.int32) for ptr, indptr in self.ptrs.items()}
+        for name, table in self.tables.items():
+            arrays.update(table.arrays(name))
+        np.savez(records_file, format=np.array(NPZ_FORMAT), source=np.array(self.source), **arrays)
+
+    @classmethod
+    def load(cls, records_file: str):
+        """
+        :param records_file:
+        :return: records, None for a file of an older layout
+        """
+        with np.load(records_file, allow_pickle=False) as data:
+            if not _is_current(data):
+                return None
+            tables = {name: StringTable.from_arrays(data, name)
+                      for name in ['keys', 'names'] + [field for field, _ in RECORD_LISTS]}
+            ptrs = {ptr: data[ptr] for _, ptr in RECORD_LISTS}
+            return cls(tables, ptrs, str(data['source']))
+
+    def _items(self, field: str, ptr: str, i: int) -> List:
+        indptr = self.ptrs[ptr]
+        return self.tables[field].slice(indptr[i], indptr[i + 1])
+
+    def __getitem__(self, key: str) -> Dict:
+        i = self._row[key]
+        return {'ids': self._items('ids', 'id_ptr', i),
+                'name': self.tables['names'][i],
+                'aliases': self._items('aliases', 'alias_ptr', i),
+                'parents': self._items('parents', 'parent_ptr', i),
+                'children': self._items('children', 'child_ptr', i)}
+
+    def __contains__(self, key) -> bool:
+        return key in self._row
+
+    def __iter__(self):
+        return iter(self._row)
+
+    def __len__(self) -> int:
+        return len(self._row)
+
+
+# class for ranked fuzzy lookups over MeSH names and aliases
+class TrigramIndex:
+    def __init__(self, names: Dict):
+        """
+        Build inverted trigram index
+        :param names: k=lowercased name or alias, v=MeSH record key
+        """
+        key_row = dict()
+        for key in names.values():
+            key_row.setdefault(key, len(key_row))
+        self.names = StringTable.from_strings(list(names))
+        self.keys = StringTable.from_strings(list(key_row))
+        # record key of each name, as a row of keys
+        self.rows = np.array([key_row[key] for key in names.values()], dtype=np.int32)
+        postings = defaultdict(list)
+        sizes = []
+        for i, name in enumerate(names):
+            grams = trigrams(name)
+            sizes.append(len(grams))
+            for g in grams:
+                postings[g].append(i)
+        self.sizes = np.array(sizes, dtype=np.int32)
+        gram_list = sorted(postings)
+        self.grams = StringTable.from_strings(gram_list)
+        self.posting_ptr, rows = _flatten([postings[g] for g in gram_list])
+        self.posting_rows = np.array(rows, dtype=np.int32)
+        self.source = ''
+        self._gram_row = None
+
+    def save(self, index_file: str, source='') -> None:
+        """
+        Write the index as uncompressed npz
+        :param index_file:
+        :param source: source_stamp of the mesh.json the index was built from
+        :return:
+        """
+        self.source = source
+        arrays = {a: getattr(self, a) for a in TRIGRAM_ARRAYS}
+        for name in TRIGRAM_TABLES:
+            arrays.update(getattr(self, name).arrays(name))
+        np.savez(index_file, format=np.array(NPZ_FORMAT), source=np.array(source), **arrays)
+
+    @classmethod
+    def load(cls, index_file: str):
+        """
+        :param index_file:
+        :return: index, None for a file of an older layout
+        """
+        index = cls.__new__(cls)
+        with np.load(index_file, allow_pickle=False) as data:
+            if not _is_current(data):
+                return None
+            for a in TRIGRAM_ARRAYS:
+                setattr(index, a, data[a])
+            for name in TRIGRAM_TABLES:
+                setattr(index, name, StringTable.from_arrays(data, name))
+            index.source = str(data['source'])
+        index._gram_row = None
+        return index
+
+    def search(self, query: str, n=5, cutoff=0.3) -> List:
+        """
+        Rank names by trigram Jaccard similarity to the query
+        :param query:
+        :param n: max number of distinct records returned
+        :param cutoff: minimum similarity
+        :return: list of (record key, similarity, matched name)
+        """
+        if self._gram_row is None:
+            self._gram_row = {g: i for i, g in enumerate(self.grams.tolist())}
+        grams = trigrams(query)
+        rows = [self.posting_rows[self.posting_ptr[i]:self.posting_ptr[i + 1]]
+                for i in (self._gram_row.get(g) for g in grams) if i is not None]
+        if not rows:
+            return []
+        shared = np.bincount(np.concatenate(rows), minlength=len(self.names))
+        hits = np.flatnonzero(shared)
+        scores = shared[hits] / (len(grams) + self.sizes[hits] - shared[hits])
+
+        scored = [(score, self.names[i], self.keys[int(self.rows[i])])
+                  for i, score in zip(hits.tolist(), scores.tolist()) if score >= cutoff]
+        scored.sort(key=lambda x: (-x[0], x[1]))
+
+        ranked = []
+        seen = set()
+        for score, name, key in scored:
+            if key not in seen:
+                seen.add(key)
+                ranked.append((key, score, name))
+                if len(ranked) == n:
+                    break
+        return ranked
 
 
 class MeshSearcher:
-    def __init__(self, outprefix: str):
+    def __init__(self, outprefix: str, policy='interactive', data_dir=None):
         """
-        Initialize MeSH search tool
+        Initialize MeSH search tool. Records are read from the compact
+        mesh_records.npz; mesh.json is only parsed to (re)build it
+        :param outprefix:
+        :param policy: resolution of inexact queries, one of LOOKUP_POLICIES
+        :param data_dir: directory with mesh.json, the data directory by default
         """
-        paths = PhenoXPaths(outprefix)
-        mesh_json_path = os.path.join(paths.data_dir, 'mesh.json')
-        self.mesh = dict()
+        assert policy in LOOKUP_POLICIES
+        self.policy = policy
+        self._index = None
+        self._hierarchy = None
+        data_dir = data_dir or PhenoXPaths(outprefix).data_dir
+        self.mesh_json_path = os.path.join(data_dir, 'mesh.json')
+        self.records_file = os.path.join(data_dir, 'mesh_records.npz')
+        self.hierarchy_file = os.path.join(data_dir, 'mesh_hierarchy.npz')
+        self.index_file = os.path.join(data_dir, 'mesh_trigrams.npz')
 
-        if not os.path.exists(mesh_json_path):
-            mesh_bin_file = glob.glob(os.path.join(paths.data_dir, '*.bin'))
+        if not os.path.exists(self.mesh_json_path):
+            mesh_bin_file = glob.glob(os.path.join(data_dir, '*.bin'))
             if mesh_bin_file:
-                self._parse_mesh_bin(mesh_bin_file[0], mesh_json_path)
+                self._parse_mesh_bin(mesh_bin_file[0], self.mesh_json_path)
 
-        self.mesh = json.load(open(mesh_json_path, 'r'))
+        self.source = source_stamp(self.mesh_json_path)
+        self.mesh = self._load_records()
+
+    def _load_records(self) -> MeshRecords:
+        """
+        Records from mesh_records.npz, rebuilt from mesh.json when missing
+        or built from an older mesh.json
+        :return:
+        """
+        if os.path.exists(self.records_file):
+            records = MeshRecords.load(self.records_file)
+            if records is not None and records.source == self.source:
+                return records
+        with open(self.mesh_json_path, 'r') as f:
+            records = MeshRecords.from_dict(json.load(f), self.source)
+        records.save(self.records_file)
+        return records
 
     def _parse_mesh_bin(self, bin_file, json_file):
         """
@@ -30,114 +343,112 @@ class MeshSearcher:
         :param json_file:
         :return:
         """
+        mesh = dict()
 
-        def _chunks(filename, start):
-            """
-            Split file into chunks
-            :param filename:
-            :param start:
-            :return:
-            """
-            with open(filename, 'r') as f:
-                buffer = []
-                for line in f:
-                    if line.startswith(start):
-                        if buffer:
-                            yield buffer
-                            buffer = []
-                    else:
-                        buffer.append(line.strip())
+        # stream MeSH records; only disease tree numbers are kept
+        for name, ids, aliases in iter_mesh_bin(bin_file):
+            record = {'ids': ids,
+                      'name': name,
+                      'aliases': aliases,
+                      'parents': [],
+                      'children': []}
+            if name and name.lower() not in mesh:
+                mesh[name.lower()] = record
+            else:
+                sys.stdout.write('Duplicate name! %s\n' % name)
 
-        mesh = dict()
+        # get parent child relationships from the hierarchy index
+        hierarchy = MeshHierarchy.from_records((r['name'], r['ids']) for r in mesh.values())
+        for key, data in mesh.items():
+            node = hierarchy.node(key)
+            data['parents'] = [n.lower() for n in hierarchy.names_of(hierarchy.parents(node))]
+            data['children'] = [n.lower() for n in hierarchy.names_of(hierarchy.children(node))]
 
-        # iterate through each chunk and parse MeSH record
-        for c in _chunks(bin_file, '*NEWRECORD'):
-            name = None
-            ids = []
-            aliases = []
-
-            for l in c:
-                # parse mesh id
-                if l.startswith('MN = '):
-                    id = l.split('=')[1].strip()
-                    if id.startswith('C'):
-                        ids.append(id)
-                # parse main heading
-                elif l.startswith('MH = '):
-                    name = l.split('=')[1].strip()
-                # parse aliases
-                elif l.startswith('ENTRY = '):
-                    aliases.append(l.split('=')[1].strip().split('|')[0].lower())
-
-            # if disease ID, create a record
-            if ids:
-                record = {'ids': ids,
-                          'name': name,
-                          'aliases': aliases,
-                          'parents': [],
-                          'children': []}
-                if name and name.lower() not in mesh:
-                    mesh[name.lower()] = record
-                else:
-                    sys.stdout.write('Duplicate name! %s\n' % name)
-
-        # create MeSH id to MeSH MH dictionary
-        id_to_name_dict = dict()
-
-        for name, data in mesh.items():
-            for id in data['ids']:
-                id_to_name_dict[id] = name
-
-        # get parent child relationships and add back into MeSH tree
-        par_map = list()
-
-        for name, data in mesh.items():
-            for id in data['ids']:
-                par_id = '.'.join(id.split('.')[:-1])
-                if par_id and name:
-                    par_map.append((name, id_to_name_dict[par_id]))
-
-        for ent, par in par_map:
-            mesh[ent]['parents'].append(par)
-            mesh[par]['children'].append(ent)
-
-        json.dump(mesh, open(json_file, 'w'))
+        with open(json_file, 'w') as f:
+            json.dump(mesh, f)
+        hierarchy.save(self.hierarchy_file, source=source_stamp(json_file))
 
         return
 
-    def lookup(self, query_text):
+    @property
+    def hierarchy(self) -> MeshHierarchy:
         """
-        Find closest MeSH term
-        :param query_text:
+        Tree number hierarchy index, rebuilt from the records when missing
+        or built from an older mesh.json
         :return:
         """
-        query = query_text.lower()
-        if query in self.mesh.keys():
-            return self.mesh[query]
-        else:
-            closest = difflib.get_close_matches(query, self.mesh.keys())
-            print('Did you mean?')
-            for ind, match in enumerate(closest):
-                print('%i) %s' % (ind + 1, self.mesh[match]['name']))
-            selection = input()
-            try:
-                if int(selection) <= len(closest):
-                    return self.mesh[closest[0]]
-                else:
-                    sys.stdout.write('Not a known selection, exiting...\n')
-                    sys.exit(0)
-            except Exception:
-                sys.stdout.write('Unknown exception, exiting...\n')
-                sys.exit(0)
-
-
-
-
-
-
+        if self._hierarchy is None:
+            if os.path.exists(self.hierarchy_file):
+                self._hierarchy = MeshHierarchy.load(self.hierarchy_file)
+            if self._hierarchy is None or self._hierarchy.source != self.source:
+                self._hierarchy = MeshHierarchy.from_records(
+                    (r['name'], r['ids']) for r in self.mesh.values()
+                )
+                self._hierarchy.save(self.hierarchy_file, source=self.source)
+        return self._hierarchy
 
+    @property
+    def index(self) -> TrigramIndex:
+        """
+        Trigram index over MeSH names and aliases, loaded from disk and
+        rebuilt from the records when missing or built from an older mesh.json
+        :return:
+        """
+        if self._index is None:
+            if os.path.exists(self.index_file):
+                self._index = TrigramIndex.load(self.index_file)
+            if self._index is None or self._index.source != self.source:
+                names = dict()
+                for key, record in self.mesh.items():
+                    for alias in record['aliases']:
+                        names.setdefault(alias, key)
+                for key in self.mesh:
+                    names[key] = key
+                self._index = TrigramIndex(names)
+                self._index.save(self.index_file, source=self.source)
+        return self._index
 
+    def candidates(self, query_text, n=5) -> List:
+        """
+        Ranked MeSH records closest to the query
+        :param query_text:
+        :param n:
+        :return:
+        """
+        return [self.mesh[key] for key, _, _ in self.index.search(query_text, n=n)]
 
+    def lookup(self, query_text, policy=None):
+        """
+        Find closest MeSH term
+        :param query_text:
+        :param policy: overrides the searcher policy for this query;
+            interactive prompts on stdin, best takes the top candidate,
+            fail raises MeshLookupError, candidates returns the ranked list
+        :return:
+        """
+        policy = policy or self.policy
+        query = query_text.lower()
+        if query in self.mesh:
+            return [self.mesh[query]] if policy == 'candidates' else self.mesh[query]
 
+        closest = self.candidates(query)
+        # an exact alias hit is as good as a name hit
+        if closest and query in closest[0]['aliases']:
+            return closest if policy == 'candidates' else closest[0]
 
+        if policy == 'candidates':
+            return closest
+        if policy == 'best' and closest:
+            sys.stdout.write('Using closest MeSH term: %s\n' % closest[0]['name'])
+            return closest[0]
+        if policy in ('best', 'fail') or not closest or not sys.stdin.isatty():
+            raise MeshLookupError(query_text, closest)
 
+        print('Did you mean?')
+        for ind, match in enumerate(closest):
+            print('%i) %s' % (ind + 1, match['name']))
+        selection = input()
+        if selection.strip().isdigit() and 1 <= int(selection) <= len(closest):
+            return closest[int(selection) - 1]
+        sys.stdout.write('Not a known selection\n')
+        raise MeshLookupError(query_text, closest)
@@ -0,0 +1,119 @@
+import json
+import time
+import resource
+import threading
+import contextlib
+from collections import OrderedDict, defaultdict
+from typing import Dict
+
+import numpy as np
+
+
+def cpu_time() -> float:
+    """
+    CPU seconds of this process and its finished child processes
+    :return:
+    """
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return time.process_time() + children.ru_utime + children.ru_stime
+
+
+# class for collecting timings and counters of one PhenoX run
+class RunMetrics:
+    def __init__(self, trace_file=None, **run_info):
+        """
+        Every measurement is appended to trace_file as a JSON line when it
+        is taken, and aggregated for summary()
+        :param trace_file: JSON lines file, or None to only aggregate
+        :param run_info: fields of the run_start event, e.g. the query
+        """
+        self.trace_file = trace_file
+        self.stages = OrderedDict()
+        self.values = OrderedDict()
+        self.endpoints = defaultdict(lambda: {'requests': 0, 'errors': 0, 'retries': 0, 'bytes': 0,
+                                              'latencies': []})
+        self._lock = threading.Lock()
+        self.emit('run_start', **run_info)
+
+    def emit(self, event: str, **fields) -> None:
+        if self.trace_file is None:
+            return
+        line = json.dumps(dict(event=event, time=round(time.time(), 3), **fields), default=str) + '\n'
+        with self._lock, open(self.trace_file, 'a') as f:
+            f.write(line)
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        """
+        Time a pipeline stage
+        :param name:
+        :return: dict the stage may add fields to
+        """
+        info = dict()
+        cpu_start = cpu_time()
+        start = time.perf_counter()
+        try:
+            yield info
+        finally:
+            info.update(seconds=round(time.perf_counter() - start, 4),
+                        cpu_seconds=round(cpu_time() - cpu_start, 4))
+            self.stages[name] = info
+            self.emit('stage', stage=name, **info)
+
+    def request(self, endpoint: str, seconds: float, nbytes: int, status=200) -> None:
+        """
+        Count one E-utilities request
+        :param endpoint: e.g. efetch
+        :param seconds: latency
+        :param nbytes: response size
+        :param status: HTTP status
+        :return:
+        """
+        with self._lock:
+            stats = self.endpoints[endpoint]
+            stats['requests'] += 1
+            stats['errors'] += status >= 400
+            stats['bytes'] += nbytes
+            stats['latencies'].append(seconds)
+        self.emit('request', endpoint=endpoint, seconds=round(seconds, 4), bytes=nbytes, status=status)
+
+    def retry(self, endpoint: str, reason) -> None:
+        with self._lock:
+            self.endpoints[endpoint]['retries'] += 1
+        self.emit('retry', endpoint=endpoint, reason=str(reason))
+
+    def record(self, name: str, **values) -> None:
+        """
+        Record measurements such as counts, shapes or timings of a step
+        :param name:
+        :param values:
+        :return:
+        """
+        self.values[name] = values
+        self.emit(name, **values)
+
+    def summary(self) -> Dict:
+        """
+        Aggregated metrics: stage times, per endpoint request statistics and
+        recorded values
+        :return:
+        """
+        endpoints = dict()
+        for endpoint, stats in sorted(self.endpoints.items()):
+            latencies = np.array(stats['latencies'])
+            endpoints[endpoint] = {k: v for k, v in stats.items() if k != 'latencies'}
+            if len(latencies):
+                endpoints[endpoint].update(
+                    seconds=round(float(latencies.sum()), 4),
+                    latency_mean=round(float(latencies.mean()), 4),
+                    latency_p50=round(float(np.percentile(latencies, 50)), 4),
+                    latency_p95=round(float(np.percentile(latencies, 95)), 4),
+                    latency_max=round(float(latencies.max()), 4),
+                )
+        return {'stages': dict(self.stages), 'endpoints': endpoints, 'values': dict(self.values)}
+
+    def write_summary(self, summary_file: str) -> None:
+        summary = self.summary()
+        self.emit('run_end', **summary)
+        with open(summary_file, 'w') as f:
+            json.dump(summary, f, indent=2, default=str)
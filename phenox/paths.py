@@ -10,4 +10,5 @@ class PhenoXPaths:
         self.src_dir = os.path.join(self.base_dir, 'phenox')
         self.test_dir = os.path.join(self.base_dir, 'tests')
         self.output_dir = os.path.join(self.base_dir, 'output')
+        self.cache_dir = os.path.join(self.base_dir, 'cache')
         self.outprefix = outprefix
\ No newline at end of file
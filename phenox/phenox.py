@@ -1,6 +1,7 @@
 import os
 import sys
 import math
+import logging
 import tqdm
 from typing import List, Dict, Tuple
 import matplotlib.pyplot as plt
@@ -13,42 +14,197 @@ from phenox.geo_data import GEOQuery
 from phenox.pubmed import Pubmed
 from phenox.wordcloud import WordcloudPlotter
 from phenox.batcheffect import BatchEffect
+from phenox.entrez_cache import EntrezCache
+from phenox.eutils_client import AsyncEntrez
+from phenox.checkpoint import RunCheckpoints, params_key
+from phenox.metrics import RunMetrics
+from phenox.transport import MeteredTransport, RecordingTransport, ReplayTransport
+from phenox.retry import RetryPolicy
 import phenox.utils.base_utils as base_utils
 
+# class holding resources that are expensive to load and shared across queries
+class PhenoXResources:
+    def __init__(self, email: str, outprefix: str, cache_mode='readwrite', cache_size=2048,
+                 ner_processes=1, request_rate=None, transport=None) -> None:
+        """
+        Entrez cache and client, MeSH index and NER lexicon, loaded on first
+        use and reused by every PhenoX query given this object
+        :param email:
+        :param outprefix:
+        :param cache_mode: Entrez cache mode (readwrite, readonly, offline) or off;
+            always off when recording or replaying
+        :param cache_size: Entrez cache size bound in MB
+        :param ner_processes: worker processes for abstract NER
+        :param request_rate: NCBI requests per second for this process, defaults
+            to NCBI's limit; lower it when several processes share the limit
+        :param transport: phenox.transport.Transport for recording, replaying
+            or redirecting E-utilities requests, None for live NCBI requests
+        """
+        self.paths = PhenoXPaths(outprefix)
+        self.email = email
+        # the wordcloud render cache follows the requested mode even while recording
+        self.cache_mode = cache_mode
+        self.ner_processes = ner_processes
+        self.request_rate = request_rate
+        # every E-utilities request is measured into the metrics of the current run
+        self.transport = MeteredTransport(transport)
+        # one backoff policy and circuit breaker for all requests of the process
+        self.retry = RetryPolicy()
+        self._mesh = None
+        self._pubmed = None
+
+        # archived responses must not reach the live cache, and every request
+        # must reach the archive for recording and for replayed delays and errors
+        if isinstance(transport, (RecordingTransport, ReplayTransport)) and cache_mode != 'off':
+            logging.info('Entrez cache is off while recording or replaying')
+            cache_mode = 'off'
+
+        self.cache = None
+        if cache_mode != 'off':
+            os.makedirs(self.paths.cache_dir, exist_ok=True)
+            self.cache = EntrezCache(
+                os.path.join(self.paths.cache_dir, 'entrez.sqlite'),
+                max_bytes=cache_size * 1024 ** 2, mode=cache_mode
+            )
+        self.eutils = AsyncEntrez(cache=self.cache, rate=request_rate, transport=self.transport)
+
+    @property
+    def mesh(self) -> MeshSearcher:
+        if self._mesh is None:
+            self._mesh = MeshSearcher(self.paths.outprefix)
+        return self._mesh
+
+    @property
+    def pubmed(self) -> Pubmed:
+        if self._pubmed is None:
+            self._pubmed = Pubmed(self.email, self.paths.outprefix, cache=self.cache,
+                                  ner_processes=self.ner_processes, transport=self.transport,
+                                  retry=self.retry)
+            if self.request_rate:
+                self._pubmed.request_interval = 1. / self.request_rate
+        return self._pubmed
+
+    def reset(self) -> None:
+        """
+        Clear per-query state before a run; batch workers and the job
+        server reuse these resources for every query
+        :return:
+        """
+        if self._pubmed is not None:
+            self._pubmed.reset()
+
+    def warm(self, cluster_engine='pvclust') -> None:
+        """
+        Load everything up front: MeSH indexes, NER lexicon and matcher,
+        and the R runtime when clustering with pvclust
+        :param cluster_engine:
+        :return:
+        """
+        self.mesh.hierarchy
+        self.mesh.index
+        self.pubmed
+        if cluster_engine == 'pvclust':
+            try:
+                import rpy2.robjects
+                from rpy2.robjects.packages import importr
+                importr('pvclust')
+            except Exception as err:
+                logging.warning('Could not start R for pvclust: {}'.format(err))
+
+
 # class for linking differential gene expression to disease
 class PhenoX:
-    def __init__(self, email: str, query_str: str, outprefix: str) -> None:
+    def __init__(self, email: str, query_str: str, outprefix: str,
+                 cache_mode='readwrite', cache_size=2048, ner_processes=1,
+                 mesh_policy='interactive', cluster_engine='pvclust', nboot=5000,
+                 cluster_jobs=None, nboot_tol=None, wordcloud_pngs=False,
+                 resume=False, from_stage=None, resources=None, transport=None) -> None:
         """
         Initialize class
         :param gene_list:
+        :param cache_mode: Entrez cache mode (readwrite, readonly, offline) or off
+        :param cache_size: Entrez cache size bound in MB
+        :param ner_processes: worker processes for abstract NER
+        :param mesh_policy: resolution of inexact MeSH queries (interactive, best, fail)
+        :param cluster_engine: pvclust (R) or python multiscale bootstrap
+        :param nboot: bootstrap replicates per scale
+        :param cluster_jobs: worker processes for clustering
+        :param nboot_tol: AU tolerance for adaptive pvclust replicate counts
+        :param wordcloud_pngs: also write one wordcloud PNG per cluster
+        :param resume: skip stages with a valid checkpoint in the run directory
+        :param from_stage: recompute this stage and all later ones
+        :param resources: PhenoXResources shared with other queries, cache_mode,
+            cache_size, ner_processes and transport are ignored when given
+        :param transport: phenox.transport.Transport for E-utilities requests
         """
         self.paths = PhenoXPaths(outprefix)
         self.query_str = query_str
         self.email = email
+        self.ner_processes = ner_processes
+        self.mesh_policy = mesh_policy
+        self.cluster_engine = cluster_engine
+        self.nboot = nboot
+        self.cluster_jobs = cluster_jobs
+        self.nboot_tol = nboot_tol
+        self.wordcloud_pngs = wordcloud_pngs
+        self.resume = resume
+        self.from_stage = from_stage
+        self.run_dir = os.path.join(
+            self.paths.output_dir, 'runs',
+            '{}_{}'.format(self.paths.outprefix, params_key(query_str)[:16])
+        )
+
+        self.resources = resources or PhenoXResources(
+            email, outprefix, cache_mode=cache_mode, cache_size=cache_size, ner_processes=ner_processes,
+            transport=transport
+        )
+        self.cache = self.resources.cache
+        self.eutils = self.resources.eutils
+        self.metrics = None
+        self.metrics_file = os.path.join(self.run_dir, 'metrics.jsonl')
+        self.metrics_summary_file = os.path.join(self.run_dir, 'metrics_summary.json')
 
     def _get_best_mesh_term(self) -> Tuple:
         """
         Retrieve the best MeSH term from search query
         :return:
         """
-        mesh = MeshSearcher(self.paths.outprefix)
-        mesh_entry = mesh.lookup(self.query_str)
-        return mesh_entry, [mesh.mesh[c]['name'] for c in mesh_entry['children']]
+        mesh = self.resources.mesh
+        mesh_entry = mesh.lookup(self.query_str, policy=self.mesh_policy)
+        hierarchy = mesh.hierarchy
+        children = hierarchy.children(hierarchy.node(mesh_entry['name']))
+        return mesh_entry, hierarchy.names_of(children)
+
+    def _get_geo_query(self, mesh_term: str) -> GEOQuery:
+        return GEOQuery(outprefix=self.paths.outprefix, term=mesh_term, email=self.email, cache=self.cache,
+                        cluster_engine=self.cluster_engine, nboot=self.nboot, cluster_jobs=self.cluster_jobs,
+                        nboot_tol=self.nboot_tol, eutils=self.eutils, transport=self.resources.transport,
+                        metrics=self.metrics, retry=self.resources.retry)
+
+    def _get_pubmed(self) -> Pubmed:
+        pubmed = self.resources.pubmed
+        pubmed.metrics = self.metrics
+        return pubmed
 
-    def _get_geo_datasets(self, mesh_term: str) -> Tuple:
+    def _get_geo_datasets(self, geo: GEOQuery, mesh_term: str) -> Tuple:
         """
         Given a MeSH term, fetch GEO datasets and corresponding PubMed IDs
+        :param geo: GEOQuery class used for querying
         :param mesh_term:
         :return:
         """
         sys.stdout.write("Retrieving matching GEO datasets...\n")
-        geo = GEOQuery(outprefix=self.paths.outprefix, term=mesh_term, email=self.email)
-        pubmed_dict, gds_dict, cluster_dict, meta_dict = geo.get_all_geo_data(mesh_term)
-        
-        # geo clustering batch effect checking
+        return geo.retrieve_geo_data(mesh_term)
+
+    def _batch_effect(self, cluster_dict: Dict, meta_dict: Dict) -> None:
+        """
+        Geo clustering batch effect checking
+        :param cluster_dict: key=cluster_ids, value=list of GDS ids
+        :param meta_dict: key=gds_ids, value=list of gds metrics (n_samples, dates, GPLs)
+        :return:
+        """
         batch = BatchEffect(cluster_dict, meta_dict, self.paths.outprefix)
         batch.cluster_stats()
-        return geo, pubmed_dict, gds_dict, cluster_dict
 
     def _fetch_pubmed_abstracts(
             self,
@@ -59,13 +215,14 @@ class PhenoX:
             cluster_dict: Dict
         ) -> Dict:
         """
-        Retrieve Pubmed abstracts from list of Pubmed IDs in the GEO data dict
+        Collect PubMed IDs per cluster, from the GEO data dict and from
+        searches on the cluster's gene names
         :param geo: GEOQuery class used for querying
         :param mesh_term: string from mesh_lookup
         :param pubmed_dict: key=cluster_ids, value=list of pubmed ids
         :param gds_dict: k=gds_id, v={k=geneName, v=gene freq}
         :param cluster_dict: key=cluster_ids, value=list of GDS ids
-        :return:
+        :return: key=cluster_ids, value=list of pubmed ids
         """
 
         # function to map GDS ids to a set of geneNames
@@ -81,7 +238,7 @@ class PhenoX:
         sys.stdout.write("Retrieving matching PubMed abstracts...\n")
 
         # initialize pubmed clusters
-        pubmed = Pubmed(self.email, self.paths.outprefix)
+        pubmed = self._get_pubmed()
         pubmed_ids = pubmed.get_clusters(pubmed_dict, cluster_dict)
 
         sys.stdout.write("Retrieving matching PubMed abstracts for genes...\n")
@@ -92,22 +249,31 @@ class PhenoX:
             # k: map_gid_to_gname(map_gds_to_gid(gds_list)) for k, gds_list in cluster_dict.items()
         }
 
-        for clust, gene_names in cluster_to_gene_name.items():
-            query_terms = pubmed.construct_query_terms(mesh_term['name'], gene_names)
-            pubmed_clust = []
-            sys.stdout.write('Querying PubMed for genes from {}\n'.format(clust))
-            for query_term in tqdm.tqdm(query_terms, desc='PubMed batches'):
-                pubmed_clust += geo.get_ncbi_docsum(mesh_term['name'], "pubmed", query_term)
-            ids_to_add = base_utils.flatten(pubmed_clust)
-            ids_to_add = [entry['Id'] for entry in ids_to_add]
-            pubmed_ids[clust] += ids_to_add
+        # search each gene once, across clusters, and map hits back to clusters
+        plan = pubmed.plan_gene_queries(mesh_term['name'], cluster_to_gene_name)
+        sys.stdout.write('Querying PubMed with {} gene searches over {} clusters\n'
+                         .format(len(plan), len(cluster_to_gene_name)))
+        results = geo.search_ids(mesh_term['name'], "pubmed", [q for q, _ in plan])
+        for (_, clusters), ids_to_add in zip(plan, results):
+            for clust in clusters:
+                pubmed_ids[clust] += ids_to_add
+        pubmed_ids = {k: list(dict.fromkeys(v)) for k, v in pubmed_ids.items()}
+        if self.metrics is not None:
+            self.metrics.record('pubmed_ids', clusters=len(pubmed_ids), gene_searches=len(plan),
+                                pmids=len(set(base_utils.flatten(pubmed_ids.values()))))
 
-        # perform wordcloud NER
-        wordcloud_data = dict()
+        return pubmed_ids
 
-        for cluster_name, cluster_ids in pubmed_ids.items():
-            term_freq = pubmed.get_term_frequencies(cluster_ids)
-            wordcloud_data[cluster_name] = term_freq
+    def _extract_terms(self, pubmed_ids: Dict) -> Dict:
+        """
+        NER and count term frequency in pubmed clusters
+        :param pubmed_ids: key=cluster_ids, value=list of pubmed ids
+        :return: key=cluster_ids, value=Counter of terms
+        """
+        pubmed = self._get_pubmed()
+
+        # perform wordcloud NER once per unique pmid, then count per cluster
+        wordcloud_data = pubmed.get_cluster_term_frequencies(pubmed_ids)
 
         return wordcloud_data
 
@@ -119,14 +285,14 @@ class PhenoX:
         """
         output_file = os.path.join(
             self.paths.output_dir,
-            '{}_GDS_wordcloud.png'.format(self.query_str.replace(' ', '-'))
+            '{}_{}_GDS_wordcloud.png'.format(self.paths.outprefix, self.query_str.replace(' ', '-'))
         )
-        plotter = WordcloudPlotter(self.paths.outprefix)
-        plotter.generate_wordclouds(clusters, output_file)
+        plotter = WordcloudPlotter(self.paths.outprefix, cache_mode=self.resources.cache_mode)
+        plotter.generate_wordclouds(clusters, output_file, cluster_files=self.wordcloud_pngs)
 
         wc_text_file = os.path.join(
             self.paths.output_dir,
-            '{}_term_frequencies.txt'.format(self.query_str.replace(' ', '-'))
+            '{}_{}_term_frequencies.txt'.format(self.paths.outprefix, self.query_str.replace(' ', '-'))
         )
         with open(wc_text_file, 'w') as outf:
             for cluster_name, cluster_content in clusters.items():
@@ -138,22 +304,56 @@ class PhenoX:
 
     def subtype(self):
         """
-        Run pipeline
+        Run pipeline, checkpointing each stage in the run directory and
+        tracing stage times, NCBI requests and stage measurements to
+        metrics.jsonl, summarized in metrics_summary.json
+        :return:
+        """
+        os.makedirs(self.run_dir, exist_ok=True)
+        self.resources.reset()
+        self.metrics = RunMetrics(self.metrics_file, query=self.query_str, outprefix=self.paths.outprefix,
+                                  cluster_engine=self.cluster_engine, nboot=self.nboot)
+        self.resources.transport.metrics = self.metrics
+        try:
+            self._run_stages()
+        finally:
+            self.resources.transport.metrics = None
+            self.metrics.write_summary(self.metrics_summary_file)
+            logging.info('Run metrics written to {}'.format(self.metrics_summary_file))
+
+    def _run_stages(self):
+        """
+        Run the pipeline stages through their checkpoints
         :return:
         """
+        checkpoints = RunCheckpoints(self.run_dir, resume=self.resume, from_stage=self.from_stage,
+                                     metrics=self.metrics)
+
         # get best mesh term from user query
-        mesh_term, mesh_children = self._get_best_mesh_term()
+        mesh_term, mesh_children = checkpoints.run(
+            'mesh', {'query': self.query_str, 'policy': self.mesh_policy}, self._get_best_mesh_term
+        )
+        geo = self._get_geo_query(mesh_term['name'])
 
         # retrieve GEO datasets, generate clusters, visualize in R,
-        # and output clustered pubmed abstracts
-        geo, pubmed_dict, gds_dict, cluster_dict = self._get_geo_datasets(
-            mesh_term['name']
+        # and check clusters for batch effects
+        pubmed_dict, gds_dict, meta_dict = checkpoints.run(
+            'geo', {}, lambda: self._get_geo_datasets(geo, mesh_term['name'])
+        )
+        cluster_dict = checkpoints.run(
+            'cluster', {'engine': self.cluster_engine, 'nboot': self.nboot, 'nboot_tol': self.nboot_tol},
+            lambda: geo.cluster_geo_data(gds_dict)
         )
+        checkpoints.run('batch', {}, lambda: self._batch_effect(cluster_dict, meta_dict))
 
-        # NER and count term frequency in pubmed clusters
-        term_frequency = self._fetch_pubmed_abstracts(
-            geo, mesh_term, pubmed_dict, gds_dict, cluster_dict
+        # clustered pubmed abstracts, NER and count term frequency
+        pubmed_ids = checkpoints.run(
+            'pubmed', {}, lambda: self._fetch_pubmed_abstracts(
+                geo, mesh_term, pubmed_dict, gds_dict, cluster_dict
+            )
         )
+        term_frequency = checkpoints.run('ner', {}, lambda: self._extract_terms(pubmed_ids))
 
         # visualize everything
-        self._visualize(term_frequency)
+        checkpoints.run('visualize', {'wordcloud_pngs': self.wordcloud_pngs},
+                        lambda: self._visualize(term_frequency))
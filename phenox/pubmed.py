@@ -6,24 +6,115 @@ Created on Wed Jul 11 15:34:02 2018
 """
 
 import sys
+import time
 import tqdm
+import threading
 import Bio.Entrez as Entrez
-import spacy
 import os
 import json
-import pickle
-from spacy_lookup import Entity
-from collections import Counter
+import logging
+import multiprocessing
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict, Tuple
 
 from phenox.paths import PhenoXPaths
+from phenox.entrez_cache import entrez_request
+from phenox.retry import NCBIUnavailableError, RetryPolicy
+from phenox.keyword_matcher import KeywordMatcher, ontology_matcher
+from phenox.lexicon import OntologyLexicon, load_ontology_keywords
+
+
+# keyword matcher shared with NER worker processes
+_worker_matcher = None
+
+
+def _init_ner_worker(matcher: KeywordMatcher) -> None:
+    global _worker_matcher
+    _worker_matcher = matcher
+
+
+def _match_DNER(matcher: KeywordMatcher, abstract_text: str) -> Tuple:
+    """
+    Match DO/HPO keywords in abstract text
+    :param matcher:
+    :param abstract_text:
+    :return: Counter of entity text, list of main DO/HPO terms
+    """
+    kw = []
+    dner = []
+    for ent_text, _, main_term in matcher.find(abstract_text):
+        kw.append(ent_text)
+        dner.append(main_term)
+    return Counter(kw), dner
+
+
+def _ner_worker(pmid_text: Tuple) -> Tuple:
+    pmid, abstract_text = pmid_text
+    return pmid, _match_DNER(_worker_matcher, abstract_text)
 
 
 # class for retrieving pubmed abstracts and finding disease/phenotype entities
 class Pubmed:
-    def __init__(self, email: str, outprefix: str):
+    def __init__(self, email: str, outprefix: str, efetch_batch=200, max_workers=3, cache=None,
+                 ner_batch_size=256, ner_processes=1, transport=None, metrics=None, retry=None,
+                 lexicon=None, matcher=None):
+        """
+        Initialize class
+        :param lexicon: prebuilt (id2kw, kw2id) DO/HPO dicts, read from the data
+            directory by default
+        :param matcher: prebuilt KeywordMatcher, loaded from the data directory
+            or built from the lexicon by default
+        """
         Entrez.email = email
         self.paths = PhenoXPaths(outprefix)
+        self.cache = cache
+        self.transport = transport
+        # metrics.RunMetrics of the current run, or None
+        self.metrics = metrics
+        self.retry = retry or RetryPolicy()
+        self.efetch_batch = efetch_batch
+        self.max_workers = max_workers
+        self.ner_batch_size = ner_batch_size
+        self.ner_processes = ner_processes
+        # NCBI allows 3 requests/sec without an API key, 10 with one
+        self.request_interval = 1. / (10 if Entrez.api_key else 3)
+        self._request_lock = threading.Lock()
+        self._last_request = 0.
+        self.reset()
+
+        # memory-mapped DO/HPO lexicon, see scripts/build_lexicon.py
+        lexicon_file = os.path.join(self.paths.data_dir, 'ontology_lexicon.bin')
+        if lexicon is not None:
+            self.id2kw, self.kw2id = lexicon
+        elif os.path.exists(lexicon_file):
+            lexicon = OntologyLexicon(lexicon_file)
+            self.id2kw, self.kw2id = lexicon.id2kw, lexicon.kw2id
+        else:
+            logging.warning('No ontology lexicon at {}, loading pickles'.format(lexicon_file))
+            self.id2kw, self.kw2id = load_ontology_keywords(self.paths.data_dir)
+
+        # prebuilt DO/HPO keyword automaton, see scripts/build_keyword_matcher.py
+        matcher_file = os.path.join(self.paths.data_dir, 'keyword_matcher.pkl')
+        if matcher is not None:
+            self.matcher = matcher
+        elif os.path.exists(matcher_file):
+            self.matcher = KeywordMatcher.load(matcher_file)
+        else:
+            logging.warning('No prebuilt keyword matcher at {}, building one'.format(matcher_file))
+            self.matcher = ontology_matcher(self.kw2id, self.id2kw)
+
+        # read synonyms from HGNC
+        with open(os.path.join(self.paths.data_dir, 'hgnc_synonyms.json'), 'r') as f:
+            hgnc_syn = f.read()
+            self.hgnc = json.loads(hgnc_syn)
+        
+    def reset(self) -> None:
+        """
+        Drop the abstracts, entities and counts of earlier runs, so an
+        instance shared by many queries does not grow or mix their counts
+        :return:
+        """
         self.pmid_abstracts = dict()
         # disease and human phenotype NER
         self.pmid_dner = {}
@@ -32,17 +123,46 @@ class Pubmed:
         self.dner_cluster = {}
         self.total_dner = []
 
-        self.nlp = spacy.load('en')
-        self.id2kw = pickle.load(open(os.path.join(self.paths.data_dir, 'id2kw_dict.pkl'), 'rb'))
-        self.kw2id = pickle.load(open(os.path.join(self.paths.data_dir, 'kw2id_dict.pkl'), 'rb'))
-        entity = Entity(keywords_list=list(self.kw2id.keys()), label='DO/HPO')
-        self.nlp.add_pipe(entity, last=True)
+    @staticmethod
+    def _parse_article(article) -> str:
+        """
+        Join abstract text, title and keywords of a single PubmedArticle record
+        :param article:
+        :return:
+        """
+        abs_str = []
+        # abstract text
+        try:
+            abstract = article['MedlineCitation']['Article']['Abstract']['AbstractText']
+            for a in abstract:
+                abs_str.append(a)
+        except:
+            pass
+        # title
+        try:
+            title = article['MedlineCitation']['Article']['ArticleTitle']
+            abs_str.append(title)
+        except:
+            pass
+        # keyword list
+        try:
+            kwls = article['MedlineCitation']['KeywordList'][0]
+            for w in kwls:
+                abs_str.append(w)
+        except:
+            pass
+        return ' '.join(abs_str).strip()
+
+    def _throttle(self) -> None:
+        """
+        Block until the next request slot is free under NCBI rate limits
+        """
+        with self._request_lock:
+            wait = self._last_request + self.request_interval - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            self._last_request = time.time()
 
-        # read synonyms from HGNC
-        with open(os.path.join(self.paths.data_dir, 'hgnc_synonyms.json'), 'r') as f:
-            hgnc_syn = f.read()
-            self.hgnc = json.loads(hgnc_syn)
-        
     # fetch abstract from a single pmid    
     def fetch_abstract(self, pmid: str) -> None:
         """
@@ -52,41 +172,89 @@ class Pubmed:
         self.pmid_abstracts[pmid] = ''
 
         try:
-            handle = Entrez.efetch(db='pubmed', id=pmid, retmode='xml')
-            record = Entrez.read(handle)
-            abs_str = []
-            # abstract text
-            try:
-                abstract = record['PubmedArticle'][0]['MedlineCitation']['Article']['Abstract']['AbstractText']
-                for a in abstract:
-                    abs_str.append(a)
-            except:
-                pass
-            # title
-            try:
-                title = record['PubmedArticle'][0]['MedlineCitation']['Article']['ArticleTitle']
-                abs_str.append(title)
-            except:
-                pass
-            # keyword list
+            record = self._read_efetch(db='pubmed', id=pmid, retmode='xml')
+            self.pmid_abstracts[pmid] = self._parse_article(record['PubmedArticle'][0])
+        except (KeyboardInterrupt, NCBIUnavailableError):
+            raise
+        except Exception:
+            pass
+
+    def _read_efetch(self, **params):
+        """
+        Rate limited efetch parsed with Entrez.read, under the retry policy;
+        a response that fails to parse is dropped from the cache and fetched again
+        :param params:
+        :return:
+        """
+        def fetch():
+            self._throttle()
+            handle = entrez_request(self.cache, 'efetch', transport=self.transport, **params)
             try:
-                kwls = record['PubmedArticle'][0]['MedlineCitation']['KeywordList'][0]
-                for w in kwls:
-                    abs_str.append(w)
-            except:
+                return Entrez.read(handle)
+            except ValueError:
+                if self.cache is not None:
+                    self.cache.discard('efetch', params)
+                raise
+            finally:
+                handle.close()
+
+        on_retry = self.metrics.retry if self.metrics is not None else None
+        return self.retry.call(fetch, 'efetch', on_retry=on_retry)
+
+    def _fetch_abstract_batch(self, pmid_batch: List) -> None:
+        """
+        Fetch abstracts for a batch of pmids with a single efetch request
+        :param pmid_batch:
+        :return:
+        """
+        for pmid in pmid_batch:
+            self.pmid_abstracts[pmid] = ''
+
+        try:
+            record = self._read_efetch(db='pubmed', id=','.join(pmid_batch), retmode='xml')
+        except (KeyboardInterrupt, NCBIUnavailableError):
+            # stop the run rather than continue with missing abstracts
+            raise
+        except Exception as err:
+            logging.warning('PubMed efetch failed for {} pmids: {}'.format(len(pmid_batch), err))
+            return
+
+        for article in record.get('PubmedArticle', []):
+            pmid = str(article['MedlineCitation']['PMID'])
+            self.pmid_abstracts[pmid] = self._parse_article(article)
+
+    def fetch_abstracts(self, pmid_list: List) -> None:
+        """
+        Fetch abstracts for a list of pmids, sending efetch_batch ids per
+        request and running up to max_workers requests concurrently
+        :param pmid_list:
+        :return:
+        """
+        pmids = list(dict.fromkeys(pmid_list))
+        batches = [pmids[i:i + self.efetch_batch] for i in range(0, len(pmids), self.efetch_batch)]
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for _ in tqdm.tqdm(executor.map(self._fetch_abstract_batch, batches),
+                               total=len(batches), desc='PubMed batches'):
                 pass
 
-            self.pmid_abstracts[pmid] = ' '.join(abs_str).strip()
-        except:
-            pass
-        
     def extract_DNER(self, pmid: str) -> None:
         """
         Store dner count and dner associated with each pmid
         :param pmid:
         """
         self.pmid_ent_text[pmid], self.pmid_dner[pmid] = self.find_DNER(self.pmid_abstracts[pmid])
-    
+
+    def extract_DNER_batch(self, pmid_list: List) -> None:
+        """
+        Store dner count and dner associated with each pmid, annotating
+        all abstracts as one stream
+        :param pmid_list:
+        """
+        pmid_texts = ((pmid, self.pmid_abstracts[pmid]) for pmid in pmid_list)
+        for pmid, (kw, dner) in self.find_DNER_batch(pmid_texts).items():
+            self.pmid_ent_text[pmid], self.pmid_dner[pmid] = kw, dner
+
     # find disease and phenotype NER
     def find_DNER(self, abstract_text: str) -> Tuple:
         """
@@ -94,23 +262,45 @@ class Pubmed:
         :param abstract_text:
         :return:
         """
-        kw = []
-        dner = []
         try:
-            doc = self.nlp(abstract_text)
-            for ent in doc.ents:
-                if ent.label_=='DO/HPO' and ent.__getitem__(0).is_stop==False:
-                    kw.append(ent.text)
-                    if ent.text.lower() in self.kw2id:
-                        # convert recognized keyword to the main term (first item) in DO/HPO
-                        dner.append(self.id2kw[self.kw2id[ent.text.lower()]][0])
+            kw, dner = _match_DNER(self.matcher, abstract_text)
             self.total_dner.extend(dner)
-            return Counter(kw), dner
+            return kw, dner
         except KeyboardInterrupt:
             raise
         except Exception:
             return Counter([]), []
 
+    def find_DNER_batch(self, pmid_texts, batch_size=None, n_process=None) -> Dict:
+        """
+        Identify disease and phenotype NER for a stream of abstracts
+        :param pmid_texts: iterable of (pmid, abstract_text) pairs
+        :param batch_size: abstracts sent to a worker at a time, defaults to ner_batch_size
+        :param n_process: worker processes, defaults to ner_processes
+        :return: k=pmid, v=(Counter of entity text, dner list)
+        """
+        batch_size = batch_size or self.ner_batch_size
+        n_process = n_process or self.ner_processes
+        results = dict()
+
+        if n_process > 1:
+            pool = multiprocessing.Pool(n_process, initializer=_init_ner_worker, initargs=(self.matcher,))
+            matched = pool.imap(_ner_worker, pmid_texts, chunksize=batch_size)
+        else:
+            pool = None
+            matched = ((pmid, _match_DNER(self.matcher, text)) for pmid, text in pmid_texts)
+
+        try:
+            for pmid, (kw, dner) in tqdm.tqdm(matched, desc='NER'):
+                self.total_dner.extend(dner)
+                results[pmid] = (kw, dner)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        return results
+
     # count word frequencies based on clustering results
     def cluster_count(self, cluster: List) -> int:
         """
@@ -142,31 +332,73 @@ class Pubmed:
                     if gdsid_pmid_map[gene_id]:
                         c_pmid.append(gdsid_pmid_map[gene_id])
                 except KeyError:
-                    sys.stdout.write('Missing Pubmed key: {}\n'.format(g))
+                    sys.stdout.write('Missing Pubmed key: {}\n'.format(gene_id))
                     continue
             pmid_clustered[cluster_name] = c_pmid
 
         return pmid_clustered
 
-    def get_term_frequencies(self, pmid_list: List) -> Dict:
+    def annotate(self, pmid_list: List) -> List:
+        """
+        Fetch and annotate the pmids not yet in the per-pmid result store
+        (pmid_dner), so each pmid is fetched and annotated once per run
+        :param pmid_list:
+        :return: pmids annotated by this call
         """
-        Get all term frequencies
+        new_pmids = [pmid for pmid in dict.fromkeys(pmid_list) if pmid not in self.pmid_dner]
+        if new_pmids:
+            to_fetch = [pmid for pmid in new_pmids if pmid not in self.pmid_abstracts]
+            start = time.perf_counter()
+            self.fetch_abstracts(to_fetch)
+            fetched = time.perf_counter()
+            self.extract_DNER_batch(new_pmids)
+            annotated = time.perf_counter()
+            if self.metrics is not None:
+                self.metrics.record('pubmed_fetch', pmids=len(to_fetch), seconds=round(fetched - start, 4),
+                                    abstracts=sum(bool(self.pmid_abstracts[pmid]) for pmid in to_fetch))
+                self.metrics.record('ner', abstracts=len(new_pmids), seconds=round(annotated - fetched, 4),
+                                    per_second=round(len(new_pmids) / max(annotated - fetched, 1e-9), 1))
+        return new_pmids
+
+    def term_frequencies(self, pmid_list: List) -> Counter:
+        """
+        Aggregate stored per-pmid terms over the unique pmids of a list
+        :param pmid_list:
         :return:
         """
-        for pmid in tqdm.tqdm(pmid_list):
-            self.fetch_abstract(pmid)
-            self.extract_DNER(pmid)
+        freq_list = Counter()
+        for pmid in dict.fromkeys(pmid_list):
+            freq_list.update(self.pmid_dner.get(pmid, []))
+        return freq_list
 
-        freq_list = Counter(self.total_dner)
+    def get_term_frequencies(self, pmid_list: List) -> Dict:
+        """
+        Get all term frequencies of one list of pmids
+        :return:
+        """
+        self.annotate(pmid_list)
+        return self.term_frequencies(pmid_list)
 
-        return freq_list
+    def get_cluster_term_frequencies(self, pmid_clusters: Dict) -> Dict:
+        """
+        Term frequencies of every cluster, annotating the union of pmids once
+        :param pmid_clusters: k=cluster id, v=list of pmids
+        :return: k=cluster id, v=Counter of terms
+        """
+        all_pmids = [pmid for pmids in pmid_clusters.values() for pmid in pmids]
+        new_pmids = self.annotate(all_pmids)
+        logging.info('Annotated {} new pmids for {} pmid-cluster memberships'
+                     .format(len(new_pmids), len(all_pmids)))
+        return {cluster_id: self.term_frequencies(pmids) for cluster_id, pmids in pmid_clusters.items()}
 
-    def construct_query_terms(self, mesh_term: str, gene_name_list: List) -> List:
+    @staticmethod
+    def chunk_query_terms(mesh_term: str, terms: List, max_len=4000) -> List:
         """
-        Construct a list of query terms to make sure each term does not exceed
-        4000 characters. 
+        OR terms together into query strings that, prefixed with the MeSH
+        term, do not exceed max_len characters
         :param mesh_term:
-        :param gene_name_list: list of gene names
+        :param terms:
+        :param max_len:
         :return query_term_list: a list of query strings.
         """
         query_term_list = []
@@ -175,29 +407,77 @@ class Pubmed:
         search_prefix = mesh_term + " AND "
         search_term = "("
 
-        # generate gene name synonym list from HGNC
-        gene_syn_list = []
-        for gene_name in gene_name_list:
-            gene_syn_list.append(gene_name)
-            if gene_name in self.hgnc:
-                gene_syn_list += self.hgnc[gene_name]['names'] + self.hgnc[gene_name]['aliases']
-
-        # iterate through gene name list
-        for gene_name in tqdm.tqdm(gene_syn_list):
-            if len(search_prefix + search_term + gene_name) > 4000:
+        for term in terms:
+            if len(search_prefix + search_term + term) > max_len and search_term != "(":
                 # remove trailing " OR " and append ")"
-                search_term = search_term[:-4] + ")"
-                # append to query term list
-                query_term_list.append(search_term)
+                query_term_list.append(search_term[:-4] + ")")
                 # reinitialize search term
                 search_term = "("
-            else:
-                # append gene name to search term
-                search_term += gene_name + " OR "
+            search_term += term + " OR "
 
         # add final search term if present
         if search_term != "(":
-            search_term = search_term[:-4] + ")"
-            query_term_list.append(search_term)
-
+            query_term_list.append(search_term[:-4] + ")")
         return query_term_list
+
+    def synonym_group(self, gene_name: str) -> List:
+        """
+        Gene name with its HGNC names and aliases
+        :param gene_name:
+        :return:
+        """
+        group = [gene_name]
+        if gene_name in self.hgnc:
+            group += self.hgnc[gene_name]['names'] + self.hgnc[gene_name]['aliases']
+        return group
+
+    def construct_query_terms(self, mesh_term: str, gene_name_list: List) -> List:
+        """
+        Construct a list of query terms to make sure each term does not exceed
+        4000 characters. 
+        :param mesh_term:
+        :param gene_name_list: list of gene names
+        :return query_term_list: a list of query strings.
+        """
+        # generate gene name synonym list from HGNC
+        gene_syn_list = []
+        for gene_name in gene_name_list:
+            gene_syn_list += self.synonym_group(gene_name)
+        return self.chunk_query_terms(mesh_term, gene_syn_list)
+
+    def plan_gene_queries(self, mesh_term: str, cluster_genes: Dict) -> List:
+        """
+        Plan the gene searches of all clusters together. Genes are grouped by
+        the set of clusters they occur in, and each group's synonyms are
+        OR-ed into query chunks, so every gene is searched once and its hits
+        belong to exactly the clusters of its group. When clusters overlap in
+        many small groups, searching each cluster's genes on their own takes
+        fewer requests and is used instead.
+        :param mesh_term:
+        :param cluster_genes: k=cluster id, v=list of gene names
+        :return: list of (query string, list of cluster ids)
+        """
+        gene_clusters = defaultdict(list)
+        for cluster_id, gene_names in cluster_genes.items():
+            for gene_name in set(gene_names):
+                gene_clusters[gene_name].append(cluster_id)
+
+        # sorted, so repeated runs send identical (cacheable) queries
+        groups = defaultdict(list)
+        for gene_name in sorted(gene_clusters):
+            groups[tuple(gene_clusters[gene_name])].append(gene_name)
+
+        plan = []
+        for cluster_ids, gene_names in groups.items():
+            terms = list(dict.fromkeys(t for g in gene_names for t in self.synonym_group(g)))
+            plan += [(q, list(cluster_ids)) for q in self.chunk_query_terms(mesh_term, terms)]
+
+        per_cluster = [(q, [cluster_id]) for cluster_id, gene_names in cluster_genes.items()
+                       for q in self.construct_query_terms(mesh_term, sorted(set(gene_names)))]
+        if len(per_cluster) < len(plan):
+            logging.info('Planned {} gene searches for {} clusters, fewer than {} for {} cluster groups'
+                         .format(len(per_cluster), len(cluster_genes), len(plan), len(groups)))
+            return per_cluster
+        logging.info('Planned {} gene searches for {} genes in {} cluster groups'
+                     .format(len(plan), len(gene_clusters), len(groups)))
+        return plan
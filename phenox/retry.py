@@ -0,0 +1,220 @@
+import time
+import random
+import socket
+import asyncio
+import logging
+import threading
+import http.client
+from email.utils import parsedate_to_datetime
+from typing import Callable
+from urllib.error import HTTPError, URLError
+import Bio.Entrez as Entrez
+
+
+# retries per request for each error class
+DEFAULT_BUDGETS = {
+    'throttle': 6,      # HTTP 429
+    'server': 4,        # HTTP 5xx
+    'network': 4,       # connection errors and timeouts
+    'bad_request': 1,   # HTTP 400 and <ERROR> responses, e.g. expired history sessions
+    'parse': 1,         # truncated or corrupt response bodies
+}
+
+# error classes that signal NCBI is struggling, as opposed to one bad request
+BREAKER_CLASSES = ('throttle', 'server', 'network')
+
+
+class NCBIUnavailableError(RuntimeError):
+    """
+    Raised when a request runs out of retries or the circuit breaker is open
+    """
+    pass
+
+
+class NCBIErrorResponse(RuntimeError):
+    """
+    Raised for an E-utilities response that carries an <ERROR> instead of
+    results, such as an expired history session
+    """
+    pass
+
+
+def classify(err: Exception):
+    """
+    Error class of a failed E-utilities call
+    :param err:
+    :return: key of DEFAULT_BUDGETS, or None when retrying cannot help
+    """
+    if isinstance(err, HTTPError):
+        if err.code == 429:
+            return 'throttle'
+        if 500 <= err.code <= 599:
+            return 'server'
+        if err.code == 400:
+            return 'bad_request'
+        return None
+    if isinstance(err, NCBIErrorResponse):
+        return 'bad_request'
+    if isinstance(err, (URLError, ConnectionError, socket.timeout, http.client.HTTPException)):
+        return 'network'
+    if isinstance(err, ValueError):
+        return 'parse'
+    return None
+
+
+def retry_after(err: Exception):
+    """
+    Seconds requested by a Retry-After header, in delta or HTTP-date form
+    :param err:
+    :return: None without a usable header
+    """
+    headers = getattr(err, 'headers', None)
+    value = headers.get('Retry-After') if headers is not None else None
+    if not value:
+        return None
+    try:
+        return max(0., float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0., parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+# class for failing fast while NCBI is down
+class CircuitBreaker:
+    def __init__(self, threshold=8, reset_after=60.):
+        """
+        Opens after threshold consecutive failures, rejecting requests until
+        reset_after seconds have passed; then requests are let through again
+        and the first success closes it, while another failure reopens it
+        :param threshold:
+        :param reset_after: seconds
+        """
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self.failures = 0
+        self.opened = None
+        self._lock = threading.Lock()
+
+    def check(self) -> None:
+        with self._lock:
+            if self.opened is not None and time.monotonic() - self.opened < self.reset_after:
+                raise NCBIUnavailableError('NCBI circuit breaker is open after {} consecutive failures'
+                                           .format(self.failures))
+
+    def success(self) -> None:
+        with self._lock:
+            self.failures = 0
+            self.opened = None
+
+    def failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                if self.opened is None:
+                    logging.error('Opening NCBI circuit breaker after {} consecutive failures'.format(self.failures))
+                self.opened = time.monotonic()
+
+
+# class for retrying E-utilities calls, shared by all calls of a process
+class RetryPolicy:
+    def __init__(self, base_delay=1., max_delay=60., budgets=None, breaker=None, seed=None):
+        """
+        Exponential backoff with full jitter, honoring Retry-After, with a
+        retry budget per error class and a shared circuit breaker
+        :param base_delay: backoff of the first retry in seconds, doubling after each
+        :param max_delay: cap on any single wait
+        :param budgets: dict of retries per error class, overrides DEFAULT_BUDGETS
+        :param breaker: CircuitBreaker, a new one by default
+        :param seed: jitter seed
+        """
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budgets = dict(DEFAULT_BUDGETS, **(budgets or {}))
+        self.breaker = breaker or CircuitBreaker()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        # Bio.Entrez retries failed requests itself, sleeping 15 s between
+        # tries; this policy is the only retry layer, so its budgets, backoff
+        # and circuit breaker see every attempt
+        Entrez.max_tries = 1
+
+    def delay(self, err: Exception, attempt: int) -> float:
+        """
+        Wait before retry number attempt (0 based)
+        :param err:
+        :param attempt:
+        :return: seconds
+        """
+        requested = retry_after(err)
+        if requested is not None:
+            return min(requested, self.max_delay)
+        with self._lock:
+            return self._random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def _next_wait(self, err: Exception, endpoint: str, retries: dict, on_retry=None) -> float:
+        """
+        Decide whether a failed call is retried
+        :param err:
+        :param endpoint:
+        :param retries: retries so far per error class, updated in place
+        :param on_retry: called with (endpoint, err) before each retry
+        :return: seconds to wait, raising when the call is not retried
+        """
+        error_class = classify(err)
+        if error_class is None:
+            raise err
+        if error_class in BREAKER_CLASSES:
+            self.breaker.failure()
+        if retries.get(error_class, 0) >= self.budgets[error_class]:
+            raise NCBIUnavailableError('{} failed after {} retries: {}'
+                                       .format(endpoint, sum(retries.values()), err)) from err
+        retries[error_class] = retries.get(error_class, 0) + 1
+        wait = self.delay(err, sum(retries.values()) - 1)
+        logging.warning('{} failed ({}: {}), retry {} in {:.1f}s'
+                        .format(endpoint, error_class, err, retries[error_class], wait))
+        if on_retry is not None:
+            on_retry(endpoint, err)
+        return wait
+
+    def call(self, fn: Callable, endpoint: str, on_retry=None):
+        """
+        Call fn until it succeeds or the policy gives up
+        :param fn: blocking call without arguments
+        :param endpoint: E-utilities endpoint, for logs
+        :param on_retry: called with (endpoint, err) before each retry
+        :return: result of fn
+        """
+        retries = dict()
+        while True:
+            self.breaker.check()
+            try:
+                result = fn()
+            except Exception as err:
+                wait = self._next_wait(err, endpoint, retries, on_retry)
+            else:
+                self.breaker.success()
+                return result
+            time.sleep(wait)
+
+    async def call_async(self, fn: Callable, endpoint: str, on_retry=None):
+        """
+        Await fn() until it succeeds or the policy gives up
+        :param fn: coroutine function without arguments
+        :param endpoint:
+        :param on_retry:
+        :return: result of fn
+        """
+        retries = dict()
+        while True:
+            self.breaker.check()
+            try:
+                result = await fn()
+            except Exception as err:
+                wait = self._next_wait(err, endpoint, retries, on_retry)
+            else:
+                self.breaker.success()
+                return result
+            await asyncio.sleep(wait)
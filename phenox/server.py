@@ -0,0 +1,205 @@
+import os
+import glob
+import json
+import time
+import uuid
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List
+
+from phenox import batch
+from phenox.paths import PhenoXPaths
+
+# PhenoX options a job may set
+JOB_OPTIONS = ('mesh_policy', 'cluster_engine', 'nboot', 'nboot_tol', 'cluster_jobs',
+               'wordcloud_pngs', 'resume', 'from_stage')
+
+
+def _ready() -> int:
+    return os.getpid()
+
+
+# class for queueing PhenoX queries on warm worker processes
+class JobQueue:
+    def __init__(self, config: Dict, workers=1, max_queued=100, keep_finished=1000, finished_ttl=86400.):
+        """
+        Jobs run on a fixed pool of worker processes that each keep their
+        shared resources (MeSH index, NER lexicon, Entrez cache, R) loaded
+        :param config: batch.worker_config settings
+        :param workers: jobs running at once
+        :param max_queued: jobs waiting before new submissions are refused
+        :param keep_finished: finished jobs remembered, oldest forgotten first
+        :param finished_ttl: seconds a finished job is remembered
+        """
+        self.config = config
+        self.workers = workers
+        self.max_queued = max_queued
+        self.keep_finished = keep_finished
+        self.finished_ttl = finished_ttl
+        self.paths = PhenoXPaths(config['outprefix'])
+        self.jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self.executor = ProcessPoolExecutor(workers, initializer=batch._init_worker, initargs=(config,))
+        # start and warm every worker now rather than on its first job
+        for _ in range(workers):
+            self.executor.submit(_ready)
+
+    def shutdown(self) -> None:
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def submit(self, query: str, options=None) -> Dict:
+        """
+        Queue a query
+        :param query:
+        :param options: PhenoX options, keys from JOB_OPTIONS
+        :return: job status
+        """
+        options = options or dict()
+        unknown = set(options) - set(JOB_OPTIONS)
+        if unknown:
+            raise ValueError('Unknown job options: {}'.format(', '.join(sorted(unknown))))
+        with self._lock:
+            self._evict()
+            waiting = sum(not job['future'].done() for job in self.jobs.values())
+            if waiting >= self.max_queued + self.workers:
+                raise OverflowError('Job queue is full ({} jobs waiting)'.format(waiting))
+            job_id = uuid.uuid4().hex[:12]
+            self.jobs[job_id] = {
+                'id': job_id, 'query': query, 'options': options, 'submitted': time.time(),
+                'future': self.executor.submit(batch._run_query, query, options),
+            }
+        logging.info('Queued job {} for {}'.format(job_id, query))
+        return self.status(job_id)
+
+    def _evict(self) -> None:
+        """
+        Forget finished jobs past finished_ttl or beyond keep_finished,
+        called with the lock held
+        :return:
+        """
+        now = time.time()
+        finished = []
+        for job_id, job in self.jobs.items():
+            if job['future'].done():
+                job.setdefault('finished', now)
+                finished.append(job_id)
+        expired = [j for j in finished if now - self.jobs[j]['finished'] >= self.finished_ttl]
+        excess = [j for j in finished if j not in expired][:max(0, len(finished) - len(expired) - self.keep_finished)]
+        for job_id in expired + excess:
+            del self.jobs[job_id]
+
+    def _result_files(self, row: Dict) -> List:
+        pattern = os.path.join(glob.escape(self.paths.output_dir), glob.escape(row['outprefix']) + '_*')
+        return sorted(glob.glob(pattern))
+
+    def status(self, job_id: str):
+        """
+        Job status: queued, running, done or failed, with result paths when done
+        :param job_id:
+        :return: None for unknown jobs
+        """
+        job = self.jobs.get(job_id)
+        if job is None:
+            return None
+        future = job['future']
+        status = {k: job[k] for k in ('id', 'query', 'options', 'submitted')}
+        status['outprefix'] = batch.query_prefix(self.config['outprefix'], job['query'])
+        if not future.done():
+            status['status'] = 'running' if future.running() else 'queued'
+        elif future.exception() is not None:
+            status.update(status='failed', error=str(future.exception()))
+        else:
+            row = future.result()
+            status.update(status='done' if row['status'] == 'ok' else 'failed',
+                          seconds=row['seconds'], error=row['error'])
+            status['results'] = self._result_files(row) if row['status'] == 'ok' else []
+        return status
+
+    def list_jobs(self) -> List:
+        with self._lock:
+            self._evict()
+            job_ids = list(self.jobs)
+        return [status for status in map(self.status, job_ids) if status is not None]
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """
+    POST /jobs {"query": ..., "options": {...}} queues a job,
+    GET /jobs lists jobs and GET /jobs/<id> reports one
+    """
+    def _send(self, code: int, payload) -> None:
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        jobs = self.server.jobs
+        parts = self.path.strip('/').split('/')
+        if parts == ['jobs']:
+            return self._send(200, jobs.list_jobs())
+        if len(parts) == 2 and parts[0] == 'jobs':
+            status = jobs.status(parts[1])
+            if status is not None:
+                return self._send(200, status)
+        return self._send(404, {'error': 'Not found: {}'.format(self.path)})
+
+    def do_POST(self):
+        if self.path.strip('/') != 'jobs':
+            return self._send(404, {'error': 'Not found: {}'.format(self.path)})
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            query = request['query'].strip()
+            if not query:
+                raise ValueError('Empty query')
+            return self._send(202, self.server.jobs.submit(query, request.get('options')))
+        except OverflowError as err:
+            return self._send(503, {'error': str(err)})
+        except (ValueError, KeyError, TypeError, AttributeError) as err:
+            return self._send(400, {'error': 'Bad job request: {}'.format(err)})
+
+    def log_message(self, fmt, *args):
+        logging.info('%s - %s' % (self.address_string(), fmt % args))
+
+
+def make_server(jobs: JobQueue, host='127.0.0.1', port=8400) -> ThreadingHTTPServer:
+    """
+    HTTP server for a job queue, port 0 picks a free port
+    :param jobs:
+    :param host:
+    :param port:
+    :return:
+    """
+    server = ThreadingHTTPServer((host, port), _Handler)
+    server.jobs = jobs
+    return server
+
+
+def serve(email: str, outprefix: str, host='127.0.0.1', port=8400, workers=1, max_queued=100,
+          **settings) -> None:
+    """
+    Run the job server until interrupted
+    :param email:
+    :param outprefix: query outputs get <outprefix>_<query>
+    :param host:
+    :param port:
+    :param workers: jobs running at once
+    :param max_queued:
+    :param settings: batch.worker_config settings and PhenoX defaults for jobs
+    :return:
+    """
+    jobs = JobQueue(batch.worker_config(email, outprefix, workers, **settings), workers, max_queued)
+    server = make_server(jobs, host, port)
+    print('PhenoX server listening on http://{}:{}/jobs with {} workers'.format(host, server.server_address[1], workers))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        jobs.shutdown()
@@ -0,0 +1,305 @@
+import io
+import json
+import time
+import zlib
+import base64
+import hashlib
+import logging
+import threading
+from collections import Counter, defaultdict
+from email.message import Message
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict
+from urllib.error import HTTPError
+from urllib.parse import parse_qs, urlsplit
+from urllib.request import urlopen
+import Bio.Entrez as Entrez
+
+from phenox.entrez_cache import request_key
+from phenox.eutils_client import AsyncEntrez, EUTILS_URL
+
+
+class ArchiveMissError(LookupError):
+    """
+    Raised on replay when a request is not in the archive
+    """
+    pass
+
+
+def wire_params(query_type: str, params: Dict) -> Dict:
+    """
+    Request parameters as sent over the wire (numbers as strings, id lists
+    joined except for elink), so recorded and served requests share keys
+    :param query_type:
+    :param params:
+    :return:
+    """
+    query = parse_qs(AsyncEntrez.encode_params(query_type, params), keep_blank_values=True)
+    return {k: v[0] if len(v) == 1 else v for k, v in query.items()}
+
+
+def archive_key(query_type: str, params: Dict) -> str:
+    """
+    Archive address of a request, the cache key of its wire parameters
+    :param query_type:
+    :param params:
+    :return:
+    """
+    return request_key(query_type, wire_params(query_type, params))
+
+
+# class for storing E-utilities request/response pairs of a run
+class RequestArchive:
+    def __init__(self, archive_file: str):
+        """
+        JSON lines file, one request per line with its endpoint, wire
+        parameters, HTTP status, elapsed time and compressed response body.
+        Lines are appended as responses arrive, so parallel workers may
+        record into the same archive.
+        :param archive_file:
+        """
+        self.archive_file = archive_file
+        self._lock = threading.Lock()
+
+    def add(self, query_type: str, params: Dict, status: int, data: bytes, elapsed: float) -> None:
+        entry = {
+            'key': archive_key(query_type, params),
+            'endpoint': query_type,
+            'params': {k: v for k, v in wire_params(query_type, params).items()
+                       if k not in ('email', 'tool', 'api_key')},
+            'status': status,
+            'elapsed': round(elapsed, 4),
+            'body': base64.b64encode(zlib.compress(data)).decode('ascii'),
+        }
+        line = json.dumps(entry) + '\n'
+        with self._lock, open(self.archive_file, 'a') as f:
+            f.write(line)
+
+    def load(self) -> Dict:
+        """
+        Read the archive
+        :return: k=archive key, v=list of (status, body, elapsed) in recorded order
+        """
+        responses = defaultdict(list)
+        with open(self.archive_file, 'r') as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    body = zlib.decompress(base64.b64decode(entry['body']))
+                    responses[entry['key']].append((entry['status'], body, entry['elapsed']))
+        return responses
+
+
+# class for sending E-utilities requests, live by default
+class Transport:
+    def __init__(self, base_url=None, timeout=120):
+        """
+        Bottom layer of every E-utilities request, beneath the Entrez cache
+        :param base_url: E-utilities endpoint such as a stand-in server,
+            None sends requests through Bio.Entrez
+        :param timeout: socket timeout in seconds for base_url requests
+        """
+        self.base_url = base_url
+        self.timeout = timeout
+
+    def send(self, query_type: str, params: Dict) -> bytes:
+        if self.base_url is None:
+            handle = getattr(Entrez, query_type)(**params)
+            data = handle.read()
+            handle.close()
+            return data.encode('utf-8') if isinstance(data, str) else data
+        url = '{}/{}.fcgi'.format(self.base_url.rstrip('/'), query_type)
+        body = AsyncEntrez.encode_params(query_type, params).encode('utf-8')
+        with urlopen(url, data=body, timeout=self.timeout) as response:
+            return response.read()
+
+    def fetch(self, query_type: str, params: Dict, send=None) -> bytes:
+        """
+        Response body of one request, raising HTTPError for error statuses
+        :param query_type: Entrez function name
+        :param params: E-utilities parameters
+        :param send: caller's own sender, e.g. the async client's pooled
+            connections, used instead of self.send
+        :return:
+        """
+        return (send or self.send)(query_type, params)
+
+
+# class for recording live requests into an archive
+class RecordingTransport(Transport):
+    def __init__(self, archive: RequestArchive, base_url=None, timeout=120):
+        super().__init__(base_url, timeout)
+        self.archive = archive
+
+    def fetch(self, query_type: str, params: Dict, send=None) -> bytes:
+        start = time.perf_counter()
+        try:
+            data = super().fetch(query_type, params, send)
+        except HTTPError as err:
+            body = err.read() if err.fp is not None else b''
+            self.archive.add(query_type, params, err.code, body, time.perf_counter() - start)
+            raise HTTPError(err.url, err.code, err.msg, err.hdrs, io.BytesIO(body))
+        self.archive.add(query_type, params, 200, data, time.perf_counter() - start)
+        return data
+
+
+# class for serving archived responses instead of NCBI
+class ReplayTransport(Transport):
+    def __init__(self, archive: RequestArchive, latency=0., jitter=0., error_rate=0., error_code=503,
+                 recorded_timing=False, seed=0):
+        """
+        Replay recorded responses. A request recorded several times is
+        answered with its recordings in order, then the last one again.
+        Injected delays and errors are drawn from a hash of the seed, the
+        request and how often it was asked before, so a replay behaves the
+        same whatever order concurrent requests arrive in.
+        :param archive:
+        :param latency: seconds added to every response
+        :param jitter: up to this many seconds added at random
+        :param error_rate: fraction of responses replaced by error_code
+        :param error_code: HTTP status of injected errors
+        :param recorded_timing: also wait as long as the recorded request took
+        :param seed:
+        """
+        super().__init__()
+        self.responses = archive.load()
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_code = error_code
+        self.recorded_timing = recorded_timing
+        self.seed = seed
+        self._asked = Counter()
+        self._lock = threading.Lock()
+
+    def _draw(self, key: str, n: int, purpose: str) -> float:
+        digest = hashlib.sha256('{}:{}:{}:{}'.format(self.seed, purpose, key, n).encode('utf-8')).digest()
+        return int.from_bytes(digest[:8], 'big') / 2 ** 64
+
+    def fetch(self, query_type: str, params: Dict, send=None) -> bytes:
+        key = archive_key(query_type, params)
+        with self._lock:
+            n = self._asked[key]
+            self._asked[key] += 1
+        recorded = self.responses.get(key)
+        if not recorded:
+            raise ArchiveMissError('{} request not in archive: {}'.format(query_type, params))
+        status, data, elapsed = recorded[min(n, len(recorded) - 1)]
+
+        delay = self.latency + self.jitter * self._draw(key, n, 'latency')
+        if self.recorded_timing:
+            delay += elapsed
+        if delay > 0:
+            time.sleep(delay)
+
+        if self.error_rate and self._draw(key, n, 'error') < self.error_rate:
+            logging.debug('Injecting HTTP {} into {} {}'.format(self.error_code, query_type, params))
+            status, data = self.error_code, b'Injected error'
+        if status >= 400:
+            raise HTTPError(EUTILS_URL + query_type + '.fcgi', status, 'Replayed error', Message(),
+                            io.BytesIO(data))
+        return data
+
+
+# class for counting requests, bytes and latencies per endpoint
+class MeteredTransport(Transport):
+    def __init__(self, inner=None):
+        """
+        Measure every request sent through the inner transport into
+        self.metrics, a metrics.RunMetrics swapped in per run
+        :param inner: Transport, None for live requests
+        """
+        super().__init__(getattr(inner, 'base_url', None))
+        self.inner = inner
+        self.metrics = None
+
+    def fetch(self, query_type: str, params: Dict, send=None) -> bytes:
+        metrics = self.metrics
+        start = time.perf_counter()
+        try:
+            if self.inner is None:
+                data = super().fetch(query_type, params, send)
+            else:
+                data = self.inner.fetch(query_type, params, send)
+        except HTTPError as err:
+            if metrics is not None:
+                metrics.request(query_type, time.perf_counter() - start, 0, err.code)
+            raise
+        if metrics is not None:
+            metrics.request(query_type, time.perf_counter() - start, len(data))
+        return data
+
+
+def make_transport(record=None, replay=None, latency=0., jitter=0., error_rate=0., error_code=503,
+                   recorded_timing=False, seed=0, base_url=None):
+    """
+    Transport from command line style settings
+    :param record: archive file to record into
+    :param replay: archive file to replay from
+    :param latency: replay only, see ReplayTransport
+    :param jitter:
+    :param error_rate:
+    :param error_code:
+    :param recorded_timing:
+    :param seed:
+    :param base_url: live E-utilities endpoint, e.g. a stand-in server
+    :return: None for plain live requests
+    """
+    if record and replay:
+        raise ValueError('Cannot record and replay at the same time')
+    if replay:
+        return ReplayTransport(RequestArchive(replay), latency=latency, jitter=jitter, error_rate=error_rate,
+                               error_code=error_code, recorded_timing=recorded_timing, seed=seed)
+    if record:
+        return RecordingTransport(RequestArchive(record), base_url=base_url)
+    if base_url:
+        return Transport(base_url)
+    return None
+
+
+class _ReplayHandler(BaseHTTPRequestHandler):
+    """
+    Answers <anything>/<endpoint>.fcgi GET and POST requests from a transport
+    """
+    def _serve(self, path: str, query: str) -> None:
+        endpoint = path.rstrip('/').rsplit('/', 1)[-1]
+        if not endpoint.endswith('.fcgi'):
+            code, data = 404, b'Not an E-utilities endpoint'
+        else:
+            params = {k: v[0] if len(v) == 1 else v for k, v in parse_qs(query, keep_blank_values=True).items()}
+            try:
+                code, data = 200, self.server.transport.fetch(endpoint[:-len('.fcgi')], params)
+            except HTTPError as err:
+                code, data = err.code, err.read()
+            except ArchiveMissError as err:
+                code, data = 404, str(err).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        self._serve(url.path, url.query)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self._serve(urlsplit(self.path).path, body.decode('utf-8'))
+
+    def log_message(self, fmt, *args):
+        logging.debug('%s - %s' % (self.address_string(), fmt % args))
+
+
+def make_replay_server(transport: Transport, host='127.0.0.1', port=8401) -> ThreadingHTTPServer:
+    """
+    Stand-in E-utilities server, e.g. for a ReplayTransport; point clients
+    at http://host:port/ with --eutils-url
+    :param transport:
+    :param host:
+    :param port: 0 picks a free port
+    :return:
+    """
+    server = ThreadingHTTPServer((host, port), _ReplayHandler)
+    server.transport = transport
+    return server
@@ -1,60 +1,155 @@
+import os
+import json
+import math
+import hashlib
+import logging
+import numpy as np
+from PIL import Image
 from wordcloud import WordCloud
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict
 import matplotlib.pyplot as plt
-import math
+plt.switch_backend('agg')
 
 from phenox.paths import PhenoXPaths
 
 
+# WordCloud settings of each cluster panel; part of the render cache key
+CLOUD_PARAMS = dict(width=1400, height=800, max_words=400, background_color=None,
+                    mode="RGBA", random_state=0)
+
+
+def cloud_key(freqs: Dict) -> str:
+    """
+    Cache key of a rendered cloud: hash of the frequencies and cloud settings
+    :param freqs: k=term, v=frequency
+    :return:
+    """
+    items = sorted((str(k), float(v)) for k, v in freqs.items())
+    payload = json.dumps([items, sorted(CLOUD_PARAMS.items(), key=lambda p: p[0])], default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def render_cloud(freqs: Dict) -> np.ndarray:
+    """
+    Lay out and rasterize one cluster's wordcloud
+    :param freqs: k=term, v=frequency
+    :return: height x width x 4 RGBA image
+    """
+    if not freqs:
+        return np.zeros((CLOUD_PARAMS['height'], CLOUD_PARAMS['width'], 4), dtype=np.uint8)
+    return WordCloud(**CLOUD_PARAMS).generate_from_frequencies(freqs).to_array()
+
+
 class WordcloudPlotter:
-    def __init__(self, outprefix: str):
+    def __init__(self, outprefix: str, processes=None, cache_mode='readwrite', cache_size=256):
+        """
+        Initialize class
+        :param outprefix:
+        :param processes: worker processes for rendering clouds, defaults to cpu count
+        :param cache_mode: render cache mode as for the Entrez cache; readwrite,
+            readonly and offline reuse renders of identical frequencies, only
+            readwrite stores new ones, off disables the cache
+        :param cache_size: render cache size bound in MB, least recently used
+            renders are evicted first
+        """
         self.paths = PhenoXPaths(outprefix)
+        self.processes = processes or os.cpu_count()
+        self.cache_mode = cache_mode
+        self.max_bytes = cache_size * 1024 ** 2
+        self.render_dir = os.path.join(self.paths.cache_dir, 'wordclouds') if cache_mode != 'off' else None
+
+    def _evict(self) -> None:
+        """
+        Drop least recently used renders until the cache fits in max_bytes
+        :return:
+        """
+        renders = []
+        for entry in os.scandir(self.render_dir):
+            if entry.name.endswith('.png'):
+                stat = entry.stat()
+                renders.append((stat.st_mtime, stat.st_size, entry.path))
+        excess = sum(size for _, size, _ in renders) - self.max_bytes
+        evicted = 0
+        for _, size, path in sorted(renders):
+            if excess <= 0:
+                break
+            os.remove(path)
+            excess -= size
+            evicted += 1
+        if evicted:
+            logging.debug('Evicted {} cached wordclouds'.format(evicted))
 
-    def generate_wordclouds(self, clusters, output_file):
+    def _render_all(self, clusters: Dict) -> Dict:
+        """
+        Render every cluster's cloud, in parallel for uncached frequencies
+        :param clusters: k=cluster name, v={k=term, v=frequency}
+        :return: k=cluster name, v=RGBA image
+        """
+        images = dict()
+        keys = {name: cloud_key(freqs) for name, freqs in clusters.items()}
+        if self.render_dir and os.path.isdir(self.render_dir):
+            for name, key in keys.items():
+                cached = os.path.join(self.render_dir, '{}.png'.format(key))
+                if os.path.exists(cached):
+                    images[name] = np.asarray(Image.open(cached))
+                    if self.cache_mode == 'readwrite':
+                        # the modification time orders renders for eviction
+                        os.utime(cached)
+
+        todo = [name for name in clusters if name not in images]
+        if len(todo) > 1 and self.processes > 1:
+            with ProcessPoolExecutor(min(self.processes, len(todo))) as executor:
+                rendered = list(executor.map(render_cloud, [dict(clusters[name]) for name in todo]))
+        else:
+            rendered = [render_cloud(dict(clusters[name])) for name in todo]
+
+        for name, image in zip(todo, rendered):
+            images[name] = image
+        if todo and self.render_dir and self.cache_mode == 'readwrite':
+            os.makedirs(self.render_dir, exist_ok=True)
+            for name in todo:
+                Image.fromarray(images[name]).save(os.path.join(self.render_dir, '{}.png'.format(keys[name])))
+            self._evict()
+        return images
+
+    def generate_wordclouds(self, clusters, output_file, cluster_files=False):
         """
         Generate plot with subplots of wordclouds
-        :param clusters:
+        :param clusters: k=cluster name, v={k=term, v=frequency}
+        :param output_file:
+        :param cluster_files: also write one PNG per cluster next to output_file
         :return:
         """
+        images = self._render_all(clusters)
+
         num_clusters = len(clusters)
         num_columns = 3
         num_rows = int(math.ceil(num_clusters/num_columns))
-        fig, axes = plt.subplots(num_rows, num_columns, figsize=(18, 5*num_rows), dpi=200)
+        fig, axes = plt.subplots(num_rows, num_columns, figsize=(18, 5*num_rows), dpi=200, squeeze=False)
         fig.subplots_adjust(hspace=0, wspace=0)
 
-        single_row = False
-        if num_rows == 1:
-            single_row = True
-
         # turn axes off for everything and remove ticks
-        if single_row:
-            for i in range(num_columns):
-                axes[i].get_xaxis().set_ticks([])
-                axes[i].get_yaxis().set_ticks([])
-                axes[i].axis('off')
-        else:
-            for i in range(num_rows):
-                for j in range(num_columns):
-                    axes[i, j].get_xaxis().set_ticks([])
-                    axes[i, j].get_yaxis().set_ticks([])
-                    axes[i, j].axis('off')
-
-        clusters_sort = [(k, v) for k, v in clusters.items()]
-        clusters_sort.sort(key=lambda x: x[0])
-
-        # plot clusters
-        for i, cluster in enumerate(clusters_sort):
-            cluster_name, freqs = cluster
-            row = int(math.floor(i / num_columns))
-            col = i % num_columns
-            wordcloud = WordCloud(width=1400, height=800, max_words=400, background_color=None, mode="RGBA").generate_from_frequencies(freqs)
-            if single_row:
-                axes[col].imshow(wordcloud, interpolation="bilinear")
-                axes[col].set_title('{}'.format(cluster_name))
-                axes[col].axis('on')
-            else:
-                axes[row, col].imshow(wordcloud, interpolation="bilinear")
-                axes[row, col].set_title('{}'.format(cluster_name))
-                axes[row, col].axis('on')
-
-        plt.savefig(output_file, bbox_inches='tight')
-        print('Wordcloud saved to %s' % output_file)
\ No newline at end of file
+        for ax in axes.ravel():
+            ax.get_xaxis().set_ticks([])
+            ax.get_yaxis().set_ticks([])
+            ax.axis('off')
+
+        clusters_sort = sorted(clusters.keys())
+
+        # composite pre-rendered clouds into the grid
+        for i, cluster_name in enumerate(clusters_sort):
+            ax = axes[i // num_columns, i % num_columns]
+            ax.imshow(images[cluster_name], interpolation="bilinear")
+            ax.set_title('{}'.format(cluster_name))
+            ax.axis('on')
+
+        fig.savefig(output_file, bbox_inches='tight')
+        plt.close(fig)
+        print('Wordcloud saved to %s' % output_file)
+
+        if cluster_files:
+            stem = os.path.splitext(output_file)[0]
+            for cluster_name in clusters_sort:
+                Image.fromarray(images[cluster_name]).save('{}_{}.png'.format(stem, cluster_name))
+            print('Per cluster wordclouds saved to %s_<cluster>.png' % stem)
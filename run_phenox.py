@@ -1,16 +1,66 @@
 #!/usr/bin/env python
 
+import sys
 import argparse
 from phenox.phenox import PhenoX
+from phenox.checkpoint import STAGES
+from phenox.mesh_lookup import MeshLookupError
+from phenox.batch import read_queries, run_batch
+from phenox.server import serve
+from phenox.transport import make_transport
 
 
 __version__ = '0.3.3'
 
 
+def transport_settings(args):
+    return dict(record=args.record, replay=args.replay, latency=args.replay_latency,
+                error_rate=args.replay_error_rate, base_url=args.eutils_url)
+
+
+def run_queries(args):
+    queries = read_queries(args.batch)
+    print('Input queries: %d from %s' % (len(queries), args.batch))
+    # nobody answers prompts in a batch run
+    mesh_policy = 'best' if args.mesh_policy == 'interactive' else args.mesh_policy
+    run_batch(args.email, queries, args.outprefix, workers=args.workers,
+              cache_mode=args.cache_mode, cache_size=args.cache_size,
+              ner_processes=args.ner_processes, mesh_policy=mesh_policy,
+              cluster_engine=args.cluster_engine, nboot=args.nboot,
+              cluster_jobs=args.cluster_jobs, nboot_tol=args.nboot_tol,
+              wordcloud_pngs=args.wordcloud_pngs, resume=args.resume,
+              from_stage=args.from_stage, transport=transport_settings(args))
+
+
+def run_server(args):
+    # nobody answers prompts for a server job
+    mesh_policy = 'best' if args.mesh_policy == 'interactive' else args.mesh_policy
+    serve(args.email, args.outprefix, host=args.host, port=args.serve, workers=args.workers,
+          cache_mode=args.cache_mode, cache_size=args.cache_size,
+          ner_processes=args.ner_processes, mesh_policy=mesh_policy,
+          cluster_engine=args.cluster_engine, nboot=args.nboot,
+          cluster_jobs=args.cluster_jobs, nboot_tol=args.nboot_tol,
+          wordcloud_pngs=args.wordcloud_pngs, resume=args.resume,
+          from_stage=args.from_stage, transport=transport_settings(args))
+
+
 def run(args):
+    if args.serve is not None:
+        return run_server(args)
+    if args.batch:
+        return run_queries(args)
     print('Input query: %s' % args.query_str)
-    phenox = PhenoX(args.email, args.query_str, args.outprefix)
-    phenox.subtype()
+    phenox = PhenoX(args.email, args.query_str, args.outprefix,
+                    cache_mode=args.cache_mode, cache_size=args.cache_size,
+                    ner_processes=args.ner_processes, mesh_policy=args.mesh_policy,
+                    cluster_engine=args.cluster_engine, nboot=args.nboot,
+                    cluster_jobs=args.cluster_jobs, nboot_tol=args.nboot_tol,
+                    wordcloud_pngs=args.wordcloud_pngs, resume=args.resume,
+                    from_stage=args.from_stage, transport=make_transport(**transport_settings(args)))
+    try:
+        phenox.subtype()
+    except MeshLookupError as err:
+        sys.exit(str(err))
 
 
 # argparse function for options
@@ -28,13 +78,139 @@ def getargs():
         help='choose an alternate prefix for outfiles'
     )
 
+    parser.add_argument(
+        '--cache-mode', dest='cache_mode', default='readwrite',
+        choices=['readwrite', 'readonly', 'offline', 'off'],
+        help='Entrez response cache: readwrite (default), readonly\n'
+             '(serve hits, store nothing), offline (cache only, no\n'
+             'network) or off'
+    )
+
+    parser.add_argument(
+        '--cache-size', metavar='MB', dest='cache_size', type=int,
+        default=2048,
+        help='size bound of the Entrez cache in MB (default 2048)'
+    )
+
+    parser.add_argument(
+        '--ner-processes', metavar='N', dest='ner_processes', type=int,
+        default=1,
+        help='worker processes for PubMed abstract NER (default 1)'
+    )
+
+    parser.add_argument(
+        '--mesh-policy', dest='mesh_policy', default='interactive',
+        choices=['interactive', 'best', 'fail'],
+        help='when the query is not an exact MeSH term: prompt for a\n'
+             'candidate (default), use the best candidate, or fail'
+    )
+
+    parser.add_argument(
+        '--cluster-engine', dest='cluster_engine', default='pvclust',
+        choices=['pvclust', 'python'],
+        help='bootstrap clustering with R pvclust (default) or the\n'
+             'native python engine, which does not need R'
+    )
+
+    parser.add_argument(
+        '--nboot', metavar='N', dest='nboot', type=int, default=5000,
+        help='bootstrap replicates per scale (default 5000); the\n'
+             'upper bound when --adaptive-nboot is set'
+    )
+
+    parser.add_argument(
+        '--adaptive-nboot', metavar='TOL', dest='nboot_tol', type=float,
+        default=None,
+        help='pvclust: double replicates from 500 until AU p-values of\n'
+             'candidate clusters change by less than TOL'
+    )
+
+    parser.add_argument(
+        '--cluster-jobs', metavar='N', dest='cluster_jobs', type=int,
+        default=None,
+        help='worker processes for clustering (default: all cores\n'
+             'for python, all but one for pvclust)'
+    )
+
+    parser.add_argument(
+        '--wordcloud-pngs', dest='wordcloud_pngs', action='store_true',
+        help='also write one wordcloud PNG per cluster'
+    )
+
+    parser.add_argument(
+        '--resume', dest='resume', action='store_true',
+        help='skip pipeline stages with a valid checkpoint from an\n'
+             'earlier run of the same query'
+    )
+
+    parser.add_argument(
+        '--from-stage', dest='from_stage', default=None, choices=STAGES,
+        help='resume, but recompute this stage and all later ones'
+    )
+
+    parser.add_argument(
+        '--batch', metavar='FILE', dest='batch', default=None,
+        help='run every query in FILE (one per line) instead of\n'
+             'query_str; outputs are prefixed <prefix>_<query> and a\n'
+             'summary goes to <prefix>_batch_summary.txt. The\n'
+             'interactive MeSH policy becomes best'
+    )
+
+    parser.add_argument(
+        '--workers', metavar='N', dest='workers', type=int, default=1,
+        help='with --batch or --serve: queries run in parallel\n'
+             '(default 1)'
+    )
+
+    parser.add_argument(
+        '--serve', metavar='PORT', dest='serve', type=int, default=None,
+        help='run as a local job server: POST /jobs {"query": ...}\n'
+             'queues a query, GET /jobs/<id> reports its status and\n'
+             'result files; options given here are the job defaults'
+    )
+
+    parser.add_argument(
+        '--host', dest='host', default='127.0.0.1',
+        help='with --serve: address to bind (default 127.0.0.1)'
+    )
+
+    parser.add_argument(
+        '--record', metavar='FILE', dest='record', default=None,
+        help='append every E-utilities request and response to the\n'
+             'archive FILE; the Entrez cache is off while recording'
+    )
+
+    parser.add_argument(
+        '--replay', metavar='FILE', dest='replay', default=None,
+        help='answer E-utilities requests from an archive made with\n'
+             '--record instead of NCBI; the Entrez cache is off'
+    )
+
+    parser.add_argument(
+        '--replay-latency', metavar='S', dest='replay_latency', type=float,
+        default=0.,
+        help='with --replay: seconds added to every response'
+    )
+
+    parser.add_argument(
+        '--replay-error-rate', metavar='P', dest='replay_error_rate',
+        type=float, default=0.,
+        help='with --replay: fraction of responses replaced by HTTP 503'
+    )
+
+    parser.add_argument(
+        '--eutils-url', metavar='URL', dest='eutils_url', default=None,
+        help='send E-utilities requests to URL instead of NCBI, e.g.\n'
+             'a stand-in server from scripts/replay_server.py'
+    )
+
     parser.add_argument(
         "--version", action='version',
         version='\n'.join(['PhenoX v' + __version__])
     )
 
     parser.add_argument(
-        "query_str", help="disease query term"
+        "query_str", nargs='?', help="disease query term"
     )
 
     required_named = parser.add_argument_group('required arguments')
@@ -44,7 +220,12 @@ def getargs():
         help='NCBI requires an email for database queries'
     )
 
-    return parser.parse_args()
+    args = parser.parse_args()
+    if not args.query_str and not args.batch and args.serve is None:
+        parser.error('a query_str, --batch FILE or --serve PORT is required')
+    if args.record and args.replay:
+        parser.error('--record and --replay cannot be combined')
+    return args
 
 
 if __name__ == '__main__':
@@ -0,0 +1,15 @@
+import os
+
+from phenox.paths import PhenoXPaths
+from phenox.lexicon import load_ontology_keywords
+from phenox.keyword_matcher import ontology_matcher
+
+
+paths = PhenoXPaths('phenox')
+
+id2kw, kw2id = load_ontology_keywords(paths.data_dir)
+
+matcher = ontology_matcher(kw2id, id2kw)
+matcher_file = os.path.join(paths.data_dir, 'keyword_matcher.pkl')
+matcher.save(matcher_file)
+print('Keyword matcher with {} keywords written to {}'.format(len(matcher.keywords), matcher_file))
@@ -0,0 +1,13 @@
+import os
+
+from phenox.paths import PhenoXPaths
+from phenox.lexicon import build_lexicon, load_ontology_keywords
+
+
+paths = PhenoXPaths('phenox')
+
+id2kw, kw2id = load_ontology_keywords(paths.data_dir)
+
+lexicon_file = os.path.join(paths.data_dir, 'ontology_lexicon.bin')
+build_lexicon(id2kw, kw2id, [], lexicon_file)
+print('Ontology lexicon written to {}'.format(lexicon_file))
@@ -0,0 +1,35 @@
+import argparse
+
+from phenox.transport import RequestArchive, ReplayTransport, make_replay_server
+
+
+parser = argparse.ArgumentParser(
+    prog='replay_server.py',
+    description='Serve a recorded E-utilities archive as a stand-in for NCBI; '
+                'run PhenoX with --eutils-url http://HOST:PORT/'
+)
+parser.add_argument('archive', help='archive written by run_phenox.py --record')
+parser.add_argument('--host', default='127.0.0.1')
+parser.add_argument('--port', type=int, default=8401)
+parser.add_argument('--latency', type=float, default=0., help='seconds added to every response')
+parser.add_argument('--jitter', type=float, default=0., help='up to this many seconds added at random')
+parser.add_argument('--error-rate', dest='error_rate', type=float, default=0.,
+                    help='fraction of responses replaced by --error-code')
+parser.add_argument('--error-code', dest='error_code', type=int, default=503)
+parser.add_argument('--recorded-timing', dest='recorded_timing', action='store_true',
+                    help='also wait as long as each request took when recorded')
+parser.add_argument('--seed', type=int, default=0)
+args = parser.parse_args()
+
+transport = ReplayTransport(RequestArchive(args.archive), latency=args.latency, jitter=args.jitter,
+                            error_rate=args.error_rate, error_code=args.error_code,
+                            recorded_timing=args.recorded_timing, seed=args.seed)
+server = make_replay_server(transport, args.host, args.port)
+print('Replaying {} requests from {} on http://{}:{}/'.format(
+    sum(len(r) for r in transport.responses.values()), args.archive, args.host, server.server_address[1]))
+try:
+    server.serve_forever()
+except KeyboardInterrupt:
+    pass
+finally:
+    server.server_close()
@@ -0,0 +1,56 @@
+import os
+import sys
+import argparse
+
+from phenox.paths import PhenoXPaths
+from phenox.benchmark import BENCH_STAGES, SCALES, StageBenchmark, compare, load_results, \
+    print_results, save_results
+
+
+parser = argparse.ArgumentParser(
+    prog='run_benchmarks.py',
+    description='Time PhenoX stages on synthetic data and compare against a baseline'
+)
+parser.add_argument('--scale', choices=sorted(SCALES), default='small',
+                    help='preset data sizes (default small)')
+for size in ('datasets', 'genes_per_dataset', 'genes', 'abstracts', 'keywords', 'clusters', 'nboot'):
+    parser.add_argument('--' + size.replace('_', '-'), dest=size, type=int, default=None,
+                        help='override the preset {}'.format(size))
+parser.add_argument('--stages', nargs='+', choices=BENCH_STAGES, default=list(BENCH_STAGES))
+parser.add_argument('--jobs', type=int, default=None,
+                    help='worker processes for clustering, NER and wordclouds')
+parser.add_argument('--repeat', type=int, default=1, help='timed runs per stage, the fastest is kept')
+parser.add_argument('--no-memory', dest='memory', action='store_false',
+                    help='skip the traced peak memory run')
+parser.add_argument('-o', metavar='FILE', dest='outfile', default=None,
+                    help='results file (default output/benchmark_<scale>.json)')
+parser.add_argument('--baseline', metavar='FILE', default=None,
+                    help='compare with an earlier results file; exits 1 on regressions')
+parser.add_argument('--tolerance', type=float, default=0.2,
+                    help='allowed relative slowdown or memory growth (default 0.2)')
+args = parser.parse_args()
+
+scale = dict(SCALES[args.scale])
+scale.update({k: v for k, v in vars(args).items() if k in scale and v is not None})
+print('Benchmarking {} on {}'.format(', '.join(args.stages), scale))
+
+bench = StageBenchmark(jobs=args.jobs, **scale)
+try:
+    results = bench.run(args.stages, repeat=args.repeat, memory=args.memory)
+finally:
+    bench.close()
+print_results(results)
+
+paths = PhenoXPaths('benchmark')
+outfile = args.outfile or os.path.join(paths.output_dir, 'benchmark_{}.json'.format(args.scale))
+os.makedirs(os.path.dirname(os.path.abspath(outfile)), exist_ok=True)
+save_results(results, outfile)
+print('Results written to {}'.format(outfile))
+
+if args.baseline:
+    rows = compare(results, load_results(args.baseline), args.tolerance)
+    for stage, metric, before, current, ratio, regressed in rows:
+        print('{:<10} {:<12} {:>10.3f} -> {:>10.3f} ({:+.0%}){}'.format(
+            stage, metric, before, current, ratio - 1, '  REGRESSION' if regressed else ''))
+    if any(row[-1] for row in rows):
+        sys.exit(1)
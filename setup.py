@@ -6,6 +6,7 @@ setuptools.setup(
     version='0.1',
     url='https://github.com/NCBI-Hackathons/phenotypeXpression',
     packages=setuptools.find_packages(),
+    python_requires='>=3.9',
     install_requires=[
     ],
     tests_require=[
@@ -24,7 +24,7 @@ CONDAPATH="$(which conda)" || CONDAPATH=$HOME/anaconda3/bin
 echo "CONDAPATH => $CONDAPATH"
 export PATH=$CONDAPATH:$PATH
 
-conda create -n ${CONDAENV} -y python==3.6 pip pytest || true
+conda create -n ${CONDAENV} -y python=3.9 pip pytest || true
 
 echo "Activating Conda Environment ----->"
 conda activate ${CONDAENV} || source $CONDAPATH/activate ${CONDAENV} 
@@ -38,5 +38,8 @@ conda install -y -c conda-forge matplotlib rpy2 r-ape r-pvclust r-circlize readl
 echo "Installing phenoX ----->"
 python setup.py develop
 
-echo "Installing SpaCy en ----->"
-python -m spacy download en
+echo "Building DO/HPO lexicon ----->"
+python scripts/build_lexicon.py
+
+echo "Building DO/HPO keyword matcher ----->"
+python scripts/build_keyword_matcher.py
@@ -0,0 +1,60 @@
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """
+    Answers POSTed E-utilities requests with server.respond(endpoint, params),
+    which returns a body or a (status, body) tuple
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        params = parse_qs(self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8'))
+        endpoint = self.path.rsplit('/', 1)[-1].split('.')[0]
+        self.server.requests.append((endpoint, params, self.client_address))
+        response = self.server.respond(endpoint, params)
+        status, body = response if isinstance(response, tuple) else (200, response)
+        body = body.encode('utf-8') if isinstance(body, str) else body
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+# class for a local stand-in of the E-utilities endpoint
+class LocalEutils:
+    def __init__(self, respond):
+        """
+        :param respond: callable (endpoint, params) -> body or (status, body),
+            params as parsed by parse_qs
+        """
+        self.requests = []
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+        self.server.respond = respond
+        self.server.requests = self.requests
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base_url = 'http://127.0.0.1:{}/eutils/'.format(self.server.server_address[1])
+
+    def close(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+
+# class for tests against a local E-utilities server answering from self.respond
+class EutilsServerCase(unittest.TestCase):
+    def setUp(self):
+        self.eutils_server = LocalEutils(self.respond)
+        self.base_url = self.eutils_server.base_url
+        self.requests = self.eutils_server.requests
+
+    def tearDown(self):
+        self.eutils_server.close()
+
+    def respond(self, endpoint, params):
+        raise NotImplementedError
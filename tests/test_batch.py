@@ -0,0 +1,69 @@
+import os
+import csv
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from phenox import batch
+from phenox.batch import read_queries, query_prefix, run_batch, worker_config
+from phenox.paths import PhenoXPaths
+from phenox.pubmed import Pubmed
+
+
+class TestBatch(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        # outputs and the Entrez cache go to a scratch base directory that
+        # shares the MeSH data of the repository
+        paths = PhenoXPaths('test_batch')
+        self.base_dir = os.path.join(self.tmp_dir.name, 'base')
+        os.makedirs(self.base_dir)
+        shutil.copy(os.path.join(paths.base_dir, 'PhenoX.png'), self.base_dir)
+        os.symlink(paths.data_dir, os.path.join(self.base_dir, 'data'))
+        self.base_dir_patch = mock.patch.object(PhenoXPaths.__init__, '__defaults__', (self.base_dir,))
+        self.base_dir_patch.start()
+
+    def tearDown(self):
+        self.base_dir_patch.stop()
+        self.tmp_dir.cleanup()
+
+    def test_read_queries(self):
+        query_file = os.path.join(self.tmp_dir.name, 'queries.txt')
+        with open(query_file, 'w') as f:
+            f.write('# nightly\nbreast cancer\n\npsoriasis\nbreast cancer\n')
+        assert(read_queries(query_file) == ['breast cancer', 'psoriasis'])
+        assert(query_prefix('phenox', "Crohn's disease").startswith('phenox_Crohn-s-disease-'))
+        assert(query_prefix('phenox', "Crohn's disease") != query_prefix('phenox', 'Crohn s disease'))
+        assert(query_prefix('phenox', 'psoriasis') == query_prefix('phenox', 'psoriasis'))
+
+    def test_failures_recorded_in_summary(self):
+        # nothing is cached, so offline queries fail without touching the network
+        summary_file = run_batch('test@example.com', ['psoriasis', 'no such disease xyz'], 'test_batch',
+                                 cache_mode='offline', mesh_policy='fail', cluster_engine='python')
+        with open(summary_file) as f:
+            lines = list(csv.reader(f, delimiter='\t'))
+        assert(lines[0] == ['query', 'outprefix', 'status', 'seconds', 'error'])
+        assert([row[0] for row in lines[1:]] == ['psoriasis', 'no such disease xyz'])
+        assert(all(row[2] == 'failed' for row in lines[1:]))
+        assert(lines[2][4].startswith('MeshLookupError'))
+        assert(summary_file == os.path.join(self.base_dir, 'output', 'test_batch_batch_summary.txt'))
+        assert(os.path.exists(os.path.join(self.base_dir, 'cache', 'entrez.sqlite')))
+
+
+    def test_pubmed_state_cleared_between_queries(self):
+        batch._init_worker(worker_config('test@example.com', 'test_batch', cache_mode='offline',
+                                         mesh_policy='fail', cluster_engine='python'))
+        pubmed = Pubmed.__new__(Pubmed)
+        pubmed.reset()
+        pubmed.pmid_abstracts['1'] = 'psoriasis'
+        pubmed.pmid_dner['1'] = ['DOID_8893']
+        pubmed.total_dner.append('DOID_8893')
+        batch._worker_resources._pubmed = pubmed
+
+        batch._run_query('no such disease xyz')
+        assert(pubmed.pmid_abstracts == {} and pubmed.pmid_dner == {} and pubmed.total_dner == [])
+
+
+if __name__ == '__main__':
+    unittest.main()
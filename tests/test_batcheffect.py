@@ -0,0 +1,81 @@
+import unittest
+import numpy as np
+import scipy.stats as stats
+from collections import defaultdict
+
+from phenox.batcheffect import BatchEffect, fdr_bh
+
+
+class TestBatchEffect(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(1)
+        self.meta_dict = dict()
+        self.cluster_dict = dict()
+        k = 0
+        for c in range(6):
+            gds_ids = []
+            for _ in range(rng.integers(2, 30)):
+                gds = 'GDS{}'.format(k)
+                k += 1
+                self.meta_dict[gds] = [int(rng.integers(5, 100)), float(rng.integers(0, 20)) * 1e6,
+                                       str(rng.choice(['570', '96', '1261', '6244']))]
+                gds_ids.append(gds)
+            self.cluster_dict['cluster{}'.format(c)] = gds_ids
+        self.be = BatchEffect(self.cluster_dict, self.meta_dict, 'phenox')
+
+    def test_ks_matches_scipy(self):
+        total_stats = self.be._total_stats()
+        clust_stats = defaultdict(list)
+        for i in range(2):
+            self.be._generate_ks_test(i, total_stats[i], clust_stats)
+            for cluster_id, gds_ids in self.cluster_dict.items():
+                values = np.array([self.meta_dict[g][i] for g in gds_ids], dtype=np.float64)
+                result = stats.ks_2samp(values, total_stats[i])
+                ks_stat, p_val, mean, std = clust_stats[cluster_id][4 * i:4 * i + 4]
+                assert(np.isclose(ks_stat, result[0]))
+                assert(np.isclose(p_val, result[1], rtol=1e-9, atol=0))
+                assert(np.isclose(mean, values.mean()))
+                assert(np.isclose(std, values.std(ddof=1)))
+
+    def test_ks_pvalues_small_clusters(self):
+        # tied values in tiny clusters, where ks_2samp uses the exact distribution
+        rng = np.random.default_rng(2)
+        meta_dict = dict()
+        cluster_dict = dict()
+        for c, size in enumerate((2, 6, 12, 25)):
+            cluster_dict[c] = ['GDS{}_{}'.format(c, k) for k in range(size)]
+            for gds in cluster_dict[c]:
+                meta_dict[gds] = [int(rng.integers(0, 15)), 0., '570']
+        be = BatchEffect(cluster_dict, meta_dict, 'phenox')
+        total = be._total_stats()[0]
+        clust_stats = defaultdict(list)
+        p_vals = be._generate_ks_test(0, total, clust_stats)
+        for c, gds_ids in cluster_dict.items():
+            values = np.array([meta_dict[g][0] for g in gds_ids], dtype=np.float64)
+            result = stats.ks_2samp(values, total)
+            assert(np.isclose(clust_stats[c][0], result[0]))
+            assert(p_vals[c] == result[1])
+
+    def test_chisq_contingency(self):
+        total_stats = self.be._total_stats()
+        clust_stats = defaultdict(list)
+        self.be._generate_chisq_test(total_stats[2], clust_stats)
+        total = [self.meta_dict[g][2] for ids in self.cluster_dict.values() for g in ids]
+        categories = sorted(set(total))
+        f_exp = np.array([total.count(c) for c in categories])
+        for cluster_id, gds_ids in self.cluster_dict.items():
+            gpls = [self.meta_dict[g][2] for g in gds_ids]
+            f_obs = np.array([gpls.count(c) for c in categories])
+            chi_stat, p_val, mode, category_n = clust_stats[cluster_id]
+            assert(np.isclose(chi_stat, ((f_obs - f_exp) ** 2 / f_exp).sum()))
+            assert(np.isclose(p_val, stats.chi2.sf(chi_stat, len(categories) - 1)))
+            assert(mode == max(gpls, key=lambda c: (gpls.count(c), -gpls.index(c))))
+            assert(category_n == len(set(gpls)))
+
+    def test_fdr_bh(self):
+        adjusted = fdr_bh([0.01, 0.04, 0.03, np.nan, 0.5])
+        assert(np.allclose(adjusted, [0.04, 0.16 / 3, 0.16 / 3, np.nan, 0.5], equal_nan=True))
+
+
+if __name__ == '__main__':
+    unittest.main()
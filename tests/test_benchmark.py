@@ -0,0 +1,49 @@
+import os
+import unittest
+from unittest import mock
+
+from phenox.benchmark import StageBenchmark, synthetic_docsums, compare
+
+
+class TestBenchmark(unittest.TestCase):
+    def setUp(self):
+        self.bench = StageBenchmark(datasets=40, genes_per_dataset=20, genes=300, abstracts=50, keywords=100,
+                                    clusters=2, nboot=10, jobs=1, outprefix='test_benchmark')
+
+    def tearDown(self):
+        self.bench.close()
+        # nothing is written to the output directory of the repository
+        stats_file = os.path.join(self.bench.geo.paths.output_dir, 'test_benchmark_cluster_stats.txt')
+        assert(not os.path.exists(stats_file))
+        assert(not os.path.exists(self.bench.output_dir.name))
+
+    def test_synthetic_docsums(self):
+        batches = synthetic_docsums(10, 5, 50, batch_size=7)
+        docsums = [d for batch in batches for d in batch['DocumentSummarySet']['DocumentSummary']]
+        assert(all(len(batch['DocumentSummarySet']['DocumentSummary']) <= 7 for batch in batches))
+        assert(len(set(d['GDS'] for d in docsums)) == 10)
+        assert(synthetic_docsums(10, 5, 50, batch_size=7) == batches)
+
+    def test_run_and_compare(self):
+        results = self.bench.run(('gdsdict', 'docsum_stream', 'dataframe', 'batch', 'ner'))
+        assert(list(results['stages']) == ['gdsdict', 'docsum_stream', 'dataframe', 'batch', 'ner'])
+        for r in results['stages'].values():
+            assert(r['seconds'] > 0 and r['items'] > 0 and r['peak_mb'] > 0)
+        assert(results['stages']['ner']['items'] == 50)
+
+        assert(not any(row[-1] for row in compare(results, results)))
+        slower = {'stages': {'ner': dict(results['stages']['ner'], seconds=results['stages']['ner']['seconds'] / 2)}}
+        assert([row[:2] for row in compare(results, slower) if row[-1]] == [('ner', 'seconds')])
+
+        with self.assertRaises(ValueError):
+            self.bench.run(('visualize',))
+
+
+    def test_cluster_stage_capped(self):
+        with mock.patch('phenox.benchmark.CLUSTER_MAX_DATASETS', 25):
+            results = self.bench.run(('cluster',), memory=False)
+        assert(results['stages']['cluster']['items'] == 25)
+
+
+if __name__ == '__main__':
+    unittest.main()
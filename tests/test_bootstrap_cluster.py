@@ -0,0 +1,31 @@
+import unittest
+import numpy as np
+from scipy import sparse
+from scipy.spatial.distance import pdist
+
+from phenox.bootstrap_cluster import MultiscaleBootstrap, weighted_distances
+
+
+def synthetic_groups(n_groups=3, group_size=8, n_genes=150, seed=0):
+    rng = np.random.default_rng(seed)
+    profiles = rng.random((n_groups, n_genes)) < 0.3
+    noise = rng.random((n_groups * group_size, n_genes)) < 0.05
+    mat = np.repeat(profiles, group_size, axis=0) ^ noise
+    return sparse.csr_matrix(mat.astype(np.int8))
+
+
+class TestMultiscaleBootstrap(unittest.TestCase):
+    def test_weighted_distances(self):
+        mat = synthetic_groups()
+        weights = np.random.default_rng(1).integers(0, 3, mat.shape[1])
+        expected = pdist(mat.toarray() * np.sqrt(weights), 'euclidean')
+        assert(np.allclose(weighted_distances(mat.astype(np.float64), weights), expected))
+
+    def test_recovers_groups(self):
+        mat = synthetic_groups()
+        labels = ['GDS{}'.format(i) for i in range(mat.shape[0])]
+        fit = MultiscaleBootstrap(nboot=40, n_jobs=2, seed=0, chunk_size=10).fit(mat, labels)
+
+        clusters = sorted(sorted(c) for c in fit.pick(alpha=.95))
+        assert(clusters == sorted(sorted(labels[i:i + 8]) for i in range(0, 24, 8)))
+        assert(fit.newick().count('GDS') == 24)
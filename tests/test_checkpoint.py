@@ -0,0 +1,59 @@
+import os
+import tempfile
+import unittest
+
+from phenox.checkpoint import RunCheckpoints
+
+
+class TestCheckpoint(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.calls = []
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _pipeline(self, nboot=10, **kwargs):
+        checkpoints = RunCheckpoints(self.tmp.name, **kwargs)
+
+        def stage(name, value):
+            def compute():
+                self.calls.append(name)
+                return value
+            return compute
+
+        geo = checkpoints.run('geo', {}, stage('geo', {'GDS1': ['A', 'B']}))
+        clusters = checkpoints.run('cluster', {'nboot': nboot}, stage('cluster', {'cluster0': list(geo)}))
+        return checkpoints.run('ner', {}, stage('ner', {k: len(v) for k, v in clusters.items()}))
+
+    def test_resume(self):
+        first = self._pipeline()
+        assert(self.calls == ['geo', 'cluster', 'ner'])
+        assert(os.path.exists(os.path.join(self.tmp.name, 'manifest.json')))
+
+        self.calls = []
+        assert(self._pipeline(resume=True) == first)
+        assert(self.calls == [])
+
+        # without resume every stage is recomputed
+        self._pipeline()
+        assert(self.calls == ['geo', 'cluster', 'ner'])
+
+    def test_parameter_change_invalidates_downstream(self):
+        self._pipeline()
+        self.calls = []
+        self._pipeline(nboot=20, resume=True)
+        assert(self.calls == ['cluster', 'ner'])
+
+    def test_from_stage(self):
+        self._pipeline()
+        self.calls = []
+        self._pipeline(from_stage='cluster')
+        assert(self.calls == ['cluster', 'ner'])
+
+        with self.assertRaises(ValueError):
+            RunCheckpoints(self.tmp.name, from_stage='nope')
+
+
+if __name__ == '__main__':
+    unittest.main()
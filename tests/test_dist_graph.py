@@ -0,0 +1,31 @@
+import unittest
+import numpy as np
+from scipy import sparse
+from scipy.spatial.distance import cdist
+
+from phenox import dist_graph
+
+
+class TestDistGraph(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.mat = sparse.csr_matrix((rng.random((120, 400)) < 0.05).astype(np.float64))
+
+    def test_landmark_mds_matches_classical_with_all_landmarks(self):
+        classical = dist_graph.classical_mds(dist_graph.squared_distances(self.mat))[0]
+        landmark = dist_graph.landmark_mds(self.mat, n_landmarks=120)
+        assert(np.allclose(np.abs(classical), np.abs(landmark), atol=1e-6))
+
+    def test_knn_edges(self):
+        pairs, distances = dist_graph.knn_edges(self.mat, n_neighbors=3)
+        dense = self.mat.toarray()
+
+        assert((pairs[:, 0] < pairs[:, 1]).all())
+        assert(len(np.unique(pairs, axis=0)) == len(pairs))
+        assert(np.allclose(distances, np.linalg.norm(dense[pairs[:, 0]] - dense[pairs[:, 1]], axis=1)))
+        assert(3 * 120 / 2 <= len(pairs) <= 3 * 120)
+
+    def test_spread_labels_capped(self):
+        coords = dist_graph.embed(self.mat)
+        labels = dist_graph.spread_labels(coords, max_labels=10)
+        assert(len(set(labels.tolist())) == 10)
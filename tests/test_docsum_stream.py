@@ -0,0 +1,97 @@
+import io
+import unittest
+
+from phenox.benchmark import synthetic_docsums, docsum_xml
+from phenox.eutils_client import AsyncEntrez
+from phenox.geo_data import GEOQuery, docsum_gene_counts, merge_gds_dict
+from phenox.retry import NCBIErrorResponse, NCBIUnavailableError, RetryPolicy
+
+from eutils_server import EutilsServerCase
+
+ESEARCH = ('<?xml version="1.0" encoding="UTF-8" ?>\n'
+           '<!DOCTYPE eSearchResult PUBLIC "-//NLM//DTD esearch 20060628//EN" '
+           '"https://eutils.ncbi.nlm.nih.gov/eutils/dtd/20060628/esearch.dtd">\n'
+           '<eSearchResult><Count>{}</Count><RetMax>0</RetMax><RetStart>0</RetStart>'
+           '<QueryKey>1</QueryKey><WebEnv>ENV</WebEnv><IdList></IdList></eSearchResult>')
+
+ERROR = ('<?xml version="1.0" encoding="UTF-8" ?>\n'
+         '<eSummaryResult><ERROR>Unable to obtain query #1</ERROR></eSummaryResult>')
+
+BATCHES = synthetic_docsums(30, 8, 120, batch_size=1000, seed=3)
+DOCSUMS = [d for batch in BATCHES for d in batch['DocumentSummarySet']['DocumentSummary']]
+
+
+class TestDocsumStream(EutilsServerCase):
+    def setUp(self):
+        super().setUp()
+        self.truncate = set()
+        self.errors = dict()
+        self.eutils = AsyncEntrez(rate=100, base_url=self.base_url)
+        self.geo = GEOQuery('phenox', 'test', 'test@example.com', efetch_batch=50, eutils=self.eutils,
+                            retry=RetryPolicy(base_delay=0.01, seed=0))
+
+    def tearDown(self):
+        self.eutils.close()
+        super().tearDown()
+
+    def respond(self, endpoint, params):
+        if endpoint == 'esearch':
+            return ESEARCH.format(len(DOCSUMS))
+        start, size = int(params['retstart'][0]), int(params['retmax'][0])
+        if self.errors.get(start):
+            self.errors[start] -= 1
+            return ERROR
+        body = docsum_xml({'DocumentSummarySet': {'DocumentSummary': DOCSUMS[start:start + size]}})
+        if start in self.truncate:
+            self.truncate.discard(start)
+            body = body[:len(body) // 2]
+        return body
+
+    def test_counts_match_parsed_docsums(self):
+        gds_dict = dict()
+        n_docsums = 0
+        for batch in BATCHES:
+            counts, n = docsum_gene_counts(io.BytesIO(docsum_xml(batch)))
+            merge_gds_dict(gds_dict, counts)
+            n_docsums += n
+        expected = self.geo.gdsdict_from_profile(BATCHES)
+        assert(n_docsums == len(DOCSUMS))
+        assert(gds_dict == expected)
+        assert(list(gds_dict) == list(expected))
+
+    def test_stream_from_history_server(self):
+        gds_dict = self.geo.stream_gds_dict('Muscular Dystrophies', 'geoprofiles')
+        expected = self.geo.gdsdict_from_profile(BATCHES)
+        assert(gds_dict == expected)
+        assert(list(gds_dict) == list(expected))
+        assert(all(list(gds_dict[g]) == list(expected[g]) for g in expected))
+
+        endpoints = [e for e, _, _ in self.requests]
+        assert(endpoints.count('esearch') == 1)
+        assert(endpoints.count('efetch') == len(range(0, len(DOCSUMS), 50)))
+        assert(all(p['webenv'] == ['ENV'] for e, p, _ in self.requests if e == 'efetch'))
+
+    def test_truncated_batch_fetched_again(self):
+        self.truncate.add(100)
+        gds_dict = self.geo.stream_gds_dict('Muscular Dystrophies', 'geoprofiles')
+        assert(gds_dict == self.geo.gdsdict_from_profile(BATCHES))
+        retstarts = [p['retstart'][0] for e, p, _ in self.requests if e == 'efetch']
+        assert(retstarts.count('100') == 2)
+
+    def test_error_response_raises(self):
+        with self.assertRaises(NCBIErrorResponse):
+            docsum_gene_counts(io.BytesIO(ERROR.encode('utf-8')))
+
+        self.errors[50] = 1
+        gds_dict = self.geo.stream_gds_dict('Muscular Dystrophies', 'geoprofiles')
+        assert(gds_dict == self.geo.gdsdict_from_profile(BATCHES))
+        retstarts = [p['retstart'][0] for e, p, _ in self.requests if e == 'efetch']
+        assert(retstarts.count('50') == 2)
+
+        self.errors[50] = 5
+        with self.assertRaises(NCBIUnavailableError):
+            self.geo.stream_gds_dict('Muscular Dystrophies', 'geoprofiles')
+
+
+if __name__ == '__main__':
+    unittest.main()
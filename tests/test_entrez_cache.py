@@ -0,0 +1,70 @@
+import io
+import os
+import tempfile
+import unittest
+
+from phenox.entrez_cache import EntrezCache, CacheMissError, cacheable, request_key
+
+
+class TestEntrezCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cache_file = os.path.join(self.tmp_dir.name, 'entrez.sqlite')
+        self.calls = []
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def fetch(self, **kwargs):
+        self.calls.append(kwargs)
+        return io.BytesIO(b'<xml>' + kwargs['id'].encode('utf-8') + b'</xml>')
+
+    def test_request_key_ignores_caller_identity(self):
+        assert(request_key('efetch', {'id': '1', 'email': 'a@b.c'}) == request_key('efetch', {'id': '1'}))
+        assert(request_key('elink', {'id': ['1', '2']}) != request_key('elink', {'id': '1,2'}))
+
+    def test_invalid_responses_not_cached(self):
+        assert(cacheable({'db': 'gds'}, b'<eSummaryResult><DocSum/></eSummaryResult>'))
+        assert(cacheable({'retmode': 'text'}, b'123\n456\n'))
+        assert(not cacheable({'db': 'gds'}, b'<eSummaryResult><DocSum>'))
+        assert(not cacheable({'db': 'gds'}, b'<eSummaryResult><ERROR>Empty id list</ERROR></eSummaryResult>'))
+        assert(not cacheable({'retmode': 'text'}, b'<ERROR>Empty id list</ERROR>'))
+        assert(not cacheable({'retmode': 'json'}, b'{"esearchresult": '))
+        assert(not cacheable({'db': 'gds'}, b''))
+
+        cache = EntrezCache(self.cache_file)
+        cache.put('efetch', {'db': 'pubmed', 'id': '1'}, b'<PubmedArticleSet><PubmedArt')
+        assert(cache.get('efetch', {'db': 'pubmed', 'id': '1'}) is None)
+
+    def test_repeat_request_served_from_disk(self):
+        cache = EntrezCache(self.cache_file)
+        first = cache.request('efetch', self.fetch, db='pubmed', id='123').read()
+        second = EntrezCache(self.cache_file).request('efetch', self.fetch, db='pubmed', id='123').read()
+
+        assert(first == second == b'<xml>123</xml>')
+        assert(len(self.calls) == 1)
+
+    def test_expired_entry_refetched(self):
+        cache = EntrezCache(self.cache_file, ttls={'esearch': -1})
+        cache.request('esearch', self.fetch, db='pubmed', id='1')
+        cache.request('esearch', self.fetch, db='pubmed', id='1')
+        assert(len(self.calls) == 2)
+
+    def test_lru_eviction(self):
+        cache = EntrezCache(self.cache_file, max_bytes=45)
+        for pmid in ('1', '2', '3'):
+            cache.request('efetch', self.fetch, db='pubmed', id=pmid)
+        assert(cache.get('efetch', {'db': 'pubmed', 'id': '1'}) is None)
+        assert(cache.get('efetch', {'db': 'pubmed', 'id': '3'}) == b'<xml>3</xml>')
+
+    def test_offline_and_readonly_modes(self):
+        EntrezCache(self.cache_file).request('efetch', self.fetch, db='pubmed', id='1')
+
+        offline = EntrezCache(self.cache_file, mode='offline')
+        assert(offline.request('efetch', self.fetch, db='pubmed', id='1').read() == b'<xml>1</xml>')
+        with self.assertRaises(CacheMissError):
+            offline.request('efetch', self.fetch, db='pubmed', id='2')
+
+        readonly = EntrezCache(self.cache_file, mode='readonly')
+        readonly.request('efetch', self.fetch, db='pubmed', id='2')
+        assert(readonly.get('efetch', {'db': 'pubmed', 'id': '2'}) is None)
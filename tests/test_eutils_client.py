@@ -0,0 +1,84 @@
+import os
+import asyncio
+import time
+import tempfile
+import unittest
+from urllib.error import HTTPError
+from urllib.parse import parse_qs
+
+from phenox.entrez_cache import EntrezCache
+from phenox.eutils_client import AsyncEntrez, TokenBucket, run_all, run_sync
+
+from eutils_server import EutilsServerCase
+
+ESEARCH = ('<?xml version="1.0" encoding="UTF-8" ?>\n'
+           '<!DOCTYPE eSearchResult PUBLIC "-//NLM//DTD esearch 20060628//EN" '
+           '"https://eutils.ncbi.nlm.nih.gov/eutils/dtd/20060628/esearch.dtd">\n'
+           '<eSearchResult><Count>1</Count><RetMax>1</RetMax><RetStart>0</RetStart>'
+           '<IdList><Id>{}</Id></IdList><TranslationSet/><QueryTranslation>{}</QueryTranslation>'
+           '</eSearchResult>')
+
+
+class TestEutilsClient(EutilsServerCase):
+    def setUp(self):
+        super().setUp()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        super().tearDown()
+        self.tmp_dir.cleanup()
+
+    def respond(self, endpoint, params):
+        if params['term'][0] == 'missing':
+            return 404, 'not found'
+        return ESEARCH.format(len(self.requests), params['term'][0])
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(rate=10)
+        delays = [bucket.reserve() for _ in range(5)]
+        assert(delays[0] == 0)
+        assert(abs(delays[-1] - 0.4) < 0.05)
+
+    def test_concurrent_requests_rate_limited(self):
+        client = AsyncEntrez(rate=20, max_connections=3, base_url=self.base_url)
+        start = time.monotonic()
+        results = run_all([client.read('esearch', db='pubmed', term='q{}'.format(i)) for i in range(10)])
+        elapsed = time.monotonic() - start
+        client.close()
+
+        assert([r['QueryTranslation'] for r in results] == ['q{}'.format(i) for i in range(10)])
+        assert(elapsed >= 9 / 20 - 0.05)
+        assert(all(endpoint == 'esearch' for endpoint, _, _ in self.requests))
+        # keep-alive connections are reused from the pool
+        assert(len({addr for _, _, addr in self.requests}) <= 3)
+
+    def test_cache_and_errors(self):
+        cache = EntrezCache(os.path.join(self.tmp_dir.name, 'entrez.sqlite'))
+        client = AsyncEntrez(cache=cache, rate=50, base_url=self.base_url)
+        first = run_all([client.read('esearch', db='pubmed', term='cached')])[0]
+        second = run_all([client.read('esearch', db='pubmed', term='cached')])[0]
+        assert(first == second)
+        assert(len(self.requests) == 1)
+
+        with self.assertRaises(HTTPError):
+            run_all([client.read('esearch', db='pubmed', term='missing')])
+        client.close()
+
+    def test_sync_helpers_refuse_running_loop(self):
+        async def caller():
+            return run_sync(asyncio.sleep(0, 'done'))
+
+        with self.assertRaises(RuntimeError) as err:
+            asyncio.run(caller())
+        assert('running event loop' in str(err.exception))
+        assert(run_sync(asyncio.sleep(0, 'done')) == 'done')
+
+    def test_elink_keeps_one_id_per_parameter(self):
+        params = parse_qs(AsyncEntrez.encode_params('elink', {'id': ['1', '2']}))
+        assert(params['id'] == ['1', '2'])
+        params = parse_qs(AsyncEntrez.encode_params('esummary', {'id': ['1', '2']}))
+        assert(params['id'] == ['1,2'])
+
+
+if __name__ == '__main__':
+    unittest.main()
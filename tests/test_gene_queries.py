@@ -0,0 +1,65 @@
+import itertools
+import unittest
+
+from phenox.pubmed import Pubmed
+
+
+class TestGeneQueries(unittest.TestCase):
+    def setUp(self):
+        self.pubmed = Pubmed.__new__(Pubmed)
+        self.pubmed.hgnc = {'TP53': {'names': ['tumor protein p53'], 'aliases': ['P53']}}
+
+    def test_chunks_keep_every_term(self):
+        terms = ['GENE{}'.format(i) for i in range(500)]
+        chunks = Pubmed.chunk_query_terms('Psoriasis', terms, max_len=300)
+        assert(all(len('Psoriasis AND ' + c) <= 300 for c in chunks))
+        assert([t for c in chunks for t in c[1:-1].split(' OR ')] == terms)
+
+    def test_each_gene_searched_once(self):
+        # many shared genes, whose searches would otherwise repeat per cluster
+        shared = ['GENE{}'.format(i) for i in range(1000)]
+        cluster_genes = {
+            'cluster0': shared + ['TP53', 'BRCA1', 'EGFR'],
+            'cluster1': shared + ['TP53', 'BRCA1', 'KRAS'],
+            'cluster2': shared + ['TP53'],
+        }
+        plan = self.pubmed.plan_gene_queries('Psoriasis', cluster_genes)
+        searched = [t for q, _ in plan for t in q[1:-1].split(' OR ')]
+        assert(len(searched) == len(set(searched)))
+        assert(sorted(searched) == sorted(shared + ['TP53', 'tumor protein p53', 'P53', 'BRCA1', 'EGFR', 'KRAS']))
+
+        # mapping the plan back covers exactly the genes of each cluster
+        for cluster_id, gene_names in cluster_genes.items():
+            covered = [t for q, clusters in plan if cluster_id in clusters for t in q[1:-1].split(' OR ')]
+            expected = [t for g in gene_names for t in self.pubmed.synonym_group(g)]
+            assert(sorted(covered) == sorted(expected))
+
+
+    def test_no_more_requests_than_per_cluster_chunks(self):
+        # every pair of clusters shares its own gene, so each cluster group
+        # holds one gene
+        cluster_genes = {'cluster{}'.format(c): [] for c in range(6)}
+        for i, (a, b) in enumerate(itertools.combinations(sorted(cluster_genes), 2)):
+            cluster_genes[a].append('GENE{}'.format(i))
+            cluster_genes[b].append('GENE{}'.format(i))
+        cluster_genes['cluster0'].append('TP53')
+
+        plan = self.pubmed.plan_gene_queries('Psoriasis', cluster_genes)
+        per_cluster = [q for genes in cluster_genes.values()
+                       for q in self.pubmed.construct_query_terms('Psoriasis', genes)]
+        assert(len(plan) <= len(per_cluster) == 6)
+        for cluster_id, gene_names in cluster_genes.items():
+            covered = [t for q, clusters in plan if cluster_id in clusters for t in q[1:-1].split(' OR ')]
+            expected = [t for g in gene_names for t in self.pubmed.synonym_group(g)]
+            assert(sorted(covered) == sorted(expected))
+
+        # large clusters with shared genes still search each gene once
+        shared = ['GENE{}'.format(i) for i in range(1000)]
+        plan = self.pubmed.plan_gene_queries('Psoriasis', {'a': shared, 'b': shared + ['TP53']})
+        per_cluster = self.pubmed.construct_query_terms('Psoriasis', shared) + \
+            self.pubmed.construct_query_terms('Psoriasis', shared + ['TP53'])
+        assert(len(plan) < len(per_cluster))
+
+
+if __name__ == '__main__':
+    unittest.main()
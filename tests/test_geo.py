@@ -1,69 +1,52 @@
 import os
 import json
 import unittest
-import Bio.Entrez as Entrez
 from phenox.paths import PhenoXPaths
 from phenox.geo_data import GEOQuery
 
 
-paths = PhenoXPaths()
+paths = PhenoXPaths('test')
 test_data_path = os.path.join(paths.test_dir, 'data', 'test_geo_data.json')
 
-class TestGEO(unittest.TestCase):
-    def test_geo_data_fetcher(self):
-        geo = GEOQuery("test@test.xyz")
-        query_results = geo.get_ncbi_docsum("Muscular Dystrophies", "geoprofiles")
-        assert(len(query_results) == 1)
-        assert(len(query_results[0]['DocumentSummarySet']['DocumentSummary']) >= 844)
-
-    def test_gdsdict_from_profile(self):
-        geo = GEOQuery("test@test.xyz")
-
-        data = []
-        with open(test_data_path, 'r') as f:
-            for l in f:
-                data.append(json.loads(l))
-
-        # output gdsdict and overall gene frequency
-        gds_dict, gene_freq = geo.gdsdict_from_profile(data)
-
-        assert(len(gds_dict) == 15)
-        assert(len(gene_freq) == 2413)
 
-        gds_list = list(gds_dict.keys())
-        assert('5420' in gds_list)
+def load_test_data():
+    data = []
+    with open(test_data_path, 'r') as f:
+        for l in f:
+            data.append(json.loads(l))
+    return data
 
-        # elink gds to pid
-        pid_list = Entrez.read(
-            Entrez.elink(
-                id=gds_list, db='pubmed', dbfrom='gds', linkname='gds_pubmed'
-            )
-        )
-
-        # extract pubmed IDs
-        pids = [el['LinkSetDb'][0]['Link'][0]['Id'] for el in pid_list]
 
-        assert(len(pids) == 15)
-        assert(len(pids) == len(gds_dict))
-        assert('24646743' in pids)
-
-    def test_genedict_from_profile(self):
-        geo = GEOQuery("test@test.xyz")
+class TestGEO(unittest.TestCase):
+    def setUp(self):
+        self.geo = GEOQuery('test', 'Muscular Dystrophies', 'test@test.xyz')
 
-        data = []
-        with open(test_data_path, 'r') as f:
-            for l in f:
-                data.append(json.loads(l))
+    def tearDown(self):
+        self.geo.close()
 
-        # output gene ID => name table
-        gene_dict = geo.genedict_from_profile(data)
+    def test_geo_data_fetcher(self):
+        query_results = self.geo.get_ncbi_docsum("Muscular Dystrophies", "geoprofiles")
+        assert(len(query_results) >= 1)
+        assert(sum(len(batch['DocumentSummarySet']['DocumentSummary']) for batch in query_results) >= 844)
 
-        assert(len(gene_dict) == 2404)
-        assert('7057' in gene_dict)
-        assert(gene_dict['7057'] == 'THBS1')
+    def test_gdsdict_from_profile(self):
+        # output gdsdict: k=gds_id, v={k=geneName, v=gene freq}
+        gds_dict = self.geo.gdsdict_from_profile(load_test_data())
 
+        assert(len(gds_dict) == 28)
+        assert(len(set(g for genes in gds_dict.values() for g in genes)) == 2878)
+        assert('5420' in gds_dict)
+        assert(all(g == g.upper() for genes in gds_dict.values() for g in genes))
 
+    def test_get_pubmed_ids(self):
+        gds_dict = self.geo.gdsdict_from_profile(load_test_data())
 
+        # elink gds to pid
+        pids = self.geo.get_pubmed_ids(gds_dict)
 
+        assert(set(pids) == set(gds_dict))
+        assert('24646743' in pids.values())
 
 
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+import unittest
+
+from phenox.geo_data import GEOQuery
+from phenox.eutils_client import AsyncEntrez
+
+from eutils_server import EutilsServerCase
+
+EPOST = ('<?xml version="1.0" encoding="UTF-8" ?>\n'
+         '<!DOCTYPE ePostResult PUBLIC "-//NLM//DTD epost 20090526//EN" '
+         '"https://eutils.ncbi.nlm.nih.gov/eutils/dtd/20090526/epost.dtd">\n'
+         '<ePostResult><QueryKey>1</QueryKey><WebEnv>ENV</WebEnv></ePostResult>')
+
+DOCSUM = ('<DocSum><Id>{0}</Id><Item Name="GPL" Type="String">{1}</Item>'
+          '<Item Name="PDAT" Type="String">2010/01/0{2}</Item>'
+          '<Item Name="n_samples" Type="Integer">{3}</Item></DocSum>')
+
+ESUMMARY = ('<?xml version="1.0" encoding="UTF-8" ?>\n'
+            '<!DOCTYPE eSummaryResult PUBLIC "-//NLM//DTD esummary v1 20041029//EN" '
+            '"https://eutils.ncbi.nlm.nih.gov/eutils/dtd/20041029/esummary-v1.dtd">\n'
+            '<eSummaryResult>{}</eSummaryResult>')
+
+LINKSET = ('<LinkSet><DbFrom>gds</DbFrom><IdList><Id>{0}</Id></IdList>{1}</LinkSet>')
+LINKSETDB = ('<LinkSetDb><DbTo>pubmed</DbTo><LinkName>gds_pubmed</LinkName>'
+             '<Link><Id>9{0}</Id></Link></LinkSetDb>')
+ELINK = ('<?xml version="1.0" encoding="UTF-8" ?>\n'
+         '<!DOCTYPE eLinkResult PUBLIC "-//NLM//DTD elink 20101123//EN" '
+         '"https://eutils.ncbi.nlm.nih.gov/eutils/dtd/20101123/elink.dtd">\n'
+         '<eLinkResult>{}</eLinkResult>')
+
+ESEARCH = ('<?xml version="1.0" encoding="UTF-8" ?>\n'
+           '<!DOCTYPE eSearchResult PUBLIC "-//NLM//DTD esearch 20060628//EN" '
+           '"https://eutils.ncbi.nlm.nih.gov/eutils/dtd/20060628/esearch.dtd">\n'
+           '<eSearchResult><Count>{0}</Count><RetMax>{1}</RetMax><RetStart>0</RetStart>'
+           '<QueryKey>1</QueryKey><WebEnv>ENV</WebEnv><IdList>{2}</IdList></eSearchResult>')
+
+# more PubMed hits than esearch pages through
+PMIDS = [str(100000 + i) for i in range(23456)]
+
+GDS_IDS = [str(200 + i) for i in range(23)]
+
+
+class TestGeoBatches(EutilsServerCase):
+    def setUp(self):
+        super().setUp()
+        self.eutils = AsyncEntrez(rate=100, base_url=self.base_url)
+        self.geo = GEOQuery('phenox', 'test', 'test@example.com', elink_batch=5, esummary_batch=10,
+                            eutils=self.eutils)
+        self.gds_dict = {g: {'GENE': 1} for g in GDS_IDS}
+
+    def tearDown(self):
+        self.eutils.close()
+        super().tearDown()
+
+    def respond(self, endpoint, params):
+        if endpoint == 'epost':
+            return EPOST
+        if endpoint == 'esearch':
+            if int(params.get('retstart', ['0'])[0]) >= 10000:
+                return 400, 'Search Backend failed: retstart beyond 9998'
+            size = min(int(params['retmax'][0]), 10000)
+            return ESEARCH.format(len(PMIDS), size, ''.join('<Id>{}</Id>'.format(i) for i in PMIDS[:size]))
+        if endpoint == 'efetch':
+            start, size = int(params['retstart'][0]), int(params['retmax'][0])
+            return '\n'.join(PMIDS[start:start + size]) + '\n'
+        if endpoint == 'esummary':
+            start, size = int(params['retstart'][0]), int(params['retmax'][0])
+            return ESUMMARY.format(''.join(DOCSUM.format(g, 'GPL{}'.format(int(g) % 3), int(g) % 9 + 1, int(g) - 190)
+                                           for g in GDS_IDS[start:start + size]))
+        return ELINK.format(''.join(LINKSET.format(g, LINKSETDB.format(g) if int(g) % 2 else '')
+                                    for g in params['id']))
+
+    def test_meta_from_history_server(self):
+        meta_dict = self.geo.meta_from_gds(self.gds_dict)
+        assert(sorted(meta_dict) == sorted(GDS_IDS))
+        assert(meta_dict['201'][0] == 11 and meta_dict['201'][2] == 'GPL0')
+
+        endpoints = [e for e, _, _ in self.requests]
+        assert(endpoints.count('epost') == 1)
+        assert(endpoints.count('esummary') == 3)
+        assert(all(p['webenv'] == ['ENV'] for e, p, _ in self.requests if e == 'esummary'))
+
+    def test_pubmed_ids_one_link_set_per_gds(self):
+        pids = self.geo.get_pubmed_ids(self.gds_dict)
+        assert(sorted(pids) == sorted(GDS_IDS))
+        assert(pids['201'] == '9201' and pids['202'] is None)
+        assert(len(self.requests) == 5)
+        assert(all(len(p['id']) <= 5 for _, p, _ in self.requests))
+
+    def test_close_only_own_client(self):
+        with GEOQuery('phenox', 'test', 'test@example.com') as geo:
+            own = geo.eutils
+        assert(own._executor._shutdown)
+        self.geo.close()
+        assert(not self.eutils._executor._shutdown)
+
+    def test_search_ids_beyond_esearch_limit(self):
+        self.geo.esearch_batch = 4000
+        ids = self.geo.search_ids('psoriasis', 'pubmed', ['IL17A[tiab]'])[0]
+        assert(ids == PMIDS)
+
+        searches = [p for e, p, _ in self.requests if e == 'esearch']
+        assert(len(searches) == 1 and searches[0]['usehistory'] == ['y'])
+        fetches = [p for e, p, _ in self.requests if e == 'efetch']
+        assert(len(fetches) == 5)
+        assert(all(p['rettype'] == ['uilist'] and p['webenv'] == ['ENV'] for p in fetches))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,35 @@
+import os
+import tempfile
+import unittest
+
+from phenox.keyword_matcher import KeywordMatcher
+
+
+keywords = {'psoriasis': 'Psoriasis',
+            'psoriatic arthritis': 'psoriatic arthritis',
+            'arthritis': 'Arthritis',
+            "crohn's disease": "Crohn's disease",
+            'the flu': 'influenza',
+            'skin': 'Skin'}
+
+
+class TestKeywordMatcher(unittest.TestCase):
+    def test_leftmost_longest_case_insensitive(self):
+        matcher = KeywordMatcher(keywords, stop_words=['the'])
+        matches = matcher.find("Psoriatic Arthritis and Crohn's disease, not arthritisX or skins.")
+
+        assert([m[0] for m in matches] == ['Psoriatic Arthritis', "Crohn's disease"])
+        assert([m[2] for m in matches] == ['psoriatic arthritis', "Crohn's disease"])
+
+    def test_stop_word_start_rejected(self):
+        matcher = KeywordMatcher(keywords, stop_words=['the'])
+        assert(matcher.find('the flu in psoriasis') == [('psoriasis', 'psoriasis', 'Psoriasis')])
+
+    def test_save_load(self):
+        matcher = KeywordMatcher(keywords)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            matcher_file = os.path.join(tmp_dir, 'matcher.pkl')
+            matcher.save(matcher_file)
+            loaded = KeywordMatcher.load(matcher_file)
+        text = 'skin lesions in psoriatic arthritis'
+        assert(loaded.find(text) == matcher.find(text))
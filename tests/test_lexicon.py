@@ -0,0 +1,54 @@
+import os
+import json
+import pickle
+import tempfile
+import unittest
+
+from phenox.lexicon import build_lexicon, load_ontology_keywords, OntologyLexicon
+
+
+id2kw = {'DOID_1': ['psoriasis', 'psoriasis vulgaris'],
+         'HP_2': ['Arthritis', 'joint inflammation']}
+kw2id = {'psoriasis': 'DOID_1', 'psoriasis vulgaris': 'DOID_1',
+         'arthritis': 'HP_2', 'joint inflammation': 'HP_2'}
+hp = {'HP_3': ['Café-au-lait spot']}
+
+
+class TestOntologyLexicon(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.lexicon_file = os.path.join(self.tmp_dir.name, 'lexicon.bin')
+        build_lexicon(id2kw, kw2id, [hp], self.lexicon_file)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_lookups_match_dicts(self):
+        lexicon = OntologyLexicon(self.lexicon_file)
+        for kw, term_id in kw2id.items():
+            assert(lexicon.kw2id[kw] == term_id)
+        for term_id, kws in id2kw.items():
+            assert(lexicon.id2kw[term_id] == kws)
+        assert('missing' not in lexicon.kw2id)
+        assert(len(lexicon.kw2id) == 5)
+
+    def test_ontology_terms_added(self):
+        lexicon = OntologyLexicon(self.lexicon_file)
+        assert(lexicon.id2kw[lexicon.kw2id['café-au-lait spot']][0] == 'Café-au-lait spot')
+
+    def test_fallback_matches_lexicon(self):
+        # the pickle fallback and the lexicon file see the same keywords
+        for name, obj in (('id2kw_dict.pkl', id2kw), ('kw2id_dict.pkl', kw2id)):
+            with open(os.path.join(self.tmp_dir.name, name), 'wb') as f:
+                pickle.dump(obj, f)
+        for name, obj in (('doid.json', {}), ('hp.json', hp)):
+            with open(os.path.join(self.tmp_dir.name, name), 'w') as f:
+                json.dump(obj, f)
+        fallback_id2kw, fallback_kw2id = load_ontology_keywords(self.tmp_dir.name)
+        lexicon = OntologyLexicon(self.lexicon_file)
+        assert(fallback_kw2id == dict(lexicon.kw2id.items()))
+        assert(fallback_id2kw == dict(lexicon.id2kw.items()))
+
+    def test_pickle_reopens_mapping(self):
+        lexicon = pickle.loads(pickle.dumps(OntologyLexicon(self.lexicon_file)))
+        assert(dict(lexicon.kw2id.items()) == dict(kw2id, **{'café-au-lait spot': 'HP_3'}))
@@ -0,0 +1,61 @@
+import os
+import tempfile
+import unittest
+
+from phenox.mesh_hierarchy import MeshHierarchy, iter_mesh_bin
+
+
+mesh_bin = """*NEWRECORD
+MH = Skin Diseases
+MN = C17.800
+ENTRY = Dermatoses|T047
+*NEWRECORD
+MH = Psoriasis
+MN = C17.800.859.675
+*NEWRECORD
+MH = Skin Diseases, Papulosquamous
+MN = C17.800.859
+*NEWRECORD
+MH = Arthritis, Psoriatic
+MN = C05.116.900.853.625.800.424
+MN = C17.800.859.675.175
+*NEWRECORD
+MH = Skin
+MN = A17.815
+"""
+
+
+class TestMeshHierarchy(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.bin_file = os.path.join(self.tmp_dir.name, 'd2019.bin')
+        with open(self.bin_file, 'w') as f:
+            f.write(mesh_bin)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_stream_disease_records(self):
+        records = list(iter_mesh_bin(self.bin_file))
+        assert([r[0] for r in records] == ['Skin Diseases', 'Psoriasis',
+                                           'Skin Diseases, Papulosquamous', 'Arthritis, Psoriatic'])
+        assert(records[0][2] == ['dermatoses'])
+
+    def test_hierarchy_queries(self):
+        hierarchy = MeshHierarchy.from_records(iter_mesh_bin(self.bin_file))
+        psoriasis = hierarchy.node('psoriasis')
+
+        assert(hierarchy.names_of(hierarchy.children(psoriasis)) == ['Arthritis, Psoriatic'])
+        assert(hierarchy.names_of(hierarchy.parents(psoriasis)) == ['Skin Diseases, Papulosquamous'])
+        assert(set(hierarchy.names_of(hierarchy.ancestors(psoriasis))) ==
+               {'Skin Diseases', 'Skin Diseases, Papulosquamous'})
+        assert(len(hierarchy.descendants(hierarchy.node('Skin Diseases'))) == 3)
+
+    def test_save_load(self):
+        hierarchy = MeshHierarchy.from_records(iter_mesh_bin(self.bin_file))
+        index_file = os.path.join(self.tmp_dir.name, 'mesh_hierarchy.npz')
+        hierarchy.save(index_file)
+        loaded = MeshHierarchy.load(index_file)
+
+        node = loaded.node('Skin Diseases')
+        assert(loaded.names_of(loaded.subtree(node)) == hierarchy.names_of(hierarchy.subtree(node)))
@@ -1,13 +1,106 @@
+import os
+import json
+import tempfile
 import unittest
+from unittest import mock
+import numpy as np
 
-from phenox.mesh_lookup import MeshSearcher
+from phenox.mesh_lookup import MeshSearcher, MeshLookupError, source_stamp
+
+MESH = {
+    'skin diseases': {'ids': ['C17.800'], 'name': 'Skin Diseases', 'aliases': ['dermatoses'],
+                      'parents': [], 'children': ['psoriasis']},
+    'psoriasis': {'ids': ['C17.800.675'], 'name': 'Psoriasis', 'aliases': ['psoriases'],
+                  'parents': ['skin diseases'], 'children': []},
+}
 
 
 class TestMeshSearcher(unittest.TestCase):
 
     def test_search_correct_term(self):
-        mesh = MeshSearcher()
+        mesh = MeshSearcher('phenox')
         match = mesh.lookup('psoriasis')
 
         assert(match['name'] == 'Psoriasis')
         assert('C17.800.859.675' in match['ids'])
+
+    def test_search_alias(self):
+        mesh = MeshSearcher('phenox', policy='fail')
+        match = mesh.lookup('Acute Abdomen')
+
+        assert(match['name'] == 'Abdomen, Acute')
+
+    def test_search_misspelled_term(self):
+        mesh = MeshSearcher('phenox', policy='best')
+        assert(mesh.lookup('psoriasiss')['name'] == 'Psoriasis')
+
+        candidates = mesh.lookup('psoriasiss', policy='candidates')
+        assert(candidates[0]['name'] == 'Psoriasis')
+
+        with self.assertRaises(MeshLookupError):
+            mesh.lookup('psoriasiss', policy='fail')
+
+    def test_records_index_replaces_json(self):
+        with tempfile.TemporaryDirectory() as data_dir:
+            mesh_json = os.path.join(data_dir, 'mesh.json')
+            with open(mesh_json, 'w') as f:
+                json.dump(MESH, f)
+            mesh = MeshSearcher('phenox', policy='fail', data_dir=data_dir)
+            assert(dict(mesh.mesh) == MESH)
+            assert(os.path.exists(os.path.join(data_dir, 'mesh_records.npz')))
+            assert(mesh.hierarchy.names_of(mesh.hierarchy.children(mesh.hierarchy.node('Skin Diseases')))
+                   == ['Psoriasis'])
+
+            # a fresh index is loaded without parsing mesh.json
+            with mock.patch('phenox.mesh_lookup.json.load', side_effect=AssertionError('parsed mesh.json')):
+                mesh = MeshSearcher('phenox', policy='fail', data_dir=data_dir)
+                assert(mesh.lookup('Dermatoses')['name'] == 'Skin Diseases')
+                mesh.hierarchy
+
+            # a regenerated mesh.json replaces stale indexes
+            regenerated = dict(MESH, eczema={'ids': ['C17.800.174'], 'name': 'Eczema', 'aliases': [],
+                                             'parents': ['skin diseases'], 'children': []})
+            with open(mesh_json, 'w') as f:
+                json.dump(regenerated, f)
+            stat = os.stat(mesh_json)
+            os.utime(mesh_json, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+            mesh = MeshSearcher('phenox', policy='fail', data_dir=data_dir)
+            assert(mesh.lookup('eczema')['ids'] == ['C17.800.174'])
+            assert(len(mesh.hierarchy.children(mesh.hierarchy.node('Skin Diseases'))) == 2)
+
+    def test_records_stored_as_utf8(self):
+        with tempfile.TemporaryDirectory() as data_dir:
+            mesh_json = os.path.join(data_dir, 'mesh.json')
+            with open(mesh_json, 'w') as f:
+                json.dump(dict(MESH, **{'café': {'ids': [], 'name': 'Café', 'aliases': ['cafés'],
+                                                 'parents': [], 'children': []}}), f)
+            records_file = os.path.join(data_dir, 'mesh_records.npz')
+            # a records file of an older layout is rebuilt
+            np.savez(records_file, source=np.array(source_stamp(mesh_json)))
+            mesh = MeshSearcher('phenox', policy='fail', data_dir=data_dir)
+            assert(mesh.mesh['café']['aliases'] == ['cafés'])
+            with np.load(records_file) as data:
+                assert(data['names'].dtype == np.uint8)
+                assert(data['names'].tobytes().decode('utf-8') == 'Skin DiseasesPsoriasisCafé')
+            assert(dict(MeshSearcher('phenox', data_dir=data_dir).mesh)['café']['name'] == 'Café')
+
+    def test_trigram_index_persisted(self):
+        with tempfile.TemporaryDirectory() as data_dir:
+            with open(os.path.join(data_dir, 'mesh.json'), 'w') as f:
+                json.dump(MESH, f)
+            built = MeshSearcher('phenox', data_dir=data_dir).index
+            assert(os.path.exists(os.path.join(data_dir, 'mesh_trigrams.npz')))
+            loaded = MeshSearcher('phenox', data_dir=data_dir).index
+            assert(loaded.search('psoriasiss') == built.search('psoriasiss'))
+            assert(loaded.search('psoriasiss')[0][0] == 'psoriasis')
+            with np.load(os.path.join(data_dir, 'mesh_trigrams.npz')) as data:
+                assert(all(data[name].dtype == np.uint8 for name in ('names', 'keys', 'grams')))
+                # one key per record, names refer to it by row
+                assert(data['keys'].tobytes().decode('utf-8') in ('skin diseasespsoriasis', 'psoriasisskin diseases'))
+
+    def test_interactive_bad_selection_raises(self):
+        mesh = MeshSearcher('phenox')
+        with mock.patch('sys.stdin') as stdin, mock.patch('builtins.input', return_value='9'):
+            stdin.isatty.return_value = True
+            with self.assertRaises(MeshLookupError):
+                mesh.lookup('psoriasiss')
@@ -0,0 +1,60 @@
+import os
+import json
+import tempfile
+import unittest
+from urllib.error import HTTPError
+
+from phenox.checkpoint import RunCheckpoints
+from phenox.metrics import RunMetrics
+from phenox.transport import MeteredTransport, RequestArchive, ReplayTransport
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.trace_file = os.path.join(self.tmp_dir.name, 'metrics.jsonl')
+        self.metrics = RunMetrics(self.trace_file, query='psoriasis')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def _trace(self):
+        with open(self.trace_file) as f:
+            return [json.loads(line) for line in f]
+
+    def test_stage_timing_through_checkpoints(self):
+        run_dir = os.path.join(self.tmp_dir.name, 'run')
+        RunCheckpoints(run_dir, metrics=self.metrics).run('mesh', {}, lambda: sum(range(100000)))
+        assert(self.metrics.stages['mesh']['checkpoint'] == 'computed')
+        RunCheckpoints(run_dir, resume=True, metrics=self.metrics).run('mesh', {}, lambda: 0)
+        assert(self.metrics.stages['mesh']['checkpoint'] == 'reused')
+        assert(self.metrics.stages['mesh']['seconds'] >= 0 and 'cpu_seconds' in self.metrics.stages['mesh'])
+        assert([e['event'] for e in self._trace()] == ['run_start', 'stage', 'stage'])
+
+    def test_request_statistics(self):
+        archive = RequestArchive(os.path.join(self.tmp_dir.name, 'run.jsonl'))
+        archive.add('efetch', {'db': 'pubmed', 'id': '1'}, 200, b'x' * 100, .1)
+        archive.add('efetch', {'db': 'pubmed', 'id': '2'}, 503, b'busy', .1)
+        transport = MeteredTransport(ReplayTransport(archive))
+        transport.fetch('efetch', {'db': 'pubmed', 'id': '1'})
+        transport.metrics = self.metrics
+        transport.fetch('efetch', {'db': 'pubmed', 'id': '1'})
+        with self.assertRaises(HTTPError):
+            transport.fetch('efetch', {'db': 'pubmed', 'id': '2'})
+        self.metrics.retry('efetch', 'HTTP 503')
+        self.metrics.record('gds_matrix', rows=2, columns=3)
+
+        summary_file = os.path.join(self.tmp_dir.name, 'summary.json')
+        self.metrics.write_summary(summary_file)
+        with open(summary_file) as f:
+            summary = json.load(f)
+        efetch = summary['endpoints']['efetch']
+        # the request before metrics were attached is not counted
+        assert((efetch['requests'], efetch['errors'], efetch['retries'], efetch['bytes']) == (2, 1, 1, 100))
+        assert(efetch['latency_max'] >= efetch['latency_p50'] >= 0)
+        assert(summary['values']['gds_matrix'] == {'rows': 2, 'columns': 3})
+        assert(self._trace()[-1]['event'] == 'run_end')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+import unittest
+from collections import Counter
+
+from phenox.pubmed import Pubmed
+from phenox.keyword_matcher import KeywordMatcher
+
+ABSTRACTS = {
+    '1': 'Psoriasis with arthritis.',
+    '2': 'Arthritis and eczema.',
+    '3': 'Eczema.',
+}
+
+
+class TestNERStore(unittest.TestCase):
+    def setUp(self):
+        self.pubmed = Pubmed.__new__(Pubmed)
+        self.pubmed.matcher = KeywordMatcher({'psoriasis': 'psoriasis', 'arthritis': 'arthritis',
+                                              'eczema': 'eczema'})
+        self.pubmed.pmid_abstracts = dict()
+        self.pubmed.pmid_dner = dict()
+        self.pubmed.pmid_ent_text = dict()
+        self.pubmed.total_dner = []
+        self.pubmed.ner_batch_size = 2
+        self.pubmed.ner_processes = 1
+        self.pubmed.metrics = None
+        self.fetched = []
+        self.pubmed.fetch_abstracts = self.fetch_abstracts
+
+    def fetch_abstracts(self, pmid_list):
+        self.fetched += pmid_list
+        for pmid in pmid_list:
+            self.pubmed.pmid_abstracts[pmid] = ABSTRACTS[pmid]
+
+    def test_cluster_counts_are_independent(self):
+        freqs = self.pubmed.get_cluster_term_frequencies({
+            'cluster0': ['1', '2'],
+            'cluster1': ['2', '3', '3'],
+        })
+        assert(freqs['cluster0'] == Counter({'arthritis': 2, 'psoriasis': 1, 'eczema': 1}))
+        assert(freqs['cluster1'] == Counter({'eczema': 2, 'arthritis': 1}))
+        assert(sorted(self.fetched) == ['1', '2', '3'])
+
+    def test_each_pmid_fetched_once(self):
+        first = self.pubmed.get_term_frequencies(['1', '2'])
+        second = self.pubmed.get_term_frequencies(['2', '3'])
+        assert(first == Counter({'arthritis': 2, 'psoriasis': 1, 'eczema': 1}))
+        assert(second == Counter({'eczema': 2, 'arthritis': 1}))
+        assert(self.fetched == ['1', '2', '3'])
+
+
+if __name__ == '__main__':
+    unittest.main()
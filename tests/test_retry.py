@@ -0,0 +1,118 @@
+import io
+import os
+import tempfile
+import unittest
+from unittest import mock
+from email.message import Message
+from urllib.error import HTTPError, URLError
+
+from phenox.eutils_client import AsyncEntrez, run_sync
+from phenox.geo_data import GEOQuery
+from phenox.retry import CircuitBreaker, NCBIErrorResponse, NCBIUnavailableError, RetryPolicy, classify, \
+    retry_after
+from phenox.transport import RequestArchive, ReplayTransport, Transport
+
+ESEARCH = ('<?xml version="1.0" encoding="UTF-8" ?>\n'
+           '<!DOCTYPE eSearchResult PUBLIC "-//NLM//DTD esearch 20060628//EN" '
+           '"https://eutils.ncbi.nlm.nih.gov/eutils/dtd/20060628/esearch.dtd">\n'
+           '<eSearchResult><Count>1</Count><RetMax>1</RetMax><RetStart>0</RetStart>'
+           '<IdList><Id>7</Id></IdList><TranslationSet/><QueryTranslation>lupus</QueryTranslation>'
+           '</eSearchResult>')
+
+
+def http_error(code, retry_after_value=None):
+    headers = Message()
+    if retry_after_value is not None:
+        headers['Retry-After'] = retry_after_value
+    return HTTPError('https://eutils.example/efetch.fcgi', code, 'error', headers, io.BytesIO(b''))
+
+
+class TestRetry(unittest.TestCase):
+    def test_classify(self):
+        assert(classify(http_error(429)) == 'throttle')
+        assert(classify(http_error(503)) == 'server')
+        assert(classify(http_error(400)) == 'bad_request')
+        assert(classify(http_error(404)) is None)
+        assert(classify(URLError('refused')) == 'network')
+        assert(classify(ValueError('truncated')) == 'parse')
+        assert(classify(NCBIErrorResponse('Unable to obtain query #1')) == 'bad_request')
+        assert(classify(KeyError('x')) is None)
+
+    def test_backoff_and_retry_after(self):
+        policy = RetryPolicy(base_delay=1., max_delay=10., seed=0)
+        assert(retry_after(http_error(503, '3')) == 3.)
+        assert(policy.delay(http_error(503, '3'), 0) == 3.)
+        assert(policy.delay(http_error(503, '120'), 0) == 10.)
+        assert(all(0 <= policy.delay(http_error(503), 3) <= 8 for _ in range(20)))
+        assert(all(policy.delay(http_error(503), 10) <= 10 for _ in range(20)))
+
+    def test_budgets(self):
+        policy = RetryPolicy(base_delay=.001, budgets={'server': 2})
+        errors = [http_error(503), http_error(502)]
+        retried = []
+
+        def flaky():
+            if errors:
+                raise errors.pop()
+            return 'ok'
+
+        assert(policy.call(flaky, 'efetch', on_retry=lambda e, err: retried.append(err.code)) == 'ok')
+        assert(retried == [502, 503])
+
+        with self.assertRaises(NCBIUnavailableError):
+            policy.call(lambda: (_ for _ in ()).throw(http_error(500)), 'efetch')
+        with self.assertRaises(HTTPError):
+            policy.call(lambda: (_ for _ in ()).throw(http_error(404)), 'efetch')
+
+    def test_bio_entrez_does_not_retry_underneath(self):
+        policy = RetryPolicy(base_delay=.001, budgets={'network': 1})
+        with mock.patch('Bio.Entrez.urlopen', side_effect=URLError('connection refused')) as urlopen:
+            with self.assertRaises(NCBIUnavailableError):
+                policy.call(lambda: Transport().send('efetch', {'db': 'pubmed', 'id': '1'}), 'efetch')
+        # one try per policy attempt, no hidden Bio.Entrez retries
+        assert(urlopen.call_count == 2)
+
+    def test_circuit_breaker(self):
+        breaker = CircuitBreaker(threshold=3, reset_after=60.)
+        policy = RetryPolicy(base_delay=.001, budgets={'server': 10}, breaker=breaker)
+        calls = []
+
+        def down():
+            calls.append(1)
+            raise http_error(503)
+
+        with self.assertRaises(NCBIUnavailableError):
+            policy.call(down, 'esearch')
+        assert(len(calls) == 3)
+        # open: later calls fail without a request
+        with self.assertRaises(NCBIUnavailableError):
+            policy.call(lambda: 'ok', 'esearch')
+
+        breaker.reset_after = 0.
+        assert(policy.call(lambda: 'ok', 'esearch') == 'ok')
+        assert(breaker.opened is None and breaker.failures == 0)
+
+    def test_async_requests_recover_from_injected_errors(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            archive = RequestArchive(os.path.join(tmp_dir, 'run.jsonl'))
+            archive.add('esearch', {'db': 'gds', 'term': 'lupus'}, 200, ESEARCH.encode('utf-8'), .01)
+            client = AsyncEntrez(transport=ReplayTransport(archive, error_rate=.5, seed=3), rate=1000)
+            geo = GEOQuery('test', 'lupus', 'test@example.com', eutils=client,
+                           retry=RetryPolicy(base_delay=.001, budgets={'server': 20}))
+            result = run_sync(geo.http_attempts_async('esearch', db='gds', term='lupus'))
+            client.close()
+        assert(result['IdList'] == ['7'])
+
+    def test_unparseable_response_not_dropped(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            archive = RequestArchive(os.path.join(tmp_dir, 'run.jsonl'))
+            archive.add('esearch', {'db': 'gds', 'term': 'lupus'}, 200, ESEARCH[:120].encode('utf-8'), .01)
+            client = AsyncEntrez(transport=ReplayTransport(archive), rate=1000)
+            geo = GEOQuery('test', 'lupus', 'test@example.com', eutils=client, retry=RetryPolicy(base_delay=.001))
+            with self.assertRaises(NCBIUnavailableError):
+                run_sync(geo.http_attempts_async('esearch', db='gds', term='lupus'))
+            client.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+import os
+import json
+import glob
+import time
+import shutil
+import threading
+import unittest
+import urllib.request
+from urllib.error import HTTPError
+
+from phenox.batch import worker_config
+from phenox.paths import PhenoXPaths
+from phenox.server import JobQueue, make_server
+
+
+class TestServer(unittest.TestCase):
+    def setUp(self):
+        # nothing is cached, so offline jobs fail without touching the network
+        config = worker_config('test@example.com', 'test_server', cache_mode='offline',
+                               mesh_policy='fail', cluster_engine='python')
+        self.jobs = JobQueue(config, workers=1, max_queued=2)
+        self.server = make_server(self.jobs, port=0)
+        self.url = 'http://127.0.0.1:{}/jobs'.format(self.server.server_address[1])
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.jobs.shutdown()
+        output_dir = PhenoXPaths('test_server').output_dir
+        for path in glob.glob(os.path.join(output_dir, 'runs', 'test_server_*')):
+            shutil.rmtree(path)
+
+    def _call(self, url, payload=None):
+        data = None if payload is None else json.dumps(payload).encode('utf-8')
+        try:
+            with urllib.request.urlopen(url, data=data) as response:
+                return response.status, json.loads(response.read())
+        except HTTPError as err:
+            return err.code, json.loads(err.read())
+
+    def test_job_lifecycle(self):
+        code, job = self._call(self.url, {'query': 'no such disease xyz'})
+        assert(code == 202)
+        assert(job['status'] in ('queued', 'running'))
+        assert(job['outprefix'].startswith('test_server_no-such-disease-xyz-'))
+
+        for _ in range(300):
+            code, job = self._call('{}/{}'.format(self.url, job['id']))
+            if job['status'] not in ('queued', 'running'):
+                break
+            time.sleep(0.1)
+        assert(code == 200)
+        assert(job['status'] == 'failed')
+        assert(job['error'].startswith('MeshLookupError'))
+        assert(job['results'] == [])
+
+        code, jobs = self._call(self.url)
+        assert(code == 200 and [j['id'] for j in jobs] == [job['id']])
+
+        # finished jobs are forgotten once past their ttl
+        self.jobs.finished_ttl = 0
+        code, jobs = self._call(self.url)
+        assert(code == 200 and jobs == [])
+        assert(self._call('{}/{}'.format(self.url, job['id']))[0] == 404)
+
+    def test_result_files_match_outprefix_only(self):
+        output_dir = self.jobs.paths.output_dir
+        names = ['test_server_a-b_x.txt', 'test_server_a-b-c_x.txt', 'test_server[1]_x.txt', 'test_server1_x.txt']
+        for name in names:
+            open(os.path.join(output_dir, name), 'w').close()
+        try:
+            results = self.jobs._result_files({'outprefix': 'test_server_a-b', 'query': 'a b'})
+            assert([os.path.basename(f) for f in results] == ['test_server_a-b_x.txt'])
+            results = self.jobs._result_files({'outprefix': 'test_server[1]', 'query': '1'})
+            assert([os.path.basename(f) for f in results] == ['test_server[1]_x.txt'])
+        finally:
+            for name in names:
+                os.remove(os.path.join(output_dir, name))
+
+    def test_bad_requests(self):
+        assert(self._call(self.url + '/unknown')[0] == 404)
+        assert(self._call(self.url, {'query': ' '})[0] == 400)
+        assert(self._call(self.url, {'query': 'psoriasis', 'options': {'email': 'x'}})[0] == 400)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+import os
+import tempfile
+import threading
+import unittest
+from urllib.error import HTTPError
+
+from phenox.entrez_cache import entrez_request
+from phenox.eutils_client import AsyncEntrez, run_all
+from phenox.phenox import PhenoXResources
+from phenox.transport import ArchiveMissError, RequestArchive, ReplayTransport, make_replay_server, \
+    make_transport, archive_key
+
+from eutils_server import EutilsServerCase
+
+ESEARCH = ('<?xml version="1.0" encoding="UTF-8" ?>\n'
+           '<!DOCTYPE eSearchResult PUBLIC "-//NLM//DTD esearch 20060628//EN" '
+           '"https://eutils.ncbi.nlm.nih.gov/eutils/dtd/20060628/esearch.dtd">\n'
+           '<eSearchResult><Count>1</Count><RetMax>1</RetMax><RetStart>0</RetStart>'
+           '<IdList><Id>{}</Id></IdList><TranslationSet/><QueryTranslation>{}</QueryTranslation>'
+           '</eSearchResult>')
+
+
+class TestTransport(EutilsServerCase):
+    def setUp(self):
+        super().setUp()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.archive_file = os.path.join(self.tmp_dir.name, 'run.jsonl')
+
+    def tearDown(self):
+        super().tearDown()
+        self.tmp_dir.cleanup()
+
+    def respond(self, endpoint, params):
+        if params['term'][0] == 'missing':
+            return 404, 'not found'
+        return ESEARCH.format(len(self.requests), params['term'][0])
+
+    def _record(self):
+        transport = make_transport(record=self.archive_file, base_url=self.base_url)
+        # sync requests go through the transport's sender, async ones through the pool
+        handle = entrez_request(None, 'esearch', transport=transport, db='gds', term='psoriasis', retmax=1)
+        assert(b'<Id>1</Id>' in handle.read())
+        client = AsyncEntrez(transport=transport)
+        results = run_all([client.read('esearch', db='gds', term=t, retmax=1) for t in ('lupus', 'asthma')])
+        with self.assertRaises(HTTPError):
+            run_all([client.request('esearch', db='gds', term='missing')])
+        client.close()
+        return results
+
+    def test_record_and_replay(self):
+        recorded = self._record()
+        assert(len(self.requests) == 3 + 1)
+        assert(archive_key('esearch', {'db': 'gds', 'retmax': 1}) ==
+               archive_key('esearch', {'db': 'gds', 'retmax': '1', 'email': 'x@y.z'}))
+
+        transport = make_transport(replay=self.archive_file)
+        client = AsyncEntrez(transport=transport, rate=100)
+        replayed = run_all([client.read('esearch', db='gds', term=t, retmax=1) for t in ('lupus', 'asthma')])
+        assert(replayed == recorded)
+        with self.assertRaises(HTTPError) as err:
+            run_all([client.request('esearch', db='gds', term='missing')])
+        assert(err.exception.code == 404)
+        with self.assertRaises(ArchiveMissError):
+            run_all([client.request('esearch', db='gds', term='eczema')])
+        client.close()
+        # nothing reached the live server on replay
+        assert(len(self.requests) == 4)
+
+    def test_cache_off_when_recording_or_replaying(self):
+        self._record()
+        for transport in (make_transport(replay=self.archive_file), make_transport(record=self.archive_file)):
+            resources = PhenoXResources('test@example.com', 'test', cache_mode='readwrite', transport=transport)
+            assert(resources.cache is None and resources.eutils.cache is None)
+            resources.eutils.close()
+
+    def test_injected_errors_deterministic(self):
+        self._record()
+
+        def outcomes(seed):
+            transport = ReplayTransport(RequestArchive(self.archive_file), error_rate=.5, seed=seed)
+            result = []
+            for _ in range(20):
+                try:
+                    transport.fetch('esearch', {'db': 'gds', 'term': 'lupus', 'retmax': 1})
+                    result.append(200)
+                except HTTPError as err:
+                    result.append(err.code)
+            return result
+
+        assert(outcomes(1) == outcomes(1))
+        assert(set(outcomes(1)) == {200, 503})
+
+    def test_replay_server(self):
+        recorded = self._record()
+        server = make_replay_server(make_transport(replay=self.archive_file), port=0)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            client = AsyncEntrez(base_url='http://127.0.0.1:{}/eutils/'.format(server.server_address[1]), rate=100)
+            replayed = run_all([client.read('esearch', db='gds', term=t, retmax=1) for t in ('lupus', 'asthma')])
+            client.close()
+            assert(replayed == recorded)
+
+            # sync requests reach the stand-in through a plain transport
+            handle = entrez_request(None, 'esearch', transport=make_transport(
+                base_url='http://127.0.0.1:{}/'.format(server.server_address[1])), db='gds', term='psoriasis', retmax=1)
+            assert(b'<Id>1</Id>' in handle.read())
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+import numpy as np
+from collections import Counter
+
+from phenox.wordcloud import WordcloudPlotter, cloud_key
+
+
+class TestWordcloud(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.plotter = WordcloudPlotter('phenox', processes=2)
+        self.plotter.render_dir = self.tmp.name
+        self.clusters = {
+            'cluster0': Counter({'psoriasis': 10, 'arthritis': 4, 'eczema': 2}),
+            'cluster1': Counter({'lupus': 7, 'nephritis': 3}),
+            'cluster2': Counter(),
+        }
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_cloud_key(self):
+        assert(cloud_key({'a': 1, 'b': 2}) == cloud_key(Counter({'b': 2, 'a': 1})))
+        assert(cloud_key({'a': 1, 'b': 2}) != cloud_key({'a': 1, 'b': 3}))
+
+    def test_render_cache(self):
+        first = self.plotter._render_all(self.clusters)
+        assert(len(os.listdir(self.tmp.name)) == 3)
+        assert(first['cluster0'].shape == (800, 1400, 4))
+        assert(not first['cluster2'].any())
+
+        # a cache hit is not rendered again
+        with mock.patch('phenox.wordcloud.render_cloud') as render:
+            second = self.plotter._render_all(self.clusters)
+        assert(not render.called)
+        for name in self.clusters:
+            assert(np.array_equal(first[name], second[name]))
+
+    def test_render_cache_mode_and_size(self):
+        self.plotter.cache_mode = 'readonly'
+        self.plotter._render_all(self.clusters)
+        assert(os.listdir(self.tmp.name) == [])
+
+        # a bound fitting one render keeps the most recently used one
+        self.plotter.cache_mode = 'readwrite'
+        for name in ['cluster0', 'cluster1', 'cluster0']:
+            self.plotter._render_all({name: self.clusters[name]})
+        sizes = [os.path.getsize(os.path.join(self.tmp.name, f)) for f in os.listdir(self.tmp.name)]
+        self.plotter.max_bytes = max(sizes)
+        self.plotter._evict()
+        assert(os.listdir(self.tmp.name) == ['{}.png'.format(cloud_key(self.clusters['cluster0']))])
+
+    def test_cluster_files(self):
+        output_file = os.path.join(self.tmp.name, 'test_wordcloud.png')
+        self.plotter.generate_wordclouds(self.clusters, output_file, cluster_files=True)
+        assert(os.path.exists(output_file))
+        for name in self.clusters:
+            assert(os.path.exists(os.path.join(self.tmp.name, 'test_wordcloud_{}.png'.format(name))))
+
+
+if __name__ == '__main__':
+    unittest.main()